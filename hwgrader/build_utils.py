@@ -0,0 +1,820 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+from utils import unzip_submission, get_submitters
+from metrics_utils import record_phase, set_metrics_submission
+from index_utils import source_hash, file_hash
+import traceback
+import md5
+import fnmatch
+import filecmp
+import errno
+import shutil
+import time
+import sys
+import os
+
+__all__ = [
+    'cpu_count',
+    'run_pool',
+    'artifact_folder',
+    'artifact_status',
+    'artifact_sources',
+    'artifact_from_cache',
+    'cache_built_kernel',
+    'snapshot_tree',
+    'build_reference_tree',
+    'prepare_kernel_tree',
+    'headers_changed',
+    'choose_build_recipe',
+    'set_installed_modules',
+    'log_recipe_time',
+    'build_artifact',
+    'prebuild_submissions',
+    'start_background_build',
+    'wait_background_build',
+    'install_artifact'
+    ]
+
+ARTIFACT_SOURCE_FOLDER = 'submission'
+ARTIFACT_STATUS_NAME = 'status'
+ARTIFACT_LOG_NAME = 'build.log'
+ARTIFACT_HEADERS_NAME = 'headers_changed'
+KERNEL_MANIFEST_NAME = '.hwgrader_manifest'
+REFERENCE_LOG_NAME = 'reference_build.log'
+
+#
+# Digests of the build environment by build script (see _environment_digest).
+#
+_environment_digests = {}
+
+#
+# Build recipes. The no modules recipe skips the build and install of
+# the modules and the initrd.
+#
+BUILD_RECIPE_FULL = 'full'
+BUILD_RECIPE_NO_MODULES = 'no_modules'
+
+#
+# State of the installed modules: built with the reference headers, with
+# headers modified by a submission or unknown (e.g. an install failed).
+#
+MODULES_REFERENCE = 'reference'
+MODULES_MODIFIED = 'modified'
+MODULES_UNKNOWN = 'unknown'
+
+#
+# Files that the kernel build might rewrite in place. These are copied
+# when snapshoting a tree, all the rest are hardlinked.
+#
+SNAPSHOT_COPY_PATTERNS = [
+    '*.o',
+    '*.a',
+    '.*',
+    '*.ver',
+    'vmlinux*',
+    'bzImage',
+    'System.map',
+    'autoconf.h',
+    'version.h',
+    'compile.h',
+    'modversions.h',
+    'include/config/*'
+    ]
+
+
+def cpu_count():
+    """Return the number of processors available on this machine"""
+
+    try:
+        f = open('/proc/cpuinfo', 'rb')
+        lines = f.readlines()
+        f.close()
+    except IOError:
+        return 1
+
+    cpus = len([line for line in lines if line.startswith('processor')])
+
+    return max(cpus, 1)
+
+
+def run_pool(jobs, func, workers=None, done=None):
+    """Run func(job, slot) for each job in a pool of forked worker processes.
+
+    The slot is the index (0..workers-1) of the worker running the job. It
+    allows the func to use per-worker resources (e.g. a kernel tree). The
+    return value of func is used as the exit code of the worker. If done is
+    given, done(job, status) is called in the parent when a job ends.
+    Returns a dict that maps each job to its exit status.
+    """
+
+    if not workers:
+        workers = cpu_count()
+
+    jobs = list(jobs)
+    free_slots = range(workers)
+    running = {}
+    statuses = {}
+
+    while jobs or running:
+        while jobs and free_slots:
+            job = jobs.pop(0)
+            slot = free_slots.pop(0)
+
+            pid = os.fork()
+            if pid == 0:
+                status = 1
+                try:
+                    status = func(job, slot)
+                except:
+                    traceback.print_exc()
+
+                #
+                # Never return into the code of the parent.
+                #
+                os._exit(status and 1 or 0)
+
+            running[pid] = (job, slot)
+
+        pid, status = os.wait()
+        if pid not in running:
+            continue
+
+        job, slot = running[pid]
+        del running[pid]
+        statuses[job] = status
+        free_slots.append(slot)
+
+        if done:
+            done(job, status)
+
+    return statuses
+
+
+def artifact_folder(submission):
+    """The folder that stores the build artifacts of a submission"""
+
+    name = os.path.splitext(os.path.basename(submission))[0]
+
+    return os.path.join(ARTIFACTS_FOLDER, name)
+
+
+def artifact_status(submission):
+    """Return the build status of a submission artifact or None if not built"""
+
+    status_path = os.path.join(artifact_folder(submission), ARTIFACT_STATUS_NAME)
+    if not os.path.exists(status_path):
+        return None
+
+    f = open(status_path, 'rb')
+    status = int(f.read().strip())
+    f.close()
+
+    return status
+
+
+def artifact_sources(submission):
+    """The folder of the unzipped submission in its artifact"""
+
+    return os.path.join(artifact_folder(submission), ARTIFACT_SOURCE_FOLDER)
+
+
+def _script_path(script):
+    """Return the path of a script as the shell finds it, or None"""
+
+    if os.sep in script:
+        if os.path.exists(script):
+            return script
+        return None
+
+    for folder in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(folder, script)
+        if os.path.isfile(path):
+            return path
+
+    return None
+
+
+def _environment_digest(build_script):
+    """Return the md5 (hex) of the build environment of a cached kernel.
+
+    The digest covers the build script, the compiler version, the kernel
+    .config, a manifest (paths, sizes and dates) of the pristine kernel
+    tree and the grader's kernel modifications, so that the kernels cached
+    before any of them changed are not used. It is computed once per process.
+    """
+
+    if _environment_digests.has_key(build_script):
+        return _environment_digests[build_script]
+
+    m = md5.new()
+
+    script_path = _script_path(build_script)
+    if script_path:
+        m.update('script\0%s\0' % file_hash(script_path))
+
+    f = os.popen('gcc --version 2>&1', 'r')
+    m.update('gcc\0%s\0' % f.read())
+    f.close()
+
+    config_path = os.path.join(CUSTOM_KERNEL_BAKCUP_PATH, '.config')
+    if os.path.exists(config_path):
+        m.update('config\0%s\0' % file_hash(config_path))
+
+    file_list = list_files(CUSTOM_KERNEL_BAKCUP_PATH)
+    file_list.sort()
+    for rel_path in file_list:
+        st = os.lstat(os.path.join(CUSTOM_KERNEL_BAKCUP_PATH, rel_path))
+        m.update('%s\0%d\0%d\0' % (rel_path, st.st_size, int(st.st_mtime)))
+
+    modifications_path = os.path.join(BASE_INSTALL_PATH, KERNEL_MODIFICATIONS_FOLDER)
+    if os.path.exists(modifications_path):
+        m.update('modifications\0%s\0' % source_hash(modifications_path))
+
+    _environment_digests[build_script] = m.hexdigest()
+
+    return _environment_digests[build_script]
+
+
+def _kernel_cache_folder(digest, build_script):
+    """The cache folder of the kernel built from sources with the given hash"""
+
+    return os.path.join(KERNEL_CACHE_PATH, '%s-%s-%s' % \
+                        (os.path.basename(build_script), _environment_digest(build_script), digest))
+
+
+def _cache_artifact(dest_folder, digest, build_script):
+    """Keep the built files of an artifact in the kernel cache"""
+
+    cache_folder = _kernel_cache_folder(digest, build_script)
+    if os.path.exists(cache_folder):
+        return
+
+    #
+    # Copy to a temporary folder first so that a cut copy is never used.
+    #
+    tmp_folder = '%s.%d' % (cache_folder, os.getpid())
+    try:
+        os.makedirs(tmp_folder)
+        for name in os.listdir(dest_folder):
+            if name in (ARTIFACT_SOURCE_FOLDER, ARTIFACT_STATUS_NAME, ARTIFACT_LOG_NAME):
+                continue
+            path = os.path.join(dest_folder, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(tmp_folder, name), symlinks=True)
+            else:
+                shutil.copy2(path, tmp_folder)
+        os.rename(tmp_folder, cache_folder)
+    except (IOError, OSError):
+        #
+        # The cache is only an optimization (another worker might have
+        # cached the same sources).
+        #
+        traceback.print_exc()
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+
+def cache_built_kernel(source_folder, changed_headers, kernel_path=CUSTOM_KERNEL_PATH, build_script=BUILD_KERNEL_SCRIPT):
+    """Keep the kernel that the boot loop built (and installed) in the kernel cache.
+
+    The kernel is stored like an artifact of build_script: the image,
+    System.map and the installed modules (built from the submission's
+    headers, or the reference modules when no header changed).
+    """
+
+    digest = source_hash(source_folder)
+    if os.path.exists(_kernel_cache_folder(digest, build_script)):
+        return
+
+    stage_folder = os.path.join(TEMP_FILES_FOLDER, 'kernel_cache_stage.%d' % os.getpid())
+    try:
+        shutil.rmtree(stage_folder, ignore_errors=True)
+        os.makedirs(os.path.join(stage_folder, 'lib', 'modules'))
+        shutil.copy2(os.path.join(kernel_path, 'arch', 'i386', 'boot', 'bzImage'), stage_folder)
+        shutil.copy2(os.path.join(kernel_path, 'System.map'), stage_folder)
+        shutil.copytree(os.path.join('/lib/modules', CUSTOM_KERNEL_VERSION),
+                        os.path.join(stage_folder, 'lib', 'modules', CUSTOM_KERNEL_VERSION), symlinks=True)
+
+        f = open(os.path.join(stage_folder, ARTIFACT_HEADERS_NAME), 'wb')
+        f.write('%d\n' % changed_headers)
+        f.close()
+
+        _cache_artifact(stage_folder, digest, build_script)
+    except (IOError, OSError):
+        #
+        # The cache is only an optimization.
+        #
+        traceback.print_exc()
+    shutil.rmtree(stage_folder, ignore_errors=True)
+
+
+def _restore_artifact(dest_folder, digest, build_script):
+    """Copy the cached kernel of identical sources to an artifact. Returns False if not cached."""
+
+    cache_folder = _kernel_cache_folder(digest, build_script)
+    if not os.path.exists(cache_folder):
+        return False
+
+    for name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, name)
+        if os.path.isdir(path):
+            shutil.copytree(path, os.path.join(dest_folder, name), symlinks=True)
+        else:
+            shutil.copy2(path, dest_folder)
+
+    return True
+
+
+def _write_artifact_status(dest_folder, status):
+    """Write the status atomically so that a half built artifact is never used"""
+
+    status_path = os.path.join(dest_folder, ARTIFACT_STATUS_NAME)
+    f = open(status_path + '.tmp', 'wb')
+    f.write('%d\n' % status)
+    f.close()
+    os.rename(status_path + '.tmp', status_path)
+
+
+def artifact_from_cache(submission, source_folder, build_script=BUILD_KERNEL_SCRIPT):
+    """Create the artifact of an unzipped submission from the kernel cache.
+
+    Returns True if a kernel built from identical sources was found.
+    """
+
+    dest_folder = artifact_folder(submission)
+    if os.path.exists(dest_folder):
+        shutil.rmtree(dest_folder)
+    os.makedirs(dest_folder)
+
+    if not _restore_artifact(dest_folder, source_hash(source_folder), build_script):
+        shutil.rmtree(dest_folder, ignore_errors=True)
+        return False
+
+    shutil.copytree(source_folder, os.path.join(dest_folder, ARTIFACT_SOURCE_FOLDER))
+    _write_artifact_status(dest_folder, 0)
+
+    return True
+
+
+def _snapshot_copy(rel_path):
+    """Check whether a file should be copied (and not linked) in a snapshot"""
+
+    name = os.path.basename(rel_path)
+    for pattern in SNAPSHOT_COPY_PATTERNS:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern):
+            return True
+
+    return False
+
+
+def snapshot_tree(src, dst):
+    """Create dst as a snapshot of the tree src.
+
+    When the filesystem supports reflinks the snapshot is a copy on write
+    clone. Otherwise the files of the snapshot are hardlinks to the files
+    of src except for build outputs (see SNAPSHOT_COPY_PATTERNS). Files
+    that are later copied over the snapshot should be removed first
+    (e.g. cp --remove-destination) so that src is not modified.
+    """
+
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+
+    if not os.system('cp -a --reflink=always %s %s > /dev/null 2>&1' % (src, dst)):
+        return
+
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+
+    def func(arg, dirname, fnames):
+        rel_dir = dirname[len(src):].lstrip(os.sep)
+        dst_dir = os.path.join(dst, rel_dir)
+        os.mkdir(dst_dir)
+        shutil.copystat(dirname, dst_dir)
+
+        for name in fnames:
+            src_path = os.path.join(dirname, name)
+            dst_path = os.path.join(dst_dir, name)
+            rel_path = os.path.join(rel_dir, name)
+
+            if os.path.islink(src_path):
+                os.symlink(os.readlink(src_path), dst_path)
+            elif os.path.isdir(src_path):
+                continue
+            elif _snapshot_copy(rel_path):
+                shutil.copy2(src_path, dst_path)
+            else:
+                os.link(src_path, dst_path)
+
+    os.path.walk(src, func, None)
+
+
+def list_files(folder):
+    """Return the paths (relative to folder) of all the files under folder"""
+
+    def func(arg, dirname, fnames):
+        rel_dir = dirname[len(folder):].lstrip(os.sep)
+        for name in fnames:
+            if not os.path.isdir(os.path.join(dirname, name)):
+                arg.append(os.path.join(rel_dir, name))
+
+    file_list = []
+    os.path.walk(folder, func, file_list)
+
+    return file_list
+
+
+def build_reference_tree():
+    """Build the custom kernel (with the grader modifications) once.
+
+    The reference tree is the starting point of all the submission builds
+    so that make only rebuilds the objects that depend on the submitted files.
+    """
+
+    start_time = time.time()
+
+    snapshot_tree(CUSTOM_KERNEL_BAKCUP_PATH, CUSTOM_KERNEL_REFERENCE_PATH)
+
+    #
+    # Copy custom modificaions of the grader (memory tracking)
+    #
+    os.system('cp -rf --remove-destination %s %s' % (os.path.join(BASE_INSTALL_PATH, KERNEL_MODIFICATIONS_FOLDER, '*'), CUSTOM_KERNEL_REFERENCE_PATH))
+
+    print 'Building the reference kernel'
+    log_path = os.path.join(TEMP_FILES_FOLDER, REFERENCE_LOG_NAME)
+    status = os.system(
+        'cd %s && export HWGRADER_CC_BASEDIR=`pwd` && (make CC="%s gcc" bzImage && make CC="%s gcc" modules) > %s 2>&1' % \
+        (CUSTOM_KERNEL_REFERENCE_PATH, CACHE_CC_SCRIPT, CACHE_CC_SCRIPT, log_path)
+        )
+    if status:
+        raise Exception('Failed building the reference kernel, exit with status: %d (see %s)' % (status/256, log_path))
+
+    record_phase('reference_build', start_time)
+
+
+def revert_kernel_tree(kernel_path):
+    """Revert the files copied by the previous submission to their reference version.
+
+    The reverted files are copied (not linked) so that they get a new
+    modification time and make rebuilds the objects that depend on them.
+    """
+
+    manifest_path = os.path.join(kernel_path, KERNEL_MANIFEST_NAME)
+
+    f = open(manifest_path, 'rb')
+    rel_paths = [line.strip() for line in f.readlines() if line.strip()]
+    f.close()
+
+    for rel_path in rel_paths:
+        ref_path = os.path.join(CUSTOM_KERNEL_REFERENCE_PATH, rel_path)
+        dst_path = os.path.join(kernel_path, rel_path)
+
+        if os.path.exists(dst_path) or os.path.islink(dst_path):
+            os.remove(dst_path)
+        if os.path.exists(ref_path):
+            shutil.copy(ref_path, dst_path)
+
+
+def prepare_kernel_tree(kernel_path, submission_folder):
+    """Prepare a kernel tree for building a submission.
+
+    When a reference kernel was built, a tree that was already used is
+    reverted incrementally using its manifest (the list of files copied
+    by the previous submission), otherwise it is snapshoted from the
+    reference. Without a reference the tree is a fresh copy of the custom
+    kernel including the grader modifications.
+    The files of the submission are recorded in the manifest of the tree.
+    """
+
+    start_time = time.time()
+
+    if not os.path.exists(CUSTOM_KERNEL_REFERENCE_PATH):
+        snapshot_tree(CUSTOM_KERNEL_BAKCUP_PATH, kernel_path)
+
+        #
+        # Copy custom modificaions of the grader (memory tracking)
+        #
+        os.system('cp -rf --remove-destination %s %s' % (os.path.join(BASE_INSTALL_PATH, KERNEL_MODIFICATIONS_FOLDER, '*'), kernel_path))
+        record_phase('tree_restore', start_time)
+        return
+
+    if os.path.exists(os.path.join(kernel_path, KERNEL_MANIFEST_NAME)):
+        revert_kernel_tree(kernel_path)
+    else:
+        snapshot_tree(CUSTOM_KERNEL_REFERENCE_PATH, kernel_path)
+
+    #
+    # Write the manifest before the files are copied so that an interrupted
+    # build is still reverted.
+    #
+    manifest_path = os.path.join(kernel_path, KERNEL_MANIFEST_NAME)
+    f = open(manifest_path + '.tmp', 'wb')
+    f.write(''.join([rel_path + '\n' for rel_path in list_files(submission_folder)]))
+    f.close()
+    os.rename(manifest_path + '.tmp', manifest_path)
+
+    record_phase('tree_restore', start_time)
+
+
+def headers_changed(submission_folder):
+    """Check whether a submission changes (or adds) a header file under include/"""
+
+    if os.path.exists(CUSTOM_KERNEL_REFERENCE_PATH):
+        pristine_path = CUSTOM_KERNEL_REFERENCE_PATH
+    else:
+        pristine_path = CUSTOM_KERNEL_BAKCUP_PATH
+
+    for rel_path in list_files(submission_folder):
+        if rel_path.split(os.sep)[0] != 'include':
+            continue
+
+        pristine_file = os.path.join(pristine_path, rel_path)
+        if not os.path.exists(pristine_file):
+            return True
+        if not filecmp.cmp(pristine_file, os.path.join(submission_folder, rel_path), 0):
+            return True
+
+    return False
+
+
+def installed_modules():
+    """Return the state of the installed modules"""
+
+    if not os.path.exists(INSTALLED_MODULES_PATH):
+        return MODULES_UNKNOWN
+
+    f = open(INSTALLED_MODULES_PATH, 'rb')
+    state = f.read().strip()
+    f.close()
+
+    return state
+
+
+def set_installed_modules(state):
+    """Record the state of the installed modules"""
+
+    f = open(INSTALLED_MODULES_PATH, 'wb')
+    f.write('%s\n' % state)
+    f.close()
+
+
+def choose_build_recipe(changed_headers):
+    """Choose the cheapest build recipe for a submission.
+
+    The modules (and the initrd) need to be rebuilt only when the submission
+    changes a header file, or when the installed modules were built with
+    headers of a previous submission.
+    Returns the recipe and the reason for choosing it.
+    """
+
+    if changed_headers:
+        return BUILD_RECIPE_FULL, 'header files changed'
+
+    if installed_modules() != MODULES_REFERENCE:
+        return BUILD_RECIPE_FULL, 'the installed modules are not the reference modules'
+
+    return BUILD_RECIPE_NO_MODULES, 'no header file changed'
+
+
+def log_recipe_time(kind, recipe, duration, f_results):
+    """Log the time of a build/install recipe and its savings compared to the full recipe"""
+
+    f = open(BUILD_TIMES_PATH, 'ab')
+    f.write('%s\t%s\t%.3f\n' % (kind, recipe, duration))
+    f.close()
+
+    f = open(BUILD_TIMES_PATH, 'rb')
+    full_time = 0
+    full_num = 0
+    for line in f.readlines():
+        temp = line.split('\t')
+        if len(temp) == 3 and temp[0] == kind and temp[1] == BUILD_RECIPE_FULL:
+            full_time += float(temp[2])
+            full_num += 1
+    f.close()
+
+    f_results.write('The %s (recipe %s) took %.1f seconds' % (kind, recipe, duration))
+    if recipe != BUILD_RECIPE_FULL and full_num:
+        full_time = full_time / full_num
+        f_results.write(', saved about %.1f seconds compared to the full recipe' % (full_time - duration))
+    f_results.write('\n')
+
+
+def build_artifact(submission, kernel_path, build_script=BUILD_KERNEL_SCRIPT):
+    """Build the kernel of a submission in kernel_path.
+
+    The kernel image (bzImage, or linux for User-Mode Linux), System.map,
+    modules and the unzipped submission are stored in the artifact folder
+    of the submission. The exit status of the build is
+    written last, so an artifact with a status file is complete.
+    A kernel that was built before from identical sources is taken from
+    the kernel cache.
+    """
+
+    set_metrics_submission(submission)
+    start_time = time.time()
+
+    dest_folder = artifact_folder(submission)
+    if os.path.exists(dest_folder):
+        shutil.rmtree(dest_folder)
+    os.makedirs(dest_folder)
+
+    source_folder = os.path.join(dest_folder, ARTIFACT_SOURCE_FOLDER)
+    log_path = os.path.join(dest_folder, ARTIFACT_LOG_NAME)
+    f_log = open(log_path, 'ab', buffering=0)
+
+    #
+    # Failures before the build script are reported like a failed copy (exit 1).
+    #
+    status = 256
+    try:
+        unzip_submission(os.path.dirname(submission), source_folder, submission, f_log)
+
+        if os.path.exists(os.path.join(source_folder, 'Makefile')):
+            #
+            # Sometimes the students leave a Makefile in the main
+            # submission folder.
+            #
+            os.remove(os.path.join(source_folder, 'Makefile'))
+
+        digest = source_hash(source_folder)
+        if _restore_artifact(dest_folder, digest, build_script):
+            f_log.write('Reusing the kernel built from identical sources\n')
+            status = 0
+        else:
+            prepare_kernel_tree(kernel_path, source_folder)
+
+            #
+            # The modules are always built (make only rebuilds what changed),
+            # the installation of an artifact decides whether to install them.
+            #
+            f = open(os.path.join(dest_folder, ARTIFACT_HEADERS_NAME), 'wb')
+            f.write('%d\n' % headers_changed(source_folder))
+            f.close()
+
+            status = os.system('%s %s %s %s >> %s 2>&1' % (build_script, source_folder, kernel_path, dest_folder, log_path))
+            if not status:
+                _cache_artifact(dest_folder, digest, build_script)
+    except:
+        traceback.print_exc(file=f_log)
+
+    f_log.close()
+
+    _write_artifact_status(dest_folder, status)
+
+    record_phase('build', start_time)
+
+    return status
+
+
+def _redirect_output(log_path):
+    """Redirect the stdout/stderr of a worker process to a log file"""
+
+    fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(fd, sys.stdout.fileno())
+    os.dup2(fd, sys.stderr.fileno())
+    os.close(fd)
+
+
+def _build_worker(submission, slot, build_script=BUILD_KERNEL_SCRIPT):
+    """Build a submission in the kernel tree of the worker slot"""
+
+    _redirect_output(os.path.join(BUILD_TREES_FOLDER, 'worker_%d.log' % slot))
+
+    kernel_path = os.path.join(BUILD_TREES_FOLDER, 'slot_%d' % slot)
+
+    return build_artifact(submission, kernel_path, build_script)
+
+
+def prebuild_submissions(submissions, workers=None, build_script=BUILD_KERNEL_SCRIPT):
+    """Build the kernels of all submissions in parallel.
+
+    Each worker builds in its own copy of the custom kernel. The boot loop
+    then only needs to install the ready artifacts.
+    Returns a dict that maps each submission to its build exit status.
+    """
+
+    if not workers:
+        workers = cpu_count()
+
+    if not os.path.exists(BUILD_TREES_FOLDER):
+        os.makedirs(BUILD_TREES_FOLDER)
+
+    print 'Building %d submissions using %d workers' % (len(submissions), workers)
+    def func(submission, slot):
+        return _build_worker(submission, slot, build_script)
+
+    statuses = run_pool(submissions, func, workers)
+
+    #
+    # Remove the kernel trees of the workers (the logs are kept).
+    #
+    for slot in range(workers):
+        kernel_path = os.path.join(BUILD_TREES_FOLDER, 'slot_%d' % slot)
+        if os.path.exists(kernel_path):
+            shutil.rmtree(kernel_path, ignore_errors=True)
+
+    failed = [submission for submission in submissions if statuses.get(submission)]
+    print 'Finished building, %d of %d failed' % (len(failed), len(submissions))
+
+    return statuses
+
+
+def start_background_build(submission, nice=19):
+    """Build a submission in a background process with the given nice level.
+
+    The build uses its own kernel tree so it doesn't touch the installed
+    kernel. The process is put in its own process group so that its whole
+    build (make, gcc etc.) can be reniced later. Returns the pid of the
+    builder.
+    """
+
+    if not os.path.exists(BUILD_TREES_FOLDER):
+        os.makedirs(BUILD_TREES_FOLDER)
+
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.setpgrp()
+            os.nice(nice)
+            _redirect_output(os.path.join(BUILD_TREES_FOLDER, 'pipeline.log'))
+            status = build_artifact(submission, PIPELINE_KERNEL_PATH)
+        except:
+            traceback.print_exc()
+
+        os._exit(status and 1 or 0)
+
+    return pid
+
+
+def wait_background_build(pid):
+    """Wait for a background build to end. Returns its exit status.
+
+    The builder is reniced to normal priority as there is nothing left
+    to disturb.
+    """
+
+    os.system('renice 0 -g %d > /dev/null 2>&1' % pid)
+
+    while 1:
+        try:
+            pid, status = os.waitpid(pid, 0)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+
+    return status
+
+
+def install_artifact(submission, temp_folder, f_results, write_header=True):
+    """Install a prebuilt submission kernel and copy its sources to the temp folder"""
+
+    SUBMISSION_HEADER = "\nSubmission by %s\n\n"
+
+    dest_folder = artifact_folder(submission)
+    source_folder = os.path.join(dest_folder, ARTIFACT_SOURCE_FOLDER)
+
+    if os.path.exists(temp_folder):
+        shutil.rmtree(temp_folder, ignore_errors=True)
+
+    if not os.path.exists(source_folder):
+        raise Exception('Failed unzipping the submission')
+
+    shutil.copytree(source_folder, temp_folder)
+
+    submitters = get_submitters(temp_folder)
+    if write_header:
+        f_results.write(SUBMISSION_HEADER % ' & '.join(submitters))
+
+    status = artifact_status(submission)
+    if status:
+        f_results.write("Prebuilt submission failed, see %s\n" % os.path.join(dest_folder, ARTIFACT_LOG_NAME))
+        raise Exception('Failed building the submission, exit with status: %d' % (status/256))
+
+    f = open(os.path.join(dest_folder, ARTIFACT_HEADERS_NAME), 'rb')
+    changed_headers = int(f.read().strip())
+    f.close()
+
+    recipe, reason = choose_build_recipe(changed_headers)
+    f_results.write("Installing prebuilt kernel, recipe %s (%s)\n" % (recipe, reason))
+
+    if recipe == BUILD_RECIPE_FULL:
+        set_installed_modules(MODULES_UNKNOWN)
+        
+    start_time = time.time()
+    status = os.system('%s %s %s' % (INSTALL_KERNEL_SCRIPT, dest_folder, recipe))
+    log_recipe_time('install', recipe, time.time() - start_time, f_results)
+    record_phase('install', start_time)
+    if status:
+        raise Exception('Failed installing the submission, exit with status: %d' % (status/256))
+
+    if recipe == BUILD_RECIPE_FULL:
+        if changed_headers:
+            set_installed_modules(MODULES_MODIFIED)
+        else:
+            set_installed_modules(MODULES_REFERENCE)
+
+    return submitters
@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+import fcntl
+import errno
+import shutil
+import md5
+import sys
+import os
+import re
+
+__all__ = [
+    'compile_cached',
+    'cache_stats',
+    'write_cache_stats'
+    ]
+
+CC_CACHE_STATS_NAME = 'stats'
+CC_CACHE_LOCK_NAME = 'lock'
+CC_STATS_FIELDS = ('hits', 'misses', 'uncacheable', 'size')
+
+#
+# Files that are compiled by the cache (other files are passed to the compiler).
+#
+CC_SOURCE_EXTS = ('.c',)
+
+#
+# Line markers of the preprocessor (they include the path of the tree).
+#
+LINE_MARKER_RE = re.compile(r'^# \d+ .*$', re.M)
+
+
+def _cache_path():
+    return os.environ.get(CC_CACHE_ENV, CC_CACHE_PATH)
+
+
+def _quote(arg):
+    return "'%s'" % arg.replace("'", "'\\''")
+
+
+def _lock():
+    """Lock the cache (several builds might run in parallel)"""
+
+    cache_path = _cache_path()
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+
+    f_lock = open(os.path.join(cache_path, CC_CACHE_LOCK_NAME), 'ab')
+    fcntl.flock(f_lock.fileno(), fcntl.LOCK_EX)
+
+    return f_lock
+
+
+def _unlock(f_lock):
+    fcntl.flock(f_lock.fileno(), fcntl.LOCK_UN)
+    f_lock.close()
+
+
+def cache_stats():
+    """Return a dict with the statistics of the cache"""
+
+    stats = {}
+    for field in CC_STATS_FIELDS:
+        stats[field] = 0
+
+    stats_path = os.path.join(_cache_path(), CC_CACHE_STATS_NAME)
+    if not os.path.exists(stats_path):
+        return stats
+
+    f = open(stats_path, 'rb')
+    for line in f.readlines():
+        temp = line.split()
+        if len(temp) == 2 and temp[0] in CC_STATS_FIELDS:
+            stats[temp[0]] = int(temp[1])
+    f.close()
+
+    return stats
+
+
+def _write_stats(stats):
+    """Write the cache statistics (the cache must be locked)"""
+
+    stats_path = os.path.join(_cache_path(), CC_CACHE_STATS_NAME)
+    f = open(stats_path + '.tmp', 'wb')
+    for field in CC_STATS_FIELDS:
+        f.write('%s %d\n' % (field, stats[field]))
+    f.close()
+    os.rename(stats_path + '.tmp', stats_path)
+
+
+def _update_stats(**kwds):
+    """Add the values in kwds to the cache statistics. Returns the new statistics"""
+
+    f_lock = _lock()
+    try:
+        stats = cache_stats()
+        for field, value in kwds.items():
+            stats[field] += value
+        _write_stats(stats)
+    finally:
+        _unlock(f_lock)
+
+    return stats
+
+
+def _evict(max_size):
+    """Remove the least recently used objects until the cache is below 90% of max_size.
+
+    The cache is locked so that parallel builds don't evict the same
+    objects. Objects that are being written are not .o files yet (see
+    compile_cached), objects that disappear meanwhile are ignored.
+    """
+
+    cache_path = _cache_path()
+
+    def func(arg, dirname, fnames):
+        for name in fnames:
+            if not name.endswith('.o'):
+                continue
+            path = os.path.join(dirname, name)
+            try:
+                st = os.stat(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            arg.append((st.st_mtime, st.st_size, path))
+
+    f_lock = _lock()
+    try:
+        entries = []
+        os.path.walk(cache_path, func, entries)
+        entries.sort()
+
+        size = 0
+        for mtime, entry_size, path in entries:
+            size += entry_size
+
+        #
+        # Another build might have evicted already.
+        #
+        removed = 0
+        if size > max_size:
+            for mtime, entry_size, path in entries:
+                if size - removed < 0.9 * max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                removed += entry_size
+
+        #
+        # The walk is the real size of the cache.
+        #
+        stats = cache_stats()
+        stats['size'] = size - removed
+        _write_stats(stats)
+    finally:
+        _unlock(f_lock)
+
+
+def _parse_args(args):
+    """Return the source and output of a cacheable compile command (or None)"""
+
+    if '-c' not in args:
+        return None
+
+    source = None
+    output = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg == '-o':
+            if i + 1 >= len(args):
+                return None
+            output = args[i+1]
+            i += 2
+            continue
+        if arg[:2] == '-o':
+            output = arg[2:]
+        elif arg in ('-E', '-S', '-') or arg[:2] == '-M' or arg[:6] == '-Wp,-M':
+            #
+            # Preprocessing/dependency generation is not cached.
+            #
+            return None
+        elif arg[0] != '-':
+            if os.path.splitext(arg)[1] not in CC_SOURCE_EXTS or source:
+                return None
+            source = arg
+        i += 1
+
+    if not source:
+        return None
+
+    if not output:
+        output = os.path.splitext(os.path.basename(source))[0] + '.o'
+
+    return source, output
+
+
+def _hash_key(compiler, args, source, output):
+    """Calculate the cache key of a compile command.
+
+    The key is based on the compiler version, the flags and the preprocessed
+    source. The path of the kernel tree (HWGRADER_CC_BASEDIR) is removed so
+    that identical sources in different trees share the cache.
+    """
+
+    base_dir = os.environ.get('HWGRADER_CC_BASEDIR', '').rstrip(os.sep)
+
+    flags = [arg for arg in args if arg not in ('-c', '-o', output, '-o' + output, source)]
+    cmd = ' '.join([_quote(arg) for arg in [compiler] + flags + ['-E', source]])
+
+    f = os.popen(cmd, 'r')
+    preprocessed = f.read()
+    if f.close():
+        return None
+
+    version = os.popen('%s -dumpversion' % _quote(compiler), 'r').read()
+
+    flags_str = ' '.join(flags)
+    preprocessed = LINE_MARKER_RE.sub('', preprocessed)
+    if base_dir:
+        flags_str = flags_str.replace(base_dir, '.')
+        preprocessed = preprocessed.replace(base_dir, '.')
+
+    m = md5.new()
+    m.update(version)
+    m.update('\0')
+    m.update(flags_str)
+    m.update('\0')
+    m.update(preprocessed)
+
+    return m.hexdigest()
+
+
+def compile_cached(argv, max_size=CC_CACHE_MAX_SIZE):
+    """Run the compile command argv (compiler followed by arguments) through the cache.
+
+    Returns the exit status of the compiler.
+    """
+
+    compiler = argv[0]
+    args = list(argv[1:])
+
+    parsed = _parse_args(args)
+    key = None
+    if parsed:
+        source, output = parsed
+        key = _hash_key(compiler, args, source, output)
+
+    if not key:
+        _update_stats(uncacheable=1)
+        return os.spawnvp(os.P_WAIT, compiler, argv)
+
+    cached_path = os.path.join(_cache_path(), key[:2], key + '.o')
+
+    if os.path.exists(cached_path):
+        #
+        # Hit, copy the object and mark it as recently used.
+        #
+        try:
+            shutil.copyfile(cached_path, output + '.tmp')
+            os.rename(output + '.tmp', output)
+            os.utime(cached_path, None)
+            _update_stats(hits=1)
+            return 0
+        except (IOError, OSError):
+            #
+            # The object was probably evicted by a parallel build.
+            #
+            pass
+
+    status = os.spawnvp(os.P_WAIT, compiler, argv)
+    if status:
+        return status
+
+    _update_stats(misses=1)
+
+    try:
+        if not os.path.exists(os.path.dirname(cached_path)):
+            os.makedirs(os.path.dirname(cached_path))
+        temp_path = '%s.%d.tmp' % (cached_path, os.getpid())
+        shutil.copyfile(output, temp_path)
+        os.rename(temp_path, cached_path)
+        size = os.path.getsize(cached_path)
+    except (IOError, OSError):
+        return 0
+
+    stats = _update_stats(size=size)
+    if stats['size'] > max_size:
+        _evict(max_size)
+
+    return 0
+
+
+def write_cache_stats(path):
+    """Write the statistics of the cache to a file"""
+
+    stats = cache_stats()
+    compiled = stats['hits'] + stats['misses']
+    hit_rate = 0
+    if compiled:
+        hit_rate = 100 * stats['hits'] / compiled
+
+    f = open(path, 'wb')
+    f.write('hits\t%d\n' % stats['hits'])
+    f.write('misses\t%d\n' % stats['misses'])
+    f.write('uncacheable\t%d\n' % stats['uncacheable'])
+    f.write('hit rate\t%.1f%%\n' % hit_rate)
+    f.write('size\t%.1fMB\n' % (stats['size'] / (1024*1024)))
+    f.close()
@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+from index_utils import file_hash
+from utils import TestRecord
+import inspect
+import marshal
+import types
+import md5
+import os
+
+__all__ = [
+    'test_fingerprint',
+    'suite_fingerprints',
+    'index_tests',
+    'previous_outcomes',
+    'seed_test_status'
+    ]
+
+#
+# The results of the tests are kept in the results folder. Each line:
+# zip hash <tab> test id <tab> test fingerprint <tab> success|failure
+#
+TEST_INDEX_NAME = 'test_index.txt'
+
+#
+# Message of a failure that is taken from a previous grading.
+#
+PREVIOUS_FAILURE_MSG = 'Failed when graded before (the test did not change since)'
+
+
+def _code_names(code):
+    """The global and attribute names used by a code object and its nested functions"""
+
+    names = list(code.co_names)
+    for const in code.co_consts:
+        if type(const) is types.CodeType:
+            names += _code_names(const)
+
+    return names
+
+
+def _simple_value(value):
+    """Is the value a constant that can be fingerprinted by its repr"""
+
+    if value is None or isinstance(value, (int, long, float, str, unicode)):
+        return True
+
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            if not _simple_value(item):
+                return False
+        return True
+
+    return False
+
+
+def _source(obj):
+    try:
+        return inspect.getsource(obj)
+    except (IOError, TypeError):
+        if type(obj) is types.FunctionType:
+            return marshal.dumps(obj.func_code)
+        return obj.__name__
+
+
+def _update_function(m, func, cls, module_globals, visited):
+    """Add a function and the helpers, class attributes and globals it uses to the md5"""
+
+    if visited.has_key(id(func)):
+        return
+    visited[id(func)] = 1
+
+    m.update(_source(func))
+
+    for name in _code_names(func.func_code):
+        if hasattr(cls, name):
+            value = getattr(cls, name)
+        elif module_globals.has_key(name):
+            value = module_globals[name]
+        else:
+            continue
+
+        if type(value) is types.MethodType:
+            value = value.im_func
+
+        if type(value) is types.FunctionType:
+            #
+            # Only the helpers of the test module, the grader and the
+            # standard library are not part of the test.
+            #
+            if value.func_globals is module_globals:
+                m.update('\0%s\0' % name)
+                _update_function(m, value, cls, module_globals, visited)
+        elif type(value) in (types.ClassType, types.TypeType):
+            if value.__module__ == module_globals.get('__name__') and not visited.has_key(id(value)):
+                visited[id(value)] = 1
+                m.update('\0%s\0%s' % (name, _source(value)))
+        elif _simple_value(value):
+            m.update('\0%s=%r' % (name, value))
+
+
+def test_fingerprint(test):
+    """Return the md5 (hex) of the code that a test case runs.
+
+    Covers the source of the test method, setUp and tearDown, the helpers
+    and classes of the test module that they use and the constant values
+    of the module globals and class attributes that they use. Code of
+    modules other than the test module (e.g. a compiled extension) is not
+    covered.
+    """
+
+    cls = test.__class__
+    module_globals = getattr(test, test.id().split('.')[-1]).im_func.func_globals
+
+    m = md5.new()
+    visited = {}
+    for name in (test.id().split('.')[-1], 'setUp', 'tearDown'):
+        func = getattr(cls, name).im_func
+        if func.func_globals is module_globals:
+            m.update('\0%s\0' % name)
+            _update_function(m, func, cls, module_globals, visited)
+
+    return m.hexdigest()
+
+
+def _suite_tests(suite):
+    """The test cases of a (possibly nested) test suite"""
+
+    if not hasattr(suite, '_tests'):
+        return [suite]
+
+    tests = []
+    for test in suite._tests:
+        tests += _suite_tests(test)
+
+    return tests
+
+
+def suite_fingerprints(suite):
+    """Return a dict that maps the id of each test of the suite to its fingerprint"""
+
+    fingerprints = {}
+    for test in _suite_tests(suite):
+        fingerprints[test.id()] = test_fingerprint(test)
+
+    return fingerprints
+
+
+def index_tests(submission, fingerprints, test_status, results_folder):
+    """Record the outcomes of the tests of a submission with their fingerprints"""
+
+    zip_digest = file_hash(submission)
+    successes = test_status.get_successes()
+
+    lines = []
+    for test_id in test_status.get_tests_ids():
+        if not fingerprints.has_key(test_id):
+            continue
+        if test_id in successes:
+            outcome = 'success'
+        else:
+            outcome = 'failure'
+        lines.append('%s\t%s\t%s\t%s\n' % (zip_digest, test_id, fingerprints[test_id], outcome))
+
+    f = open(os.path.join(results_folder, TEST_INDEX_NAME), 'ab')
+    f.write(''.join(lines))
+    f.close()
+
+
+def previous_outcomes(submission, fingerprints, results_folder):
+    """Return the outcomes of the tests that were run before on this submission zip
+    and did not change since (by their fingerprints). Maps test id to True on success.
+    """
+
+    index_path = os.path.join(results_folder, TEST_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {}
+
+    zip_digest = file_hash(submission)
+
+    outcomes = {}
+    f = open(index_path, 'rb')
+    for line in f.readlines():
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 4 or fields[0] != zip_digest:
+            continue
+
+        test_id, fingerprint, outcome = fields[1:]
+        if fingerprints.get(test_id) == fingerprint:
+            outcomes[test_id] = outcome == 'success'
+        elif outcomes.has_key(test_id):
+            #
+            # A later grading with another version of the test.
+            #
+            del outcomes[test_id]
+    f.close()
+
+    return outcomes
+
+
+def seed_test_status(test_status, suite, outcomes):
+    """Add the previous outcomes of unchanged tests to a new test status.
+
+    A RebootableTestSuite skips the tests that are already in the status,
+    so only the changed (and new) tests are run.
+    """
+
+    for test in _suite_tests(suite):
+        if not outcomes.has_key(test.id()):
+            continue
+
+        test_status.addTest(test)
+        if outcomes[test.id()]:
+            test_status.addEvent('successes', test.id())
+        else:
+            test_status.addEvent('failures', TestRecord(test, TestRecord.FAILURE, PREVIOUS_FAILURE_MSG))
@@ -7,6 +7,11 @@ MMLOG_FILES_FOLDER = 'mmlog_files'
 KERNEL_MODIFICATIONS_FOLDER = 'kernel_modifications'
 BUILD_SCRIPT = 'build_submission.sh'
 BUILD_NM_SCRIPT = 'build_submission_no_modules.sh'
+BUILD_KERNEL_SCRIPT = 'build_kernel.sh'
+INSTALL_KERNEL_SCRIPT = 'install_kernel.sh'
+CACHE_CC_SCRIPT = 'cache_cc.py'
+PHASE_SCRIPT = 'grader_phase.sh'
+BUILD_UML_SCRIPT = 'build_uml.sh'
 AUTOLOGIN_FILES_FOLDER = 'autologin_files'
 BASE_INSTALL_PATH = '/etc/hwgrader'
 BASH_PROFILE_PATH = os.path.expanduser('~/.bash_profile')
@@ -16,8 +21,10 @@ SYSCTL_PATH = os.path.expanduser('/etc/sysctl.conf')
 SYSCTL_BAKCUP_PATH = os.path.join(TEMP_FILES_FOLDER, 'sysctl.conf')
 KERNEL_PANIC_STR = 'kernel.panic'
 KERNEL_PANIC_TIMEOUT = 10
-SUBMISSION_STATE_PATH = os.path.join(TEMP_FILES_FOLDER, 'sub_state.pkl')
+FAST_PANIC_TIMEOUT = 1
+STATE_STORE_FOLDER = os.path.join(TEMP_FILES_FOLDER, 'state')
 GRUB_PATH = '/boot/grub/grub.conf'
+KEXEC_PATH = '/sbin/kexec'
 TEST_STATUS_PATH = os.path.join(TEMP_FILES_FOLDER, 'test_status.pkl')
 GRADER_CONFIG_PATH = os.path.join(TEMP_FILES_FOLDER, 'config_grader')
 INITTAB_TEMPLATE = 'BIN_PATH'
@@ -26,14 +33,76 @@ DEFAULT_TESTS_FOLDER = os.path.expanduser('~/tests')
 DEFAULT_TEST_NAME = 'hw_test.py'
 CUSTOM_KERNEL_PATH = '/usr/src/linux-2.4.18-14custom'
 CUSTOM_KERNEL_BAKCUP_PATH = os.path.join(TEMP_FILES_FOLDER, os.path.split(CUSTOM_KERNEL_PATH)[-1])
+CUSTOM_KERNEL_REFERENCE_PATH = os.path.join(TEMP_FILES_FOLDER, os.path.split(CUSTOM_KERNEL_PATH)[-1] + '-reference')
+CUSTOM_KERNEL_VERSION = '2.4.18-14custom'
+ARTIFACTS_FOLDER = os.path.join(TEMP_FILES_FOLDER, 'artifacts')
+EXTRACTED_FOLDER = os.path.join(TEMP_FILES_FOLDER, 'extracted')
+BUILD_TREES_FOLDER = os.path.join(TEMP_FILES_FOLDER, 'build_trees')
+PIPELINE_KERNEL_PATH = os.path.join(BUILD_TREES_FOLDER, 'pipeline')
+INSTALLED_MODULES_PATH = os.path.join(TEMP_FILES_FOLDER, 'installed_modules')
+KERNEL_LOG_PATH = os.path.join(TEMP_FILES_FOLDER, 'kernel_log.txt')
+ABORT_SENTINEL_PATH = os.path.join(TEMP_FILES_FOLDER, 'abort')
+GRADER_PID_PATH = os.path.join(TEMP_FILES_FOLDER, 'grader.pid')
+REBOOT_MARK_PATH = os.path.join(TEMP_FILES_FOLDER, 'reboot_time')
+BUILD_TIMES_PATH = os.path.join(TEMP_FILES_FOLDER, 'build_times.txt')
 WD_FILES_FOLDER = 'wd_files'
 MAKE_FILE = 'Makefile'
 
+#
+# Compiler cache (see cache_cc.py). The cache is kept between grader runs
+# and the least recently used objects are removed above CC_CACHE_MAX_SIZE.
+#
+CC_CACHE_PATH = os.path.expanduser('~/.hwgrader_cc_cache')
+METRICS_ENV = 'HWGRADER_METRICS'
+METRICS_SUBMISSION_ENV = 'HWGRADER_SUBMISSION'
+CC_CACHE_ENV = 'HWGRADER_CC_CACHE'
+CC_CACHE_MAX_SIZE = 1024*1024*1024
+
+#
+# Kernels built from identical sources are reused between grader runs
+# (see build_utils.artifact_from_cache). The folder can be removed at any time.
+#
+KERNEL_CACHE_PATH = os.path.expanduser('~/.hwgrader_kernel_cache')
+
+#
+# Shared runs (see lease_utils.py). A lease must outlive a reboot of the
+# worker that holds it.
+#
+LEASE_TIMEOUT = 900
+LEASE_HEARTBEAT = 60
+LEASE_POLL = 30
+RESULTS_LEASE_TIMEOUT = 120
+
+#
+# Virtual machine grading globals. The guest image should have the
+# hwgrader package installed and run guest_grader.py on (auto)login.
+#
+VM_JOBS_FOLDER = os.path.join(TEMP_FILES_FOLDER, 'vm_jobs')
+VM_JOB_ARG = 'hwgrader_job'
+VM_JOB_DEVICE = '/dev/hdb1'
+VM_JOB_MOUNT = '/mnt/hwgrader_job'
+VM_RESULTS_DEVICE = '/dev/ttyS1'
+VM_GUEST_FOLDER = os.path.expanduser('~/hwgrader_job')
+VM_KERNEL_ARGS = 'root=/dev/hda1 console=ttyS0'
+VM_MEMORY = 128
+VM_TIMEOUT = 30*60
+VM_MAX_RESTARTS = 5
+QEMU_PATH = 'qemu'
+QEMU_IMG_PATH = 'qemu-img'
+UML_HOSTFS_ARG = 'hwgrader_hostfs'
+VM_SNAPSHOT_PATH = os.path.join(TEMP_FILES_FOLDER, 'vm_snapshot.qcow2')
+GUEST_GRADER_SCRIPT = 'guest_grader.py'
+
 #
 # Tests timeout after TEST_TIMEOUT seconds
 #
 TEST_TIMEOUT = 60
 
+#
+# Tests that are marked as concurrent run up to CONCURRENT_TESTS at once
+#
+CONCURRENT_TESTS = 4
+
 #
 # Memory log utility globals
 #
@@ -0,0 +1,159 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+import time
+import os
+import re
+
+__all__ = [
+    'kernel_state',
+    'check_kernel_health'
+    ]
+
+#
+# Taint flags that are expected after loading a submission module:
+# 1 - a module without a GPL license, 2 - a module loaded with insmod -f.
+#
+HEALTH_TAINT_IGNORE = 1 | 2
+
+#
+# Kernel log lines that indicate that the kernel is damaged.
+#
+KERNEL_OOPS_RE = re.compile(r'Oops|Unable to handle kernel|kernel BUG|general protection fault|Kernel panic')
+
+#
+# Delay between the two samples of stuck processes.
+#
+STUCK_PROCESS_DELAY = 2
+
+
+def _loaded_modules():
+    f = open('/proc/modules', 'rb')
+    modules = [line.split()[0] for line in f.readlines() if line.strip()]
+    f.close()
+
+    return modules
+
+
+def _device_nodes():
+    nodes = []
+    for name in os.listdir('/dev'):
+        path = os.path.join('/dev', name)
+        if not os.path.isdir(path):
+            nodes.append(path)
+
+    return nodes
+
+
+def _tainted():
+    if not os.path.exists('/proc/sys/kernel/tainted'):
+        return 0
+
+    f = open('/proc/sys/kernel/tainted', 'rb')
+    tainted = int(f.read().strip())
+    f.close()
+
+    return tainted
+
+
+def _read_kernel_log():
+    """Read and clear the kernel log, the text is kept in KERNEL_LOG_PATH"""
+
+    f = os.popen('dmesg -c', 'r')
+    text = f.read()
+    f.close()
+
+    f = open(KERNEL_LOG_PATH, 'ab')
+    f.write(text)
+    f.close()
+
+    return text
+
+
+def _stuck_processes():
+    """Return the pids of the processes in uninterruptible sleep (state D)"""
+
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            f = open(os.path.join('/proc', name, 'stat'), 'rb')
+            stat = f.read()
+            f.close()
+        except IOError:
+            #
+            # The process ended.
+            #
+            continue
+
+        #
+        # The state follows the command name (which is in parentheses).
+        #
+        if stat[stat.rfind(')')+2:].split()[0] == 'D':
+            pids.append(int(name))
+
+    return pids
+
+
+def kernel_state():
+    """Record the state of the kernel before testing a submission.
+
+    The kernel log is cleared so that only messages of the submission
+    are checked later.
+    """
+
+    _read_kernel_log()
+
+    return {
+        'modules': _loaded_modules(),
+        'nodes': _device_nodes(),
+        'tainted': _tainted()
+        }
+
+
+def check_kernel_health(state):
+    """Check whether the kernel can be used for the next submission.
+
+    state is the result of kernel_state() taken before the submission.
+    Modules and device nodes that the submission left are removed. Returns
+    a list of problems, an empty list means that there is no need to reboot.
+    """
+
+    problems = []
+
+    for module in _loaded_modules():
+        if module in state['modules']:
+            continue
+        if os.system('/sbin/rmmod %s' % module):
+            problems.append('Module %s remains loaded and cannot be unloaded' % module)
+
+    for path in _device_nodes():
+        if path in state['nodes']:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            problems.append('Failed removing the device file %s' % path)
+
+    tainted = _tainted() & ~state['tainted'] & ~HEALTH_TAINT_IGNORE
+    if tainted:
+        problems.append('The kernel is tainted (flags %d)' % tainted)
+
+    for line in _read_kernel_log().splitlines():
+        if KERNEL_OOPS_RE.search(line):
+            problems.append('Kernel log: %s' % line.strip())
+
+    stuck = _stuck_processes()
+    if stuck:
+        #
+        # Processes in state D are usually waiting for a short IO, only
+        # processes that remain stuck are reported.
+        #
+        time.sleep(STUCK_PROCESS_DELAY)
+        for pid in _stuck_processes():
+            if pid in stuck:
+                problems.append('Process %d is stuck in uninterruptible sleep' % pid)
+
+    return problems
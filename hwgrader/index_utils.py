@@ -0,0 +1,298 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+from state_utils import submission_phases
+import md5
+import fnmatch
+import os
+
+__all__ = [
+    'file_hash',
+    'source_hash',
+    'test_hash',
+    'pending_submissions',
+    'merge_target',
+    'index_submission',
+    'remove_previous_results',
+    'find_graded_source',
+    'copy_results'
+    ]
+
+#
+# The index of graded submissions is kept in the results folder. Each line:
+# test hash <tab> zip hash <tab> submission <tab> grades path <tab> stats path
+#   <tab> source hash <tab> id of the first submitter
+#
+GRADED_INDEX_NAME = 'graded_index.txt'
+
+#
+# Files that are not part of the source set of a submission.
+#
+SOURCE_HASH_IGNORE = ('submitters.txt',)
+
+#
+# Files in the folder of a test that are not part of its hash (outputs of
+# building and importing the helpers).
+#
+TEST_HASH_IGNORE = ('*.pyc', '*.pyo', '*.o', '*.ko', '*.mod.c', '.*', '*~')
+
+#
+# Hashes of the test files by path (see test_hash), computed once per process.
+#
+_test_hashes = {}
+
+
+def file_hash(path):
+    """Return the md5 (hex) of the content of a file"""
+
+    m = md5.new()
+    f = open(path, 'rb')
+    while 1:
+        data = f.read(1024*1024)
+        if not data:
+            break
+        m.update(data)
+    f.close()
+
+    return m.hexdigest()
+
+
+def source_hash(folder):
+    """Return the md5 (hex) of the source set of an extracted submission.
+
+    The hash covers the relative paths and contents of the files, so it
+    does not depend on the names and dates in the archive. The submitters
+    file is ignored.
+    """
+
+    def func(arg, dirname, fnames):
+        for name in fnames:
+            path = os.path.join(dirname, name)
+            if os.path.isfile(path) and name.lower() not in SOURCE_HASH_IGNORE:
+                arg.append(path[len(folder):].lstrip(os.sep))
+
+    rel_paths = []
+    os.path.walk(folder, func, rel_paths)
+    rel_paths.sort()
+
+    m = md5.new()
+    for rel_path in rel_paths:
+        m.update('%s\0%s\0' % (rel_path, file_hash(os.path.join(folder, rel_path))))
+
+    return m.hexdigest()
+
+
+def test_hash(test_path):
+    """Return the md5 (hex) of a test file and the files in its folder.
+
+    The folder holds the helpers of the test (modules, programs, headers
+    and makefiles), so changing any of them changes the hash and the
+    results graded with the previous version are not used.
+    """
+
+    test_path = os.path.abspath(test_path)
+    if _test_hashes.has_key(test_path):
+        return _test_hashes[test_path]
+
+    test_folder = os.path.dirname(test_path)
+
+    def func(arg, dirname, fnames):
+        for name in fnames:
+            path = os.path.join(dirname, name)
+            if not os.path.isfile(path):
+                continue
+            for pattern in TEST_HASH_IGNORE:
+                if fnmatch.fnmatch(name, pattern):
+                    break
+            else:
+                arg.append(path[len(test_folder):].lstrip(os.sep))
+
+    rel_paths = []
+    os.path.walk(test_folder, func, rel_paths)
+    rel_paths.sort()
+
+    m = md5.new()
+    m.update('%s\0%s\0' % (os.path.basename(test_path), file_hash(test_path)))
+    for rel_path in rel_paths:
+        m.update('%s\0%s\0' % (rel_path, file_hash(os.path.join(test_folder, rel_path))))
+
+    _test_hashes[test_path] = m.hexdigest()
+
+    return _test_hashes[test_path]
+
+
+def _read_index(results_folder, test_digest=None):
+    """Return the records of the submissions graded with the given test (or any test)"""
+
+    index_path = os.path.join(results_folder, GRADED_INDEX_NAME)
+    if not os.path.exists(index_path):
+        return []
+
+    records = []
+    f = open(index_path, 'rb')
+    for line in f.readlines():
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) in (5, 7) and test_digest in (None, fields[0]):
+            records.append(fields[1:])
+    f.close()
+
+    return records
+
+
+def pending_submissions(submissions, results_folder, test_path):
+    """Return the submissions that were not graded yet with this test file.
+
+    A submission is identified by the hash of its zip, so a resubmission
+    (same name, new content) is graded again.
+    """
+
+    graded = {}
+    for record in _read_index(results_folder, test_hash(test_path)):
+        graded[record[0]] = 1
+
+    return [submission for submission in submissions if not graded.has_key(file_hash(submission))]
+
+
+def merge_target(results_folder, test_path):
+    """Return the (grades path, stats path) of the last run with this test file.
+
+    If the test file changed since (e.g. a test was fixed), the last run
+    with any test file is used. Returns None if there is no such run (or
+    its files were removed).
+    """
+
+    records = _read_index(results_folder, test_hash(test_path))
+    if not records:
+        records = _read_index(results_folder)
+    if not records:
+        return None
+
+    grades_path, stats_path = records[-1][2:4]
+    if not os.path.exists(grades_path):
+        return None
+
+    return grades_path, stats_path
+
+
+def index_submission(submission, test_path, grades_path, stats_path, submitters=None, source_digest=None):
+    """Record that a submission was graded (in the results folder of grades_path).
+
+    With the submitters and the source hash of the submission (by default
+    taken from the state store), its results can be copied to identical
+    submissions (see find_graded_source).
+    """
+
+    index_path = os.path.join(os.path.dirname(grades_path), GRADED_INDEX_NAME)
+
+    if source_digest is None and os.path.exists(STATE_STORE_FOLDER):
+        source_digest = submission_phases(submission).get('source')
+
+    fields = [test_hash(test_path), file_hash(submission), os.path.basename(submission), grades_path, stats_path]
+    if source_digest and submitters:
+        fields += [source_digest, submitters[0].split()[-1]]
+
+    f = open(index_path, 'ab')
+    f.write('\t'.join(fields) + '\n')
+    f.close()
+
+
+def find_graded_source(results_folder, test_path, source_digest):
+    """Find a submission with the same source set that was graded with this test.
+
+    The test is identified by test_hash (the test file and its helpers).
+    Returns (grades path, stats path, id of the first submitter) or None.
+    """
+
+    for record in _read_index(results_folder, test_hash(test_path)):
+        if len(record) == 6 and record[4] == source_digest and os.path.exists(record[2]):
+            return record[2], record[3], record[5]
+
+    return None
+
+
+def _find_row(path, id, column):
+    if not os.path.exists(path):
+        return None
+
+    f = open(path, 'rb')
+    lines = f.readlines()
+    f.close()
+
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) > column and fields[column] == id:
+            return fields
+
+    return None
+
+
+def copy_results(graded, submitters, grades_path, stats_path):
+    """Copy the grade and stats rows of a graded submission to new submitters.
+
+    graded is the result of find_graded_source. Returns False if the rows
+    of the graded submission were not found.
+    """
+
+    old_grades_path, old_stats_path, old_id = graded
+
+    grade_row = _find_row(old_grades_path, old_id, 1)
+    stats_row = _find_row(old_stats_path, old_id, 0)
+    if not grade_row or not stats_row:
+        return False
+
+    f_grades = open(grades_path, 'ab')
+    for submitter in submitters:
+        f_grades.write('%s\t%s\n' % (grade_row[0], submitter.split()[-1]))
+    f_grades.close()
+
+    stats_lines = []
+    if os.path.exists(stats_path):
+        f_stats = open(stats_path, 'rb')
+        stats_lines = f_stats.readlines()
+        f_stats.close()
+
+    f_stats = open(stats_path, 'ab')
+    if not (stats_lines and stats_lines[0][:1] == '\t'):
+        #
+        # Take the top row with the names of the tests from the graded run.
+        #
+        f = open(old_stats_path, 'rb')
+        header = f.readline()
+        f.close()
+        if header[:1] == '\t':
+            f_stats.close()
+            f_stats = open(stats_path, 'wb')
+            f_stats.write(header)
+            f_stats.writelines(stats_lines)
+    f_stats.write('\t'.join([submitters[0].split()[-1]] + stats_row[1:]) + '\n')
+    f_stats.close()
+
+    return True
+
+
+def _remove_rows(path, ids, column):
+    if not os.path.exists(path):
+        return
+
+    f = open(path, 'rb')
+    lines = f.readlines()
+    f.close()
+
+    f = open(path + '.tmp', 'wb')
+    for line in lines:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) > column and fields[column] in ids:
+            continue
+        f.write(line)
+    f.close()
+    os.rename(path + '.tmp', path)
+
+
+def remove_previous_results(submitters, grades_path, stats_path):
+    """Remove the grades/stats rows of the submitters (before adding their new results)"""
+
+    ids = [submitter.split()[-1] for submitter in submitters]
+
+    _remove_rows(grades_path, ids, 1)
+    _remove_rows(stats_path, ids, 0)
@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+from state_utils import claim_submission, unclaimed_submissions
+import socket
+import signal
+import errno
+import time
+import os
+
+__all__ = [
+    'new_worker_id',
+    'acquire_lease',
+    'renew_leases',
+    'release_lease',
+    'lease_owner',
+    'mark_done',
+    'is_done',
+    'claim_shared',
+    'lock_results',
+    'unlock_results',
+    'set_shared_run',
+    'shared_run',
+    'lock_shared_results',
+    'unlock_shared_results',
+    'finish_shared_submission'
+    ]
+
+#
+# A shared run is a folder (on the shared submissions mount) with:
+# <submission>.lease - the worker that grades the submission. Created
+#                      with link() which is atomic also on NFS. The
+#                      owner touches it every LEASE_HEARTBEAT seconds, a
+#                      lease that was not touched for LEASE_TIMEOUT seconds
+#                      (e.g. the machine crashed) can be taken by another
+#                      worker.
+# <submission>.done  - the submission was graded.
+# results.lease      - a short lease held while writing the shared
+#                      grades/stats files.
+#
+LEASE_SUFFIX = '.lease'
+DONE_SUFFIX = '.done'
+RESULTS_LEASE_NAME = 'results'
+
+#
+# The shared run of this grader: (lease folder, worker id) or None.
+#
+_shared_run = None
+
+
+def new_worker_id():
+    """Return a unique id for a grader machine (the host name might be shared by cloned VMs)"""
+
+    return '%s-%d-%d' % (socket.gethostname(), os.getpid(), int(time.time()))
+
+
+def _lease_path(lease_folder, name):
+    return os.path.join(lease_folder, os.path.basename(name) + LEASE_SUFFIX)
+
+
+def lease_owner(lease_folder, name):
+    """Return the worker that holds the lease or None"""
+
+    try:
+        f = open(_lease_path(lease_folder, name), 'rb')
+    except IOError:
+        return None
+
+    owner = f.read().strip()
+    f.close()
+
+    return owner
+
+
+def acquire_lease(lease_folder, name, worker, timeout=LEASE_TIMEOUT):
+    """Try to take the lease of name. Returns True if the worker holds it.
+
+    A lease that expired is taken over. The age of a lease is measured
+    by the clock of the shared file system, so the clocks of the workers
+    don't matter.
+    """
+
+    path = _lease_path(lease_folder, name)
+    tmp_path = '%s.%s' % (path, worker)
+
+    f = open(tmp_path, 'wb')
+    f.write('%s\n' % worker)
+    f.close()
+
+    try:
+        while 1:
+            try:
+                os.link(tmp_path, path)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            #
+            # On NFS link() might succeed but report a failure, so check
+            # the link count instead.
+            #
+            if os.stat(tmp_path).st_nlink == 2:
+                return True
+
+            if lease_owner(lease_folder, name) == worker:
+                #
+                # Held from before a reboot.
+                #
+                return True
+
+            try:
+                lease_time = os.stat(path).st_mtime
+            except OSError:
+                #
+                # Released just now.
+                #
+                continue
+
+            if os.stat(tmp_path).st_mtime - lease_time < timeout:
+                return False
+
+            #
+            # Take the expired lease. Only one worker can rename it away,
+            # and if the lease was renewed (or replaced) meanwhile it is
+            # put back.
+            #
+            expired_path = '%s.%s.expired' % (path, worker)
+            try:
+                os.rename(path, expired_path)
+            except OSError:
+                return False
+
+            if os.stat(tmp_path).st_mtime - os.stat(expired_path).st_mtime < timeout:
+                try:
+                    os.link(expired_path, path)
+                except OSError:
+                    pass
+                os.remove(expired_path)
+                return False
+
+            os.remove(expired_path)
+    finally:
+        os.remove(tmp_path)
+
+
+def renew_leases(lease_folder, worker):
+    """Touch all the leases that the worker holds"""
+
+    for name in os.listdir(lease_folder):
+        if name.endswith(LEASE_SUFFIX) and lease_owner(lease_folder, name[:-len(LEASE_SUFFIX)]) == worker:
+            try:
+                os.utime(os.path.join(lease_folder, name), None)
+            except OSError:
+                pass
+
+
+def release_lease(lease_folder, name, worker):
+    """Release a lease if the worker still holds it"""
+
+    if lease_owner(lease_folder, name) == worker:
+        try:
+            os.remove(_lease_path(lease_folder, name))
+        except OSError:
+            pass
+
+
+def mark_done(lease_folder, name, worker):
+    """Mark a submission as graded and release its lease"""
+
+    done_path = os.path.join(lease_folder, os.path.basename(name) + DONE_SUFFIX)
+    f = open('%s.%s' % (done_path, worker), 'wb')
+    f.write('%s\n' % worker)
+    f.close()
+    os.rename('%s.%s' % (done_path, worker), done_path)
+
+    release_lease(lease_folder, name, worker)
+
+
+def is_done(lease_folder, name):
+    return os.path.exists(os.path.join(lease_folder, os.path.basename(name) + DONE_SUFFIX))
+
+
+def claim_shared(lease_folder, worker, state_folder=None, poll=LEASE_POLL, timeout=LEASE_TIMEOUT):
+    """Claim the next submission of the local queue that no other worker grades.
+
+    Waits while the only submissions left are graded by other workers, as
+    one of them might crash and its lease expire. Returns None when all the
+    submissions of the queue are done.
+    """
+
+    def accept(submission):
+        if is_done(lease_folder, submission) or not acquire_lease(lease_folder, submission, worker, timeout):
+            return False
+
+        #
+        # The worker that held the lease might have finished just before
+        # releasing it.
+        #
+        if is_done(lease_folder, submission):
+            release_lease(lease_folder, submission, worker)
+            return False
+
+        return True
+
+    while 1:
+        submission = claim_submission(worker, state_folder, accept)
+        if submission:
+            return submission
+
+        pending = [submission for submission in unclaimed_submissions(state_folder) if not is_done(lease_folder, submission)]
+        if not pending:
+            return None
+
+        time.sleep(poll)
+
+
+def _heartbeat(lease_folder, worker, parent_pid, interval):
+    while os.getppid() == parent_pid:
+        renew_leases(lease_folder, worker)
+        time.sleep(interval)
+
+
+def set_shared_run(lease_folder, worker, interval=LEASE_HEARTBEAT):
+    """Grade as one worker of a shared run.
+
+    Starts a process that renews the leases of the worker as long as the
+    grader runs.
+    """
+
+    global _shared_run
+
+    if not os.path.exists(lease_folder):
+        try:
+            os.makedirs(lease_folder)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    _shared_run = (lease_folder, worker)
+
+    parent_pid = os.getpid()
+    if os.fork() == 0:
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            _heartbeat(lease_folder, worker, parent_pid, interval)
+        finally:
+            os._exit(0)
+
+
+def shared_run():
+    """Return the (lease folder, worker id) of the shared run or None"""
+
+    return _shared_run
+
+
+def lock_results(lease_folder, worker, timeout=RESULTS_LEASE_TIMEOUT, poll=1):
+    """Wait for the lease of the shared grades/stats files"""
+
+    while not acquire_lease(lease_folder, RESULTS_LEASE_NAME, worker, timeout):
+        time.sleep(poll)
+
+
+def unlock_results(lease_folder, worker):
+    release_lease(lease_folder, RESULTS_LEASE_NAME, worker)
+
+
+def lock_shared_results():
+    """Lock the grades/stats files of the shared run (nothing to do when not shared)"""
+
+    if _shared_run is not None:
+        lock_results(_shared_run[0], _shared_run[1])
+
+
+def unlock_shared_results():
+    if _shared_run is not None:
+        unlock_results(_shared_run[0], _shared_run[1])
+
+
+def finish_shared_submission(submission):
+    """Mark a submission of the shared run as graded"""
+
+    if _shared_run is None or not submission:
+        return
+
+    lease_folder, worker = _shared_run
+    mark_done(lease_folder, submission, worker)
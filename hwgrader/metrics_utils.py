@@ -0,0 +1,106 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+import time
+import os
+
+__all__ = [
+    'set_metrics_path',
+    'set_metrics_submission',
+    'record_phase',
+    'mark_reboot',
+    'record_reboot',
+    'read_metrics'
+    ]
+
+#
+# The metrics file has a line per phase:
+# start time <tab> submission <tab> phase <tab> duration (seconds)
+# The build scripts append to the same file (see grader_phase.sh).
+#
+METRICS_NO_SUBMISSION = '-'
+
+
+def set_metrics_path(path):
+    """Set the metrics file of the run.
+
+    The path is kept in the environment so that forked workers and the
+    build scripts write to the same file.
+    """
+
+    os.environ[METRICS_ENV] = path
+
+
+def set_metrics_submission(submission):
+    """Set the submission that the following phases belong to"""
+
+    if submission:
+        os.environ[METRICS_SUBMISSION_ENV] = os.path.basename(submission)
+    elif os.environ.has_key(METRICS_SUBMISSION_ENV):
+        del os.environ[METRICS_SUBMISSION_ENV]
+
+
+def record_phase(phase, start_time, end_time=None):
+    """Record the duration of a phase that started at start_time.
+
+    Does nothing when the metrics file is not set.
+    """
+
+    metrics_path = os.environ.get(METRICS_ENV)
+    if not metrics_path:
+        return
+
+    if end_time is None:
+        end_time = time.time()
+
+    submission = os.environ.get(METRICS_SUBMISSION_ENV, METRICS_NO_SUBMISSION)
+    line = '%.3f\t%s\t%s\t%.3f\n' % (start_time, submission, phase, end_time - start_time)
+
+    #
+    # A single write to a file opened for append, parallel workers
+    # do not mix their lines.
+    #
+    fd = os.open(metrics_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.write(fd, line)
+    os.close(fd)
+
+
+def mark_reboot():
+    """Save the time of a reboot, record_reboot records the phase after the boot"""
+
+    f = open(REBOOT_MARK_PATH, 'wb')
+    f.write('%.3f\n' % time.time())
+    f.close()
+
+
+def record_reboot():
+    """Record the time from the reboot (mark_reboot) until the grader restarted"""
+
+    if not os.path.exists(REBOOT_MARK_PATH):
+        return
+
+    f = open(REBOOT_MARK_PATH, 'rb')
+    start_time = float(f.read().strip())
+    f.close()
+    os.remove(REBOOT_MARK_PATH)
+
+    record_phase('reboot', start_time)
+
+
+def read_metrics(metrics_path):
+    """Read a metrics file. Returns a list of (start time, submission, phase, duration)"""
+
+    records = []
+    f = open(metrics_path, 'rb')
+    for line in f.readlines():
+        temp = line.rstrip('\n').split('\t')
+        if len(temp) != 4:
+            continue
+        try:
+            records.append((float(temp[0]), temp[1], temp[2], float(temp[3])))
+        except ValueError:
+            continue
+    f.close()
+
+    return records
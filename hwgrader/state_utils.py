@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+import urllib
+import fcntl
+import errno
+import time
+import os
+
+__all__ = [
+    'init_state',
+    'claim_submission',
+    'peek_submission',
+    'unclaimed_submissions',
+    'current_submission',
+    'record_state',
+    'read_state',
+    'submission_phases'
+    ]
+
+#
+# The state store is a folder with:
+# queue   - the submissions, one per line (written once, atomically).
+# claims  - a file per claimed submission (named by its index in the queue),
+#           created with O_EXCL so that concurrent workers never claim the
+#           same submission.
+# journal - append only records of the run:
+#           time <tab> submission <tab> kind <tab> key <tab> value
+#           The fields are url quoted. Each record is written with a single
+#           write and synced, a record that was cut by a crash is ignored.
+#
+STATE_QUEUE_NAME = 'queue'
+STATE_CLAIMS_NAME = 'claims'
+STATE_JOURNAL_NAME = 'journal'
+
+STATE_PHASE = 'phase'
+STATE_TEST = 'test'
+STATE_CHANNEL = 'channel'
+
+
+def _path(name, state_folder=None):
+    if state_folder is None:
+        state_folder = STATE_STORE_FOLDER
+
+    return os.path.join(state_folder, name)
+
+
+def _read_queue(state_folder=None):
+    f = open(_path(STATE_QUEUE_NAME, state_folder), 'rb')
+    queue = [urllib.unquote(line[:-1]) for line in f.readlines() if line.endswith('\n')]
+    f.close()
+
+    return queue
+
+
+def _claimed(state_folder=None):
+    """Return the sorted indices of the claimed submissions"""
+
+    indices = [int(name) for name in os.listdir(_path(STATE_CLAIMS_NAME, state_folder)) if name.isdigit()]
+    indices.sort()
+
+    return indices
+
+
+def init_state(submissions, state_folder=None):
+    """Create the state store with a queue of submissions"""
+
+    if state_folder is None:
+        state_folder = STATE_STORE_FOLDER
+
+    os.makedirs(_path(STATE_CLAIMS_NAME, state_folder))
+
+    queue_path = _path(STATE_QUEUE_NAME, state_folder)
+    f = open(queue_path + '.tmp', 'wb')
+    f.write(''.join([urllib.quote(submission) + '\n' for submission in submissions]))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.rename(queue_path + '.tmp', queue_path)
+
+    open(_path(STATE_JOURNAL_NAME, state_folder), 'ab').close()
+
+
+def claim_submission(worker=None, state_folder=None, accept=None):
+    """Claim the next submission of the queue. Returns None when the queue is done.
+
+    Safe to call from several processes at once, each submission is
+    claimed exactly once. Submissions for which accept(submission) is
+    false are skipped (and left unclaimed).
+    """
+
+    if worker is None:
+        worker = str(os.getpid())
+
+    queue = _read_queue(state_folder)
+    claimed = _claimed(state_folder)
+    for index in range(len(queue)):
+        if index in claimed or (accept and not accept(queue[index])):
+            continue
+
+        claim_path = os.path.join(_path(STATE_CLAIMS_NAME, state_folder), str(index))
+        try:
+            fd = os.open(claim_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                continue
+            raise
+
+        os.write(fd, '%s\n' % worker)
+        os.close(fd)
+
+        record_state(queue[index], STATE_PHASE, 'queue', 'claimed', state_folder)
+        return queue[index]
+
+    return None
+
+
+def peek_submission(state_folder=None):
+    """Get the next submission that is not claimed (without claiming it)"""
+
+    queue = _read_queue(state_folder)
+    claimed = _claimed(state_folder)
+    for index in range(len(queue)):
+        if index not in claimed:
+            return queue[index]
+
+    return None
+
+
+def unclaimed_submissions(state_folder=None):
+    """Return the submissions of the queue that are not claimed"""
+
+    queue = _read_queue(state_folder)
+    claimed = _claimed(state_folder)
+
+    return [queue[index] for index in range(len(queue)) if index not in claimed]
+
+
+def current_submission(state_folder=None):
+    """Get the last claimed submission"""
+
+    claimed = _claimed(state_folder)
+    if not claimed:
+        return None
+
+    return _read_queue(state_folder)[claimed[-1]]
+
+
+def record_state(submission, kind, key, value, state_folder=None):
+    """Append a record to the journal of the run"""
+
+    fields = [
+        '%.3f' % time.time(),
+        urllib.quote(os.path.basename(submission or '-')),
+        urllib.quote(kind),
+        urllib.quote(str(key)),
+        urllib.quote(str(value))
+        ]
+
+    line = '\t'.join(fields) + '\n'
+
+    fd = os.open(_path(STATE_JOURNAL_NAME, state_folder), os.O_RDWR | os.O_CREAT | os.O_APPEND)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+
+        #
+        # Terminate a record that was cut by a crash so that it doesn't
+        # corrupt this one.
+        #
+        if os.fstat(fd).st_size:
+            os.lseek(fd, -1, 2)
+            if os.read(fd, 1) != '\n':
+                line = '\n' + line
+
+        os.write(fd, line)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_state(submission=None, kind=None, state_folder=None):
+    """Read the records of the journal, optionally of one submission and kind.
+
+    Returns a list of (time, submission, kind, key, value).
+    """
+
+    if submission is not None:
+        submission = os.path.basename(submission)
+
+    records = []
+    f = open(_path(STATE_JOURNAL_NAME, state_folder), 'rb')
+    for line in f.readlines():
+        fields = line[:-1].split('\t')
+        if not line.endswith('\n') or len(fields) != 5:
+            #
+            # A record that was cut by a crash.
+            #
+            continue
+
+        record = tuple([float(fields[0])] + [urllib.unquote(field) for field in fields[1:]])
+        if submission is not None and record[1] != submission:
+            continue
+        if kind is not None and record[2] != kind:
+            continue
+        records.append(record)
+    f.close()
+
+    return records
+
+
+def submission_phases(submission, state_folder=None):
+    """Return a dict with the last status of each phase of a submission"""
+
+    phases = {}
+    for record in read_state(submission, STATE_PHASE, state_folder):
+        phases[record[3]] = record[4]
+
+    return phases
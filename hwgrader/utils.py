@@ -12,31 +12,46 @@ import time
 import sys
 import traceback
 import select
+import math
 import string
 import types
 import re
 import errno
 import fcntl
+import struct
 import shutil
 import fileinput
 import warnings
 import ConfigParser
 import glob
+from metrics_utils import record_phase, mark_reboot
+from state_utils import init_state, claim_submission, peek_submission, current_submission, \
+     record_state, STATE_PHASE, STATE_TEST, STATE_CHANNEL
+from zip_utils import extract_zip, extracted_folder, load_extract_info
+from lease_utils import new_worker_id, shared_run, claim_shared, lock_shared_results, unlock_shared_results
 
 __all__ = [
     'prompt_with_timeout',
+    'abort_requested',
+    'install_abort_handler',
+    'boot_latency',
     'import_path',
     'submission_paths',
     'get_submitters',
     'add_grade',
     'add_stats',
+    'add_failure',
+    'reuse_results',
     'unzip_submission',
     'ParTextTestRunner',
     'ParTestCase',
     'TestError',
+    'TestRecord',
     'TestStatus',
+    'remove_test_status',
     'RebootableTestSuite',
     'set_grub',
+    'reboot',
     'init_bash',
     'init_sysctl',
     'init_autologin',
@@ -44,8 +59,11 @@ __all__ = [
     'end_bash',
     'end_sysctl',
     'end_autologin',
+    'end_kernel',
     'end_grader',
-    'next_submission'
+    'next_submission',
+    'peek_submission',
+    'current_submission'
     ]
 
 #
@@ -112,6 +130,45 @@ def prompt_with_timeout(prompt='Press any key to abort operation', timeout=5):
     return ch
 
 
+def abort_requested():
+    """Check (without blocking) whether the user asked to stop the grader.
+
+    The grader stops when the sentinel file ABORT_SENTINEL_PATH exists
+    (see also install_abort_handler).
+    """
+
+    return os.path.exists(ABORT_SENTINEL_PATH)
+
+
+def abort_handler(signum, frame):
+    f = open(ABORT_SENTINEL_PATH, 'wb')
+    f.close()
+
+
+def install_abort_handler():
+    """Create the abort sentinel when the grader gets SIGUSR1.
+
+    The pid of the grader is written to GRADER_PID_PATH. The grader stops
+    before its next submission (the sentinel survives a reboot).
+    """
+
+    signal.signal(signal.SIGUSR1, abort_handler)
+
+    f = open(GRADER_PID_PATH, 'wb')
+    f.write('%d\n' % os.getpid())
+    f.close()
+
+
+def boot_latency():
+    """Return the number of seconds since the kernel started"""
+
+    f = open('/proc/uptime', 'rb')
+    uptime = float(f.read().split()[0])
+    f.close()
+
+    return uptime
+
+
 def import_path(fullpath):
     """ 
     Import a file with full path specification. Allows one to
@@ -134,6 +191,8 @@ def submission_paths(submissions_folder):
     DEFAULT_RESULT_PATTERN = 'result_%s.txt'
     DEFAULT_GRADES_PATTERN = 'grades_%s.txt'
     DEFAULT_STATS_PATTERN = 'stats_%s.txt'
+    DEFAULT_CACHE_STATS_PATTERN = 'cache_stats_%s.txt'
+    DEFAULT_METRICS_PATTERN = 'metrics_%s.txt'
     
     import time
     
@@ -147,6 +206,8 @@ def submission_paths(submissions_folder):
     results_path = os.path.join(results_folder, DEFAULT_RESULT_PATTERN % time.strftime('%y%m%d_%H%M%S'))
     grades_path = os.path.join(results_folder, DEFAULT_GRADES_PATTERN % time.strftime('%y%m%d_%H%M%S'))
     stats_path = os.path.join(results_folder, DEFAULT_STATS_PATTERN % time.strftime('%y%m%d_%H%M%S'))
+    cache_stats_path = os.path.join(results_folder, DEFAULT_CACHE_STATS_PATTERN % time.strftime('%y%m%d_%H%M%S'))
+    metrics_path = os.path.join(results_folder, DEFAULT_METRICS_PATTERN % time.strftime('%y%m%d_%H%M%S'))
     temp_folder = os.path.join(submissions_folder, TEMP_USER_FOLDER)
 
     #
@@ -156,7 +217,7 @@ def submission_paths(submissions_folder):
     f_grades.write('GRADE\tID\n')
     f_grades.close()
     
-    return {'results_path':results_path, 'grades_path':grades_path, 'temp_folder':temp_folder, 'stats_path':stats_path}
+    return {'results_path':results_path, 'grades_path':grades_path, 'temp_folder':temp_folder, 'stats_path':stats_path, 'cache_stats_path':cache_stats_path, 'metrics_path':metrics_path}
 
 
 def add_grade(submitters, test_result, grades_path):
@@ -164,7 +225,10 @@ def add_grade(submitters, test_result, grades_path):
     
     GRADE_FORMAT = '%d\t%s\n'
 
-    grade = int(round(100 * test_result.successes / test_result.testsRun))
+    if test_result.testsRun:
+        grade = int(round(100 * test_result.successes / test_result.testsRun))
+    else:
+        grade = 0
 
     grade_str = ''
     for submitter in submitters:
@@ -183,12 +247,20 @@ def add_stats(submitters, test_result, stats_path):
     keys = stats.keys()
     keys.sort()
     
-    if not os.path.exists(stats_path):
+    stats_lines = []
+    if os.path.exists(stats_path):
+        f_stats = open(stats_path, 'rb')
+        stats_lines = f_stats.readlines()
+        f_stats.close()
+
+    if keys and not (stats_lines and stats_lines[0][:1] == '\t'):
         #
-        # Create the top row with name of tests
+        # Create the top row with name of tests (the rows of submissions
+        # that failed before running any test might already be there).
         #
-        f_stats = open(stats_path, 'ab')
+        f_stats = open(stats_path, 'wb')
         f_stats.write('\t%s\n' % '\t'.join([key.split('.')[-1] for key in keys]))
+        f_stats.writelines(stats_lines)
     else:
         f_stats = open(stats_path, 'ab')
             
@@ -198,6 +270,54 @@ def add_stats(submitters, test_result, stats_path):
     f_stats.close()
 
 
+def add_failure(submitters, grades_path, stats_path):
+    """Add a zero grade for a submission that failed before running any test"""
+
+    test_result = ParTestResult()
+    add_grade(submitters, test_result, grades_path)
+    add_stats(submitters, test_result, stats_path)
+
+
+def reuse_results(submission, source_folder, test_path, grades_path, stats_path, incremental, f_results, reuse=False):
+    """Copy the results of an identical submission that was already graded with this test.
+
+    The source hash of the submission is recorded in the state store (it
+    is indexed with the results of the submission). Past results are only
+    copied when reuse is set (the -R flag of the graders). Returns True if
+    the results were copied.
+    """
+
+    from index_utils import source_hash, find_graded_source, copy_results, index_submission, \
+         remove_previous_results
+
+    digest = source_hash(source_folder)
+    record_state(submission, STATE_PHASE, 'source', digest)
+
+    if not reuse:
+        return False
+
+    lock_shared_results()
+    try:
+        graded = find_graded_source(os.path.dirname(grades_path), test_path, digest)
+        if not graded:
+            return False
+
+        submitters = get_submitters(source_folder)
+        if incremental:
+            remove_previous_results(submitters, grades_path, stats_path)
+        if not copy_results(graded, submitters, grades_path, stats_path):
+            return False
+
+        index_submission(submission, test_path, grades_path, stats_path, submitters, digest)
+    finally:
+        unlock_shared_results()
+
+    f_results.write('Identical to a submission graded in %s, copied its results\n' % graded[0])
+    record_state(submission, STATE_PHASE, 'test', 'reused')
+
+    return True
+
+
 def get_submitters(temp_folder):
     
     import glob
@@ -223,18 +343,40 @@ def unzip_submission(submissions_folder, temp_folder, submission, f_results):
 
     SUBMISSION_HEADER = "\nSubmission by %s\n\n"
     
+    start_time = time.time()
+
     #
     # Unzip the submission into a temporary path.
     #
-    os.chdir(submissions_folder)
     if os.path.exists(temp_folder):
         shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(temp_folder)
     
-    if os.system('unzip %s -d %s' % (submission, temp_folder)):
-        raise Exception('Failed unzipping the submission')
+    info = None
+    if os.path.exists(extracted_folder(submission)):
+        info = load_extract_info(submission)
+
+    if info:
+        #
+        # Extracted (and checked) at init.
+        #
+        shutil.rmtree(temp_folder, ignore_errors=True)
+        shutil.copytree(extracted_folder(submission), temp_folder)
+        files, size, duration, skipped = info
+    else:
+        try:
+            files, size, skipped = extract_zip(os.path.join(submissions_folder, submission), temp_folder)
+        except Exception, e:
+            raise Exception('Failed unzipping the submission: %s' % e)
+        duration = time.time() - start_time
 
     submitters = get_submitters(temp_folder)
     f_results.write(SUBMISSION_HEADER % ' & '.join(submitters))
+    f_results.write('Extracted %d files (%d KB) in %.2f seconds\n' % (files, size // 1024, duration))
+    if skipped:
+        f_results.write('Skipped %d files of the zip: %s\n' % (len(skipped), ' '.join(skipped)))
+
+    record_phase('unzip', start_time)
 
     return submitters
 
@@ -329,23 +471,236 @@ class WatchDog(object):
     
 class RebootableTestSuite(unittest.TestSuite):
     """A special TestSuite that knows to handle reboots.
+
+    Consecutive ParTestCase tests that are marked as concurrent (see
+    ParTestCase.isConcurrent) run at the same time, up to concurrency
+    tests at once.
     """
 
+    concurrency = CONCURRENT_TESTS
+
     def __call__(self, result):
         
         past_tests_ids = result.get_tests_ids()
         tests = [test for test in self._tests if test.id() not in past_tests_ids]
          
-        for test in tests:
+        i = 0
+        while i < len(tests):
             if result.shouldStop:
                 break
-            test(result)
+
+            group = []
+            if self.concurrency > 1 and hasattr(result, 'waitTests'):
+                while i + len(group) < len(tests) and _concurrent_test(tests[i + len(group)]):
+                    group.append(tests[i + len(group)])
+
+            if len(group) > 1:
+                self._run_concurrent(group, result)
+                i += len(group)
+            else:
+                tests[i](result)
+                i += 1
             
         return result
 
+    def _set_watchdog(self, wd, running):
+        """Set the watchdog to the latest deadline of the running tests.
+
+        A test that passed its deadline is killed (see _run_concurrent), the
+        watchdog is not extended for it so it fires if the test doesn't end
+        (e.g. it is stuck in the kernel).
+        """
+
+        deadlines = [deadline for test, start_time, deadline in running.values()]
+        timeout = max(deadlines) - time.time()
+        if min(deadlines) > time.time() and timeout > 0:
+            wd.set_timeout(int(math.ceil(timeout)))
+
+    def _run_concurrent(self, tests, result):
+        """Run the tests, up to self.concurrency at once, with one watchdog"""
+
+        running = {}
+        killed = {}
+        pending = tests[:]
+
+        result.createPipe()
+        result.concurrent = 1
+        wd = WatchDog(timeout=getattr(tests[0], '_TEST_TIMEOUT', TEST_TIMEOUT))
+        try:
+            while pending or running:
+                while pending and len(running) < self.concurrency and not result.shouldStop:
+                    test = pending.pop(0)
+                    result.startTest(test)
+                    tpid = os.fork()
+                    if tpid == 0:
+                        test._runChild(result)
+
+                    test_timeout = getattr(test, '_TEST_TIMEOUT', TEST_TIMEOUT)
+                    running[tpid] = (test, result._start_time, time.time() + test_timeout)
+                    self._set_watchdog(wd, running)
+
+                if not running:
+                    break
+
+                #
+                # Wake up at the first deadline and kill the tests that
+                # passed theirs, so that a hung test doesn't hold the others.
+                #
+                deadlines = [deadline for test, start_time, deadline in running.values()]
+                tpid, status = result.waitTests(running.keys(), max(min(deadlines) - time.time(), 0))
+                if not tpid:
+                    for tpid, (test, start_time, deadline) in running.items():
+                        if deadline <= time.time() and not killed.has_key(tpid):
+                            os.kill(tpid, signal.SIGKILL)
+                            killed[tpid] = deadline - start_time
+                    continue
+
+                test, start_time, deadline = running[tpid]
+                del running[tpid]
+
+                #
+                # Read what the test sent before it exited, the events of
+                # each test carry its id.
+                #
+                result._unpickle_events()
+                result._start_time = start_time
+                result.exit_status = status
+                stats = result.channel_stats
+                result.channel_stats = None
+                try:
+                    if killed.has_key(tpid):
+                        try:
+                            raise TestError, 'The test did not end within %d seconds' % killed[tpid]
+                        except TestError:
+                            result.addError(test, sys.exc_info())
+                    else:
+                        test._checkStatus(result, status)
+                finally:
+                    result.stopTest(test)
+                    result.channel_stats = stats
+
+                if running:
+                    self._set_watchdog(wd, running)
+        finally:
+            #
+            # Stop the tests that still run (e.g. on KeyboardInterrupt).
+            #
+            for tpid, (test, start_time, deadline) in running.items():
+                os.kill(tpid, signal.SIGKILL)
+                os.waitpid(tpid, 0)
+                result._start_time = start_time
+                result.stopTest(test)
+
+            wd.close()
+            result.concurrent = 0
+
+            #
+            # The channel is shared by the tests, its traffic is recorded
+            # for the group.
+            #
+            stats = result.channel_stats
+            result.destroyPipe()
+            if os.path.exists(STATE_STORE_FOLDER) and stats:
+                record_state(os.environ.get(METRICS_SUBMISSION_ENV), STATE_CHANNEL, ' '.join([test.id() for test in tests]), 'events=%d frames=%d bytes=%d stalls=%d max_read=%d' % \
+                             (stats['events'], stats['frames'], stats['bytes'], stats['stalls'], stats['max_read']))
+
+            #
+            # Remove the orphan processes of the tests (see ParTestCase),
+            # only when no test runs.
+            #
+            for cpid in get_orphan_pids():
+                os.kill(cpid, signal.SIGKILL)
+
+
+def _concurrent_test(test):
+    return hasattr(test, 'isConcurrent') and test.isConcurrent()
+
+
+#
+# Events of the test processes are sent to the runner in frames:
+# pid of the writer, payload size, times the writer found the pipe full,
+# last frame of the event. A frame fits in PIPE_BUF (of linux) so that
+# its write is atomic.
+#
+CHANNEL_HEADER = '<LHHB'
+CHANNEL_HEADER_SIZE = struct.calcsize(CHANNEL_HEADER)
+CHANNEL_FRAME_SIZE = 4096
+CHANNEL_READ_SIZE = 16*CHANNEL_FRAME_SIZE
+CHANNEL_POLL = 0.05
+
+#
+# Longer tracebacks are cut to their last TEST_MESSAGE_MAX bytes (where the
+# assertion is) before they are sent through the pipe and kept in the
+# test status.
+#
+TEST_MESSAGE_MAX = 4096
+
+
+class TestRecord(object):
+    """The failure or error of a test, without the test object.
+
+    Only the id and descriptions of the test are kept, so a record is
+    small and always picklable (a test might hold fds or modules). Equal
+    messages are interned and so stored once in memory.
+    """
+
+    __slots__ = ('test_id', 'outcome', 'message', 'doc', 'name', 'duration', 'exit_status')
+
+    FAILURE = 'F'
+    ERROR = 'E'
+
+    def __init__(self, test, outcome, message, duration=None, exit_status=None):
+        if len(message) > TEST_MESSAGE_MAX:
+            message = '[%d bytes cut]\n...%s' % (len(message) - TEST_MESSAGE_MAX, message[-TEST_MESSAGE_MAX:])
+
+        self.test_id = test.id()
+        self.outcome = outcome
+        self.message = intern(message)
+        self.doc = test.shortDescription()
+        self.name = str(test)
+        self.duration = duration
+        self.exit_status = exit_status
+
+    def __getstate__(self):
+        return (self.test_id, self.outcome, self.message, self.doc, self.name, self.duration, self.exit_status)
+
+    def __setstate__(self, state):
+        self.test_id, self.outcome, self.message, self.doc, self.name, self.duration, self.exit_status = state
+        self.message = intern(self.message)
+
+    def id(self):
+        return self.test_id
+
+    def shortDescription(self):
+        return self.doc
+
+    def __str__(self):
+        return self.name
+
+    def __repr__(self):
+        return "<%s %s %s>" % (self.__class__.__name__, self.outcome, self.test_id)
+
+
+#
+# Test status journal globals. Each record of the journal is a header
+# (op, payload size) and a payload:
+# G - generation of the snapshot that the journal continues
+# T - a test was added (test id)
+# S - a test was started (test id)
+# P - a test was stopped (test id)
+# E - an event (pickled event name and value)
+#
+TEST_JOURNAL_SUFFIX = '.journal'
+TEST_JOURNAL_HEADER = '<cL'
+TEST_JOURNAL_HEADER_SIZE = struct.calcsize(TEST_JOURNAL_HEADER)
 
 class TestStatus(object):
-    """Class that stores test status"""
+    """Class that stores test status.
+
+    The status is kept in a snapshot file (a pickle) and a journal of the
+    changes since the snapshot (see TEST_JOURNAL_SUFFIX). Only the journal
+    is written while the tests run.
+    """
     
     def __init__(self, path=TEST_STATUS_PATH, new=False):
         """
@@ -353,35 +708,144 @@ class TestStatus(object):
         """
         
         self._path = path
+        self._fd = None
+        self._generation = 0
+        self._status = {'tests':[], 'successes':[], 'failures':[], 'errors':[], 'crashes_num':0, 'running':[]}
         
         if path and not new:
             f = open(path, 'rb')
-            self._status = pickle.load(f)
+            self._generation, self._status = pickle.load(f)
             f.close()
-        else:
-            self._status = {'tests':[], 'successes':[], 'failures':[], 'errors':[], 'crashes_num':0}
+            self._status.setdefault('running', [])
+            
+            if self._replay():
+                #
+                # Start a new journal after a reboot.
+                #
+                self.compact()
+        
+        if self._fd is None:
+            self.compact()
+        
+    def __del__(self):
+        self.close()
+        
+    def _journal_path(self):
+        return self._path + TEST_JOURNAL_SUFFIX
     
-        self._save()
+    def _replay(self):
+        """Apply the records of the journal to the status. Returns the number of records"""
+        
+        journal_path = self._journal_path()
+        if not os.path.exists(journal_path):
+            return 0
+        
+        f = open(journal_path, 'rb')
+        data = f.read()
+        f.close()
+        
+        offset = 0
+        records = 0
+        while offset + TEST_JOURNAL_HEADER_SIZE <= len(data):
+            op, size = struct.unpack(TEST_JOURNAL_HEADER, data[offset:offset+TEST_JOURNAL_HEADER_SIZE])
+            payload = data[offset+TEST_JOURNAL_HEADER_SIZE:offset+TEST_JOURNAL_HEADER_SIZE+size]
+            if len(payload) < size:
+                #
+                # A record that was cut by a crash.
+                #
+                break
+            offset += TEST_JOURNAL_HEADER_SIZE + size
+            
+            if op == 'G':
+                if int(payload) != self._generation:
+                    #
+                    # The snapshot was written but the journal was not
+                    # reset (a crash in compact), the snapshot has all the
+                    # records.
+                    #
+                    return 0
+                continue
+            
+            if op in 'TS':
+                self._status['tests'].append(payload)
+            elif op == 'E':
+                event_name, event_value = pickle.loads(payload)
+                self._status[event_name].append(event_value)
+            
+            if op == 'S':
+                self._status['crashes_num'] += 1
+                self._status['running'].append(payload)
+            elif op == 'P':
+                self._status['crashes_num'] -= 1
+                if payload in self._status['running']:
+                    self._status['running'].remove(payload)
+            
+            records += 1
+        
+        return records
+    
+    def _write(self, op, payload=''):
+        """Append a record to the journal (without syncing it)"""
+        
+        if self._fd is None:
+            return
+        
+        os.write(self._fd, struct.pack(TEST_JOURNAL_HEADER, op, len(payload)) + payload)
         
-    def _save(self):
+    def sync(self):
+        """Make sure the journal reaches the disk (e.g. before a test that might crash the kernel)"""
+        
+        if self._fd is not None:
+            os.fsync(self._fd)
+        
+    def compact(self):
+        """Write the whole status to the snapshot and start a new journal"""
+        
+        self.close()
         
         if not self._path:
             return
         
-        f = open(self._path, 'wb')
-        pickle.dump(self._status, f)
+        self._generation += 1
+        
+        f = open(self._path + '.tmp', 'wb')
+        pickle.dump((self._generation, self._status), f)
+        f.flush()
+        os.fsync(f.fileno())
         f.close()
+        os.rename(self._path + '.tmp', self._path)
+        
+        journal_path = self._journal_path()
+        fd = os.open(journal_path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        generation = str(self._generation)
+        os.write(fd, struct.pack(TEST_JOURNAL_HEADER, 'G', len(generation)) + generation)
+        os.fsync(fd)
+        os.close(fd)
+        os.rename(journal_path + '.tmp', journal_path)
+        
+        self._fd = os.open(journal_path, os.O_WRONLY | os.O_APPEND)
+        
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        
+    def remove(self):
+        """Delete the status files (the submission is done)"""
+        
+        self.close()
+        remove_test_status(self._path)
         
     #
     # Hanlde all errors/failures etc...
     #
     def addTest(self, test):
         self._status['tests'].append(test.id())
-        self._save()
+        self._write('T', test.id())
         
     def addEvent(self, event_name, event_value):
         self._status[event_name].append(event_value)
-        self._save()
+        self._write('E', pickle.dumps((event_name, event_value)))
 
     def get_tests_ids(self):
         return self._status['tests']
@@ -398,18 +862,41 @@ class TestStatus(object):
     def get_successes(self):
         return self._status['successes']
     
+    def get_running_tests(self):
+        """The ids of the tests that were started and not stopped (crashed, when
+        the status was loaded after a reboot). Several tests might run at once.
+        """
+        return self._status['running']
+    
     def startTest(self, test):
         """Called at the start of the test"""
         
-        self.addTest(test)
+        self._status['tests'].append(test.id())
         self._status['crashes_num'] += 1
-        self._save()
+        self._status['running'].append(test.id())
+        self._write('S', test.id())
+        
+        #
+        # The test might crash the kernel, the status must be on the disk
+        # for the grader to resume after the reboot.
+        #
+        self.sync()
 
     def stopTest(self, test):
         "Called when the given test has been run"
         
         self._status['crashes_num'] -= 1
-        self._save()
+        if test.id() in self._status['running']:
+            self._status['running'].remove(test.id())
+        self._write('P', test.id())
+
+
+def remove_test_status(path=TEST_STATUS_PATH):
+    """Delete the snapshot and journal of a test status"""
+    
+    for status_path in (path, path + TEST_JOURNAL_SUFFIX):
+        if os.path.exists(status_path):
+            os.remove(status_path)
 
 
 #
@@ -426,6 +913,17 @@ class ParTestResult(unittest.TestResult):
     """
     def __init__(self, test_status=None):
         self.shouldStop = 0
+        self.pr = None
+        self.pw = None
+        self._runner_pid = None
+        self._start_time = None
+        self.exit_status = None
+        self.channel_stats = None
+
+        #
+        # Set while RebootableTestSuite runs several tests at once.
+        #
+        self.concurrent = 0
 
         if test_status is None:
             test_status = TestStatus(path=None)
@@ -445,11 +943,33 @@ class ParTestResult(unittest.TestResult):
         """Called at the start of the test"""
         
         self.test_status.startTest(test)
+        self._start_time = time.time()
+        self.exit_status = None
         
     def stopTest(self, test):
         "Called when the given test has been run"
 
         self.test_status.stopTest(test)        
+        if self._start_time is not None:
+            record_phase('test %s' % test.id(), self._start_time)
+
+            #
+            # Keep the outcome of the test in the state store of the run.
+            #
+            if os.path.exists(STATE_STORE_FOLDER):
+                if test.id() in self.test_status.get_successes():
+                    outcome = 'success'
+                else:
+                    outcome = 'failure'
+                record_state(os.environ.get(METRICS_SUBMISSION_ENV), STATE_TEST, test.id(), '%s %.3f' % (outcome, time.time() - self._start_time))
+
+                if self.channel_stats:
+                    stats = self.channel_stats
+                    record_state(os.environ.get(METRICS_SUBMISSION_ENV), STATE_CHANNEL, test.id(), 'events=%d frames=%d bytes=%d stalls=%d max_read=%d' % \
+                                 (stats['events'], stats['frames'], stats['bytes'], stats['stalls'], stats['max_read']))
+
+            self._start_time = None
+            self.channel_stats = None
 
     def wasSuccessful(self):
         "Tells whether or not this result was a success"
@@ -460,12 +980,16 @@ class ParTestResult(unittest.TestResult):
 
         self.pr, self.pw = os.pipe()
         #
-        # The writing side of the pipe is set to non block so that it doesn't
-        # block if too many child precess fail and try to write. This causes
-        # the buffer to get filled and when a child tries to write to a full
-        # pipe, it is blocked
+        # The writing side of the pipe is set to non block so that a
+        # writer that finds the pipe full is counted (as back-pressure)
+        # before it waits for the runner to read (see _write_frame).
         #
         fcntl.fcntl(self.pw, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        self._channel_buffer = ''
+        self._channel_partial = {}
+        self._runner_pid = os.getpid()
+        self.channel_stats = {'events':0, 'frames':0, 'bytes':0, 'stalls':0, 'max_read':0}
         
     def destroyPipe(self):
         """Read the contents of the pipe and close it."""
@@ -487,24 +1011,94 @@ class ParTestResult(unittest.TestResult):
         if self.pw:
             os.close(self.pw)
             self.pw = None
+
+    def _write_frame(self, frame_fields, fragment):
+        """Write a frame to the pipe, waiting while the pipe is full.
+
+        A frame is at most CHANNEL_FRAME_SIZE (PIPE_BUF) bytes, so it is
+        written whole and frames of concurrent writers don't mix.
+        """
+
+        stalls = 0
+        while 1:
+            header = struct.pack(CHANNEL_HEADER, frame_fields[0], len(fragment), min(stalls, 0xffff), frame_fields[1])
+            try:
+                os.write(self.pw, header + fragment)
+                return
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    #
+                    # The runner closed the pipe (e.g. a child process
+                    # that outlived its test).
+                    #
+                    return
+
+            stalls += 1
+            try:
+                select.select([], [self.pw], [])
+            except select.error, e:
+                if e[0] != errno.EINTR:
+                    raise
         
     def _pickle_event(self, event_name, event_value):
         """Pickle the event (error, failure etc.) through the pipe"""
 
-        if self.pw == None:
+        if self.pw == None or os.getpid() == self._runner_pid:
             #
             # The main process writes directly to the status dict
-            # (It can't use the Wr side of the pipe).
+            # (It can't use the Wr side of the pipe, which stays open
+            # while concurrent tests are started).
             #
             self.test_status.addEvent(event_name, event_value)
-        else:
-            try:
-                os.write(self.pw, pickle.dumps((event_name, event_value)))
-            except OSError, e:
-                #
-                # The pipe is probably full (happens when many child process fail)
-                #
-                pass
+            return
+
+        #
+        # Split the event to frames that carry the pid of the writer, the
+        # runner joins the frames of each writer.
+        #
+        data = pickle.dumps((event_name, event_value))
+        pid = os.getpid()
+        offset = 0
+        while 1:
+            fragment = data[offset:offset+CHANNEL_FRAME_SIZE-CHANNEL_HEADER_SIZE]
+            offset += len(fragment)
+            last = offset >= len(data)
+            self._write_frame((pid, last), fragment)
+            if last:
+                break
+
+    def _read_events(self):
+        """Read the available frames from the pipe. Returns False at the end of the pipe"""
+
+        data = os.read(self.pr, CHANNEL_READ_SIZE)
+        if not data:
+            return False
+
+        stats = self.channel_stats
+        stats['bytes'] += len(data)
+        stats['max_read'] = max(stats['max_read'], len(data))
+
+        buf = self._channel_buffer + data
+        while len(buf) >= CHANNEL_HEADER_SIZE:
+            pid, size, stalls, last = struct.unpack(CHANNEL_HEADER, buf[:CHANNEL_HEADER_SIZE])
+            if len(buf) < CHANNEL_HEADER_SIZE + size:
+                break
+            fragment = buf[CHANNEL_HEADER_SIZE:CHANNEL_HEADER_SIZE+size]
+            buf = buf[CHANNEL_HEADER_SIZE+size:]
+
+            stats['frames'] += 1
+            stats['stalls'] += stalls
+
+            fragments = self._channel_partial.setdefault(pid, [])
+            fragments.append(fragment)
+            if last:
+                del self._channel_partial[pid]
+                event_name, event_value = pickle.loads(''.join(fragments))
+                self.test_status.addEvent(event_name, event_value)
+                stats['events'] += 1
+        self._channel_buffer = buf
+
+        return True
 
     def _unpickle_events(self):
         """Unpickle events (error, failure etc.) through the pipe"""
@@ -517,34 +1111,87 @@ class ParTestResult(unittest.TestResult):
             return
 
         while 1:
+            #
+            # NOTE:
+            # In some cases the test might create a segmentation fault leaving
+            # the write side of the child's pipe open. This might cause the read
+            # to wait infinitly. Therefore I check with select().
+            #
             r, w, e, = select.select([self.pr], [], [], 0)
-            if self.pr in r:
-                #
-                # This part is called when all child process have already closed their
-                # write side, therefore the read shouldnot block but throw an EOF error.
-                # NOTE:
-                # In some cases the test might create a segmentation fault leaving
-                # the write side of the child's pipe open. This might cause the read
-                # to wait infinitly. Therefore I check with select().
-                #
+            if self.pr not in r or not self._read_events():
+                break
+
+    def waitTest(self, pid):
+        """Wait for the test process like os.waitpid(), reading its events meanwhile.
+
+        The pipe is read while the test runs so that the test processes
+        don't wait for room in it.
+        """
+
+        return self.waitTests([pid])
+
+    def waitTests(self, pids, timeout=None):
+        """Wait for the first of several test processes to exit (see waitTest).
+
+        Returns (0, 0) if none exited within timeout seconds.
+        """
+
+        end_time = None
+        if timeout is not None:
+            end_time = time.time() + timeout
+
+        while 1:
+            if self.pr is not None:
                 try:
-                    event_name, event_value =  pickle.loads(os.read(self.pr, 10000))
-                    self.test_status.addEvent(event_name, event_value)
-                except EOFError:
-                    break
+                    r, w, e = select.select([self.pr], [], [], CHANNEL_POLL)
+                except select.error, e:
+                    if e[0] != errno.EINTR:
+                        raise
+                    continue
+
+                if r and not self._read_events():
+                    #
+                    # All the writers closed the pipe.
+                    #
+                    if end_time is None:
+                        return os.waitpid(pids[0], 0)
+                    self.closePipeRd()
+            elif end_time is None:
+                return os.waitpid(pids[0], 0)
             else:
-                break
+                time.sleep(CHANNEL_POLL)
+
+            #
+            # Wait only for the test processes (the grader might have
+            # other children, e.g. a background build).
+            #
+            for pid in pids:
+                cpid, status = os.waitpid(pid, os.WNOHANG)
+                if cpid:
+                    return cpid, status
+
+            if end_time is not None and time.time() >= end_time:
+                return 0, 0
+
+    def _record(self, test, outcome, err):
+        """Return the TestRecord of an error/failure of the current test"""
+
+        duration = None
+        if self._start_time is not None:
+            duration = time.time() - self._start_time
+
+        return TestRecord(test, outcome, self._exc_info_to_string(err), duration, self.exit_status)
 
     def addError(self, test, err):
         """Called when an error has occurred. 'err' is a tuple of values as
         returned by sys.exc_info().
         """
-        self._pickle_event('errors', (test, self._exc_info_to_string(err)))
+        self._pickle_event('errors', self._record(test, TestRecord.ERROR, err))
 
     def addFailure(self, test, err):
         """Called when an error has occurred. 'err' is a tuple of values as
         returned by sys.exc_info()."""
-        self._pickle_event('failures', (test, self._exc_info_to_string(err)))
+        self._pickle_event('failures', self._record(test, TestRecord.FAILURE, err))
 
     def addSuccess(self, test):
         "Called when a test has completed successfully"
@@ -622,13 +1269,37 @@ class _ParTextTestResult(ParTestResult):
 
     def startTest(self, test):
         ParTestResult.startTest(self, test)
-        if self.showAll:
+        if self.showAll and not self.concurrent:
             self.stream.write(self.getDescription(test))
             self.stream.write(" ... ")
         self.stream.flush()
 
+    def stopTest(self, test):
+        #
+        # The outcomes of tests that run at the same time are printed
+        # when each test is done, so that their lines don't mix.
+        #
+        if self.concurrent:
+            test_id = test.id()
+            if test_id in self.test_status.get_successes():
+                outcome = ('ok', '.')
+            elif [record for record in self.errors if record.test_id == test_id]:
+                outcome = ('ERROR', 'E')
+            else:
+                outcome = ('FAIL', 'F')
+
+            if self.showAll:
+                self.stream.writeln("%s ... %s" % (self.getDescription(test), outcome[0]))
+            elif self.dots:
+                self.stream.write(outcome[1])
+            self.stream.flush()
+
+        ParTestResult.stopTest(self, test)
+
     def addSuccess(self, test):
         ParTestResult.addSuccess(self, test)
+        if self.concurrent:
+            return
         if self.showAll:
             self.stream.writeln("ok")
         elif self.dots:
@@ -637,6 +1308,8 @@ class _ParTextTestResult(ParTestResult):
 
     def addError(self, test, err):
         ParTestResult.addError(self, test, err)
+        if self.concurrent:
+            return
         if self.showAll:
             self.stream.writeln("ERROR")
         elif self.dots:
@@ -645,6 +1318,8 @@ class _ParTextTestResult(ParTestResult):
 
     def addFailure(self, test, err):
         ParTestResult.addFailure(self, test, err)
+        if self.concurrent:
+            return
         if self.showAll:
             self.stream.writeln("FAIL")
         elif self.dots:
@@ -656,14 +1331,28 @@ class _ParTextTestResult(ParTestResult):
             self.stream.writeln()
         self.printErrorList('ERROR', self.errors)
         self.printErrorList('FAIL', self.failures)
+        self.printCrashes()
         self.stream.flush()
 
+    def printCrashes(self):
+        """Print the tests that were running when the machine crashed"""
+
+        crashed = self.test_status.get_running_tests()
+        for test_id in crashed:
+            self.stream.writeln(self.separator1)
+            self.stream.writeln("CRASH: %s" % test_id)
+            self.stream.writeln(self.separator2)
+            if len(crashed) > 1:
+                self.stream.writeln("The machine crashed while the test was running (with %d other tests)" % (len(crashed) - 1))
+            else:
+                self.stream.writeln("The machine crashed while the test was running")
+
     def printErrorList(self, flavour, errors):
-        for test, err in errors:
+        for record in errors:
             self.stream.writeln(self.separator1)
-            self.stream.writeln("%s: %s" % (flavour,self.getDescription(test)))
+            self.stream.writeln("%s: %s" % (flavour,self.getDescription(record)))
             self.stream.writeln(self.separator2)
-            self.stream.writeln("%s" % err)
+            self.stream.writeln("%s" % record.message)
 
     def log(self, msg):
         self.stream.writeln(msg)
@@ -758,58 +1447,110 @@ class ParTestCase(unittest.TestCase):
         return "<%s testMethod=%s>" % \
                (self.__class__, self.__testMethodName)
 
+    def isConcurrent(self):
+        """Can the test run at the same time as other tests.
+
+        Set _CONCURRENT = True on the test class (or on a test method) for
+        tests that don't share global state (e.g. kernel lists, devices)
+        with other tests. See RebootableTestSuite.
+        """
+        testMethod = getattr(self, self.__testMethodName)
+        return getattr(testMethod, '_CONCURRENT', getattr(self, '_CONCURRENT', False))
+
+    def _runChild(self, result):
+        """Run the test in the forked test process (never returns)"""
+
+        #
+        # The child processes should close the read side of the pipe.
+        #
+        result.closePipeRd()
+        
+        testMethod = getattr(self, self.__testMethodName)
+        try:
+            self.setUp()
+        except KeyboardInterrupt:
+            os._exit(-1)
+        except:
+            result.addError(self, self.__exc_info())
+            os._exit(0)
+
+        ok = 0
+        try:
+            testMethod()
+            ok = 1
+        except self.failureException, e:
+            result.addFailure(self, self.__exc_info())
+        except KeyboardInterrupt:
+            os._exit(-1)
+        except:
+            result.addError(self, self.__exc_info())
+
+        try:
+            self.tearDown()
+        except KeyboardInterrupt:
+            os._exit(-1)
+        except:
+            result.addError(self, self.__exc_info())
+            ok = 0
+
+        if ok:
+            result.addSuccess(self)
+
+        #
+        # IMPORTANT NOTE:
+        # child processses of the test processes (tpid), can throw
+        # exceptions either explicitly or implicitly through assert_
+        # and other unittest functions. This means that they reach
+        # the os._exit command below. This exit command avoids that
+        # the exceptions propogate further 'up' in the code.
+        #
+        os._exit(0)
+
+    def _checkStatus(self, result, status):
+        """Add an error if the test process didn't exit normally"""
+
+        #
+        # Check the exit status. This part is wraped in a try caluse
+        # so that I can use the addError method.
+        #    
+        try:
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) != 0:
+                if os.WEXITSTATUS(status) == 255:
+                    raise KeyboardInterrupt
+                else:
+                    raise TestError, 'The test process exited unexpectedly with code %d' % (os.WEXITSTATUS(status) - 256)
+                
+            if os.WIFSTOPPED(status):
+                sig = os.WSTOPSIG(status)
+                if sig in SIGNALS_DICT.keys():
+                    sig_str = '%s(%d)' % (SIGNALS_DICT[sig], sig)
+                else:
+                    sig_str = 'None(%d)' % sig
+                    
+                raise TestError, 'The test process stopped unexpectedly by signal %s' % sig_str
+            
+            if os.WIFSIGNALED(status):
+                sig = os.WTERMSIG(status)
+                if sig in SIGNALS_DICT.keys():
+                    sig_str = '%s(%d)' % (SIGNALS_DICT[sig], sig)
+                else:
+                    sig_str = 'None(%d)' % sig
+                    
+                raise TestError, 'The test process terminated unexpectedly by signal %s' % sig_str
+
+        except KeyboardInterrupt:
+            raise
+        except:
+            result.addError(self, self.__exc_info())
+
     def __call__(self, result=None):
         if result is None: result = self.defaultTestResult()
         result.startTest(self)
-        testMethod = getattr(self, self.__testMethodName)
         try:
             result.createPipe()
             tpid = os.fork()
             if tpid == 0:
-                #
-                # The child processes should close the read side of the pipe.
-                #
-                result.closePipeRd()
-                
-                try:
-                    self.setUp()
-                except KeyboardInterrupt:
-                    os._exit(-1)
-                except:
-                    result.addError(self, self.__exc_info())
-                    os._exit(0)
-
-                ok = 0
-                try:
-                    testMethod()
-                    ok = 1
-                except self.failureException, e:
-                    result.addFailure(self, self.__exc_info())
-                except KeyboardInterrupt:
-                    os._exit(-1)
-                except:
-                    result.addError(self, self.__exc_info())
-
-                try:
-                    self.tearDown()
-                except KeyboardInterrupt:
-                    os._exit(-1)
-                except:
-                    result.addError(self, self.__exc_info())
-                    ok = 0
-
-                if ok:
-                    result.addSuccess(self)
-
-                #
-                # IMPORTANT NOTE:
-                # child processses of the test processes (tpid), can throw
-                # exceptions either explicitly or implicitly through assert_
-                # and other unittest functions. This means that they reach
-                # the os._exit command below. This exit command avoids that
-                # the exceptions propogate further 'up' in the code.
-                #
-                os._exit(0)
+                self._runChild(result)
 
             #
             # The parent process should close the write side of the pipe.
@@ -824,7 +1565,8 @@ class ParTestCase(unittest.TestCase):
             
             try:
                 try:
-                    cpid, status = os.waitpid(tpid, 0)
+                    cpid, status = result.waitTest(tpid)
+                    result.exit_status = status
                 except KeyboardInterrupt:
                     raise
                 except:
@@ -835,39 +1577,7 @@ class ParTestCase(unittest.TestCase):
                 #
                 wd.close()
                 
-            #
-            # Check the exit status. This part is wraped in a try caluse
-            # so that I can use the addError method.
-            #    
-            try:
-                if os.WIFEXITED(status) and os.WEXITSTATUS(status) != 0:
-                    if os.WEXITSTATUS(status) == 255:
-                        raise KeyboardInterrupt
-                    else:
-                        raise TestError, 'The test process exited unexpectedly with code %d' % (os.WEXITSTATUS(status) - 256)
-                    
-                if os.WIFSTOPPED(status):
-                    sig = os.WSTOPSIG(status)
-                    if sig in SIGNALS_DICT.keys():
-                        sig_str = '%s(%d)' % (SIGNALS_DICT[sig], sig)
-                    else:
-                        sig_str = 'None(%d)' % sig
-                        
-                    raise TestError, 'The test process stopped unexpectedly by signal %s' % sig_str
-                
-                if os.WIFSIGNALED(status):
-                    sig = os.WTERMSIG(status)
-                    if sig in SIGNALS_DICT.keys():
-                        sig_str = '%s(%d)' % (SIGNALS_DICT[sig], sig)
-                    else:
-                        sig_str = 'None(%d)' % sig
-                        
-                    raise TestError, 'The test process terminated unexpectedly by signal %s' % sig_str
-
-            except KeyboardInterrupt:
-                raise
-            except:
-                result.addError(self, self.__exc_info())
+            self._checkStatus(result, status)
         finally:
             result.destroyPipe()
             
@@ -974,6 +1684,69 @@ def set_grub(custom=False):
     f_grub.close()
 
 
+def grub_default_entry():
+    """Return the kernel path, initrd path (or None) and arguments of the default grub entry"""
+    
+    f_grub = open(GRUB_PATH, 'rb')
+    grub_lines = f_grub.readlines()
+    f_grub.close()
+
+    default = 0
+    entries = []
+    for line in grub_lines:
+        temp = line.strip()
+        if re.match('default=', temp):
+            default = int(temp.split('=')[1])
+        elif re.match('title', temp):
+            entries.append({'kernel': None, 'initrd': None, 'args': ''})
+        elif entries and re.match('kernel', temp):
+            temp = temp.split()
+            entries[-1]['kernel'] = temp[1]
+            entries[-1]['args'] = ' '.join(temp[2:])
+        elif entries and re.match('initrd', temp):
+            entries[-1]['initrd'] = temp.split()[1]
+
+    entry = entries[default]
+    
+    #
+    # The paths in grub.conf are relative to the grub root which is
+    # usually the /boot partition.
+    #
+    for key in ('kernel', 'initrd'):
+        if entry[key] and os.path.exists(os.path.join('/boot', entry[key].lstrip('/'))):
+            entry[key] = os.path.join('/boot', entry[key].lstrip('/'))
+
+    return entry['kernel'], entry['initrd'], entry['args']
+
+
+def reboot(kexec=False):
+    """Reboot into the default kernel of grub.
+    
+    When kexec is set the kernel is loaded with kexec and started directly,
+    skipping the firmware and the boot loader. If kexec is not available
+    (e.g. not supported by the running kernel) a normal reboot is done.
+    """
+    
+    if kexec and os.path.exists(KEXEC_PATH):
+        try:
+            kernel, initrd, args = grub_default_entry()
+            cmd = '%s -l %s --append="%s"' % (KEXEC_PATH, kernel, args)
+            if initrd:
+                cmd += ' --initrd=%s' % initrd
+                
+            if not os.system(cmd):
+                mark_reboot()
+                os.system('sync')
+                os.system('%s -e' % KEXEC_PATH)
+        except:
+            traceback.print_exc()
+            
+        warnings.warn('Failed rebooting with kexec, doing a normal reboot')
+        
+    mark_reboot()
+    os.system('reboot')
+
+
 def init_bash(script_path):
     """Create a backup of .bash_profile and add this script to the end of .bash_profile"""
     
@@ -984,7 +1757,7 @@ def init_bash(script_path):
     f_bash.close()
         
 
-def init_sysctl():
+def init_sysctl(panic_timeout=KERNEL_PANIC_TIMEOUT):
     """Create a backup of sysctl.conf and set the kernel.panic field to reboot after panic"""
     
     shutil.copyfile(SYSCTL_PATH, SYSCTL_BAKCUP_PATH)
@@ -994,12 +1767,16 @@ def init_sysctl():
             sys.stdout.write(line)
 
     f_sysctl = open(SYSCTL_PATH, 'ab')
-    f_sysctl.write('%s=%d\n' % (KERNEL_PANIC_STR, KERNEL_PANIC_TIMEOUT))
+    f_sysctl.write('%s=%d\n' % (KERNEL_PANIC_STR, panic_timeout))
     f_sysctl.close()
         
 
-def init_autologin():
-    """Copy the autologin files"""
+def init_autologin(script_path=None):
+    """Copy the autologin files.
+
+    When script_path is set, init starts the script directly on the first
+    console (skipping the getty, login and .bash_profile).
+    """
     
     shutil.copyfile('/etc/inittab', os.path.join(TEMP_FILES_FOLDER, 'inittab'))
     shutil.copyfile('/etc/login.defs', os.path.join(TEMP_FILES_FOLDER, 'login.defs'))
@@ -1010,27 +1787,104 @@ def init_autologin():
     shutil.copyfile(os.path.join(autologin_path, 'login.defs_autologin'), '/etc/login.defs')
     
     for line in fileinput.input('/etc/inittab', inplace=1):
+        if script_path and line.startswith('1:'):
+            line = "1:2345:once:/bin/sh -c '. /etc/profile; cd; exec %s' < /dev/tty1 > /dev/tty1 2>&1\n" % script_path
         sys.stdout.write(line.replace(INITTAB_TEMPLATE, autologin_path))
 
 
-def init_grader(submissions_folder, test_path, break_flag, kernel_test):
-    """Prepare the system for the grader boot loop"""
+def init_grader(submissions_folder, test_path, break_flag, kernel_test, prebuild=False, pipeline_nice=None, kexec=False, always_reboot=False, fast=False, incremental=False, shared=None, reuse=False):
+    """Prepare the system for the grader boot loop.
+
+    In fast mode the grader is started directly by init and a panic
+    reboots the machine after FAST_PANIC_TIMEOUT seconds.
+    In incremental mode only submissions that were not graded with this
+    test file are queued, and their results are merged into the grades
+    and stats files of the last run.
+    With reuse, a submission with the same sources as one already graded
+    with this test gets a copy of its results (see reuse_results).
+    Submissions that fail the checks of validate_submissions get a zero
+    grade and are not queued.
+    """
     
     if os.path.exists(TEMP_FILES_FOLDER):
         raise Exception('Temporary grader files remain from previous run. This might indicate a bad exit.\nIt is suggested to run the script with -r flag.')
 
     os.mkdir(TEMP_FILES_FOLDER)
+    init_start_time = time.time()
 
     script_path = os.path.abspath(sys.argv[0])
     
     init_bash(script_path)
-    init_sysctl()
-    init_autologin()
+    if fast:
+        init_sysctl(FAST_PANIC_TIMEOUT)
+        init_autologin(script_path)
+    else:
+        init_sysctl()
+        init_autologin()
 
     if kernel_test:
         set_grub(custom=False)
     
     paths = submission_paths(submissions_folder)
+
+    from metrics_utils import set_metrics_path
+    set_metrics_path(paths['metrics_path'])
+
+    #
+    # Create a list of submissions to run
+    #
+    sub_list = glob.glob(os.path.join(submissions_folder, '*.[zZ][iI][pP]'))
+
+    if incremental:
+        from index_utils import pending_submissions, merge_target
+        results_folder = os.path.dirname(paths['results_path'])
+        sub_list = pending_submissions(sub_list, results_folder, test_path)
+        target = merge_target(results_folder, test_path)
+        if target:
+            os.remove(paths['grades_path'])
+            paths['grades_path'], paths['stats_path'] = target
+
+    if shared:
+        #
+        # All the workers of a shared run take submissions from the same
+        # leases folder and write to the same grades/stats files.
+        #
+        results_folder = os.path.dirname(paths['results_path'])
+        os.remove(paths['grades_path'])
+        paths['grades_path'] = os.path.join(results_folder, 'grades_%s.txt' % shared)
+        paths['stats_path'] = os.path.join(results_folder, 'stats_%s.txt' % shared)
+        paths['lease_folder'] = os.path.join(results_folder, 'leases_%s' % shared)
+        worker_id = new_worker_id()
+        try:
+            fd = os.open(paths['grades_path'], os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            os.write(fd, 'GRADE\tID\n')
+            os.close(fd)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.makedirs(paths['lease_folder'])
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    #
+    # Extract and check all the submissions in parallel. The broken
+    # submissions get a zero grade now and never enter the boot loop.
+    #
+    from validate_utils import required_files, validate_submissions, reject_submissions
+    validate_start_time = time.time()
+    test_module = import_path(test_path)
+    kernel_path = None
+    if kernel_test and getattr(test_module, '__syntax_check__', False):
+        kernel_path = CUSTOM_KERNEL_PATH
+    broken = validate_submissions(sub_list, required_files(test_module), kernel_path)
+    if shared:
+        reject_submissions(broken, test_path, paths, incremental, (paths['lease_folder'], worker_id))
+    else:
+        reject_submissions(broken, test_path, paths, incremental)
+    sub_list = [submission for submission in sub_list if not broken.has_key(submission)]
+    record_phase('validate', validate_start_time)
     
     #
     # Save the configuration of the grader
@@ -1043,23 +1897,26 @@ def init_grader(submissions_folder, test_path, break_flag, kernel_test):
     config.set('paths', 'results_path', paths['results_path'])
     config.set('paths', 'grades_path', paths['grades_path'])
     config.set('paths', 'stats_path', paths['stats_path'])
+    config.set('paths', 'cache_stats_path', paths['cache_stats_path'])
+    config.set('paths', 'metrics_path', paths['metrics_path'])
     config.set('paths', 'temp_folder', paths['temp_folder'])
+    if shared:
+        config.set('paths', 'lease_folder', paths['lease_folder'])
     config.add_section('flags')
     config.set('flags', 'break_flag', break_flag)
+    config.set('flags', 'kexec', int(kexec))
+    config.set('flags', 'always_reboot', int(always_reboot))
+    config.set('flags', 'fast', int(fast))
+    config.set('flags', 'incremental', int(incremental))
+    config.set('flags', 'reuse', int(reuse))
+    if pipeline_nice is not None:
+        config.set('flags', 'pipeline_nice', pipeline_nice)
+    if shared:
+        config.set('flags', 'worker_id', worker_id)
     config.write(f)
     f.close()
 
-    #
-    # Create a list of submissions to run
-    #
-    sub_list = glob.glob(os.path.join(submissions_folder, '*.[zZ][iI][pP]'))
-    sub_state = {
-        'list': sub_list,
-        'index': 0
-    }
-    f_sub = open(SUBMISSION_STATE_PATH, 'wb')
-    pickle.dump(sub_state, f_sub)
-    f_sub.close()
+    init_state(sub_list)
 
     #
     # Make a copy of the custom kernel
@@ -1067,6 +1924,24 @@ def init_grader(submissions_folder, test_path, break_flag, kernel_test):
     if kernel_test:
         shutil.os.rename(CUSTOM_KERNEL_PATH, CUSTOM_KERNEL_BAKCUP_PATH)
 
+    #
+    # Build the custom kernel once. The submissions are built incrementally
+    # on top of it.
+    #
+    if kernel_test:
+        from build_utils import build_reference_tree
+        build_reference_tree()
+
+    #
+    # Build the kernels of all submissions before starting the boot loop.
+    # The boot loop then only installs the ready artifacts.
+    #
+    if kernel_test and prebuild:
+        from build_utils import prebuild_submissions
+        prebuild_submissions(sub_list)
+
+    record_phase('init', init_start_time)
+
 
 def end_bash():
     """Restore the backup of .bash_profile."""
@@ -1099,39 +1974,35 @@ def end_autologin():
         warnings.warn('Missing login.defs backup')
     
 
+def end_kernel():
+    """Restore the backup of the custom kernel"""
+
+    if os.path.exists(CUSTOM_KERNEL_BAKCUP_PATH):
+        if os.path.exists(CUSTOM_KERNEL_PATH):
+            shutil.rmtree(CUSTOM_KERNEL_PATH)
+        shutil.os.rename(CUSTOM_KERNEL_BAKCUP_PATH, CUSTOM_KERNEL_PATH)
+
+
 def end_grader():
     """Remove the grader loop from the system"""
     
     end_bash()
     end_sysctl()
     end_autologin()
-
-    if os.path.exists(CUSTOM_KERNEL_BAKCUP_PATH):
-        if os.path.exists(CUSTOM_KERNEL_PATH):
-            shutil.rmtree(CUSTOM_KERNEL_PATH)
-        shutil.os.rename(CUSTOM_KERNEL_BAKCUP_PATH, CUSTOM_KERNEL_PATH)
+    end_kernel()
 
     if os.path.exists(TEMP_FILES_FOLDER):
         shutil.rmtree(TEMP_FILES_FOLDER, ignore_errors=True)
 
 
 def next_submission(submissions_folder):
-    """Get the next submission"""
+    """Get the next submission (it is claimed in the state store).
 
-    f_sub = open(SUBMISSION_STATE_PATH, 'rb')
-    sub_state = pickle.load(f_sub)
-    f_sub.close()
-
-    if len(sub_state['list']) <= sub_state['index']:
-        submission = None
-    else:
-        submission = sub_state['list'][sub_state['index']]
-
-        f_sub = open(SUBMISSION_STATE_PATH, 'wb')
-        sub_state['index'] = sub_state['index']+1
-        pickle.dump(sub_state, f_sub)
-        f_sub.close()
-
-    return submission
+    In a shared run, also take its lease so that no other worker grades it.
+    """
 
+    if shared_run():
+        lease_folder, worker = shared_run()
+        return claim_shared(lease_folder, worker)
 
+    return claim_submission()
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+from utils import get_submitters, add_failure
+from index_utils import index_submission, remove_previous_results
+from lease_utils import acquire_lease, is_done, mark_done, lock_results, unlock_results
+from zip_utils import extract_zip, extracted_folder, save_extract_info, remove_extracted
+from build_utils import run_pool
+import shutil
+import time
+import re
+import glob
+import os
+
+__all__ = [
+    'required_files',
+    'validate_submissions',
+    'reject_submissions'
+    ]
+
+VALIDATE_REASON_NAME = 'reason'
+
+
+def required_files(test_module):
+    """The files (glob patterns) that every submission of the test must include.
+
+    Set by __required_files__ in the test module, the __header_file__ used
+    by compile_extension is always required.
+    """
+
+    required = list(getattr(test_module, '__required_files__', []))
+    if hasattr(test_module, '__header_file__'):
+        required.append(test_module.__header_file__)
+
+    return required
+
+
+def _makefile_objects(makefile_path):
+    """The object files named in a kernel Makefile"""
+
+    f = open(makefile_path, 'rb')
+    objects = re.findall(r'([\w-]+\.o)\b', f.read())
+    f.close()
+
+    return objects
+
+
+def _syntax_errors(source_folder, kernel_path):
+    """Check the kernel sources of a submission with gcc -fsyntax-only.
+
+    Only the C files that the Makefile of their folder builds (the
+    submission's Makefile, or the one of the kernel tree) are checked,
+    with the include flags of a 2.4 kernel build. Returns a list of errors.
+    """
+
+    def func(arg, dirname, fnames):
+        rel_dir = dirname[len(source_folder):].lstrip(os.sep)
+        makefile_path = os.path.join(dirname, 'Makefile')
+        if not os.path.exists(makefile_path):
+            makefile_path = os.path.join(kernel_path, rel_dir, 'Makefile')
+        if not rel_dir or not os.path.exists(makefile_path):
+            return
+        objects = _makefile_objects(makefile_path)
+        for name in fnames:
+            if name.endswith('.c') and name[:-2] + '.o' in objects:
+                arg.append(os.path.join(rel_dir, name))
+
+    sources = []
+    os.path.walk(source_folder, func, sources)
+
+    errors = []
+    for rel_path in sources:
+        cmd = 'gcc -fsyntax-only -D__KERNEL__ -nostdinc -iwithprefix include -I"%s" -I"%s" -I"%s" "%s" 2>&1' % (
+            os.path.join(source_folder, 'include'),
+            os.path.join(kernel_path, 'include'),
+            os.path.join(kernel_path, os.path.dirname(rel_path)),
+            os.path.join(source_folder, rel_path)
+            )
+        f = os.popen(cmd)
+        output = f.read()
+        if f.close():
+            lines = [line for line in output.splitlines() if line.find('error') != -1]
+            errors.append(lines and lines[0] or '%s: gcc failed' % rel_path)
+
+    return errors
+
+
+def _validate_worker(submission, required, kernel_path):
+    """Extract a submission and check it. Returns 1 if the submission is broken"""
+
+    dest_folder = extracted_folder(submission)
+    if os.path.exists(dest_folder):
+        shutil.rmtree(dest_folder)
+    os.makedirs(dest_folder)
+
+    try:
+        start_time = time.time()
+        files, size, skipped = extract_zip(submission, dest_folder)
+        save_extract_info(submission, files, size, time.time() - start_time, skipped)
+        get_submitters(dest_folder)
+
+        missing = [pattern for pattern in required if not glob.glob(os.path.join(dest_folder, pattern))]
+        if missing:
+            raise Exception('Missing required files: %s' % ' '.join(missing))
+
+        if kernel_path:
+            errors = _syntax_errors(dest_folder, kernel_path)
+            if errors:
+                raise Exception('Syntax errors in the kernel sources: %s' % '; '.join(errors))
+    except Exception, e:
+        #
+        # Keep only the submitters file (for the zero grade) and the
+        # reason (the worker is a separate process).
+        #
+        for name in os.listdir(dest_folder):
+            path = os.path.join(dest_folder, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.lower() != 'submitters.txt':
+                os.remove(path)
+        f = open(os.path.join(dest_folder, VALIDATE_REASON_NAME), 'wb')
+        f.write(str(e))
+        f.close()
+        return 1
+
+    return 0
+
+
+def validate_submissions(submissions, required=(), kernel_path=None, workers=None):
+    """Extract and check all the submissions in parallel.
+
+    A submission is broken if it can't be extracted, has no submitters
+    file, misses a required file or (when kernel_path is given) its
+    kernel sources don't compile. The good submissions stay extracted
+    (see zip_utils.extracted_folder). Returns a dict that maps each broken
+    submission to the reason (see reject_submissions).
+    """
+
+    def func(submission, slot):
+        return _validate_worker(submission, required, kernel_path)
+
+    statuses = run_pool(submissions, func, workers)
+
+    broken = {}
+    for submission in submissions:
+        if not statuses.get(submission):
+            continue
+
+        #
+        # A worker that crashed leaves no reason, its submission is
+        # extracted again in the boot loop.
+        #
+        reason_path = os.path.join(extracted_folder(submission), VALIDATE_REASON_NAME)
+        if os.path.exists(reason_path):
+            f = open(reason_path, 'rb')
+            broken[submission] = f.read()
+            f.close()
+        else:
+            remove_extracted(submission)
+
+    return broken
+
+
+def reject_submissions(broken, test_path, paths, incremental=False, shared=None):
+    """Give the broken submissions a zero grade, with the reason in the results file.
+
+    shared is the (lease folder, worker id) of a shared run, where only
+    the worker that takes the lease of a submission grades it.
+    """
+
+    submissions = broken.keys()
+    submissions.sort()
+
+    f_results = open(paths['results_path'], 'ab')
+    for submission in submissions:
+        if shared:
+            lease_folder, worker = shared
+            if is_done(lease_folder, submission) or not acquire_lease(lease_folder, submission, worker):
+                continue
+            lock_results(lease_folder, worker)
+
+        f_results.write('\n' + 70*'#' + '\nProcessing submission %s\n' % submission)
+        f_results.write('Rejected before the boot loop: %s\n' % broken[submission])
+        try:
+            try:
+                submitters = get_submitters(extracted_folder(submission))
+                if incremental:
+                    remove_previous_results(submitters, paths['grades_path'], paths['stats_path'])
+                add_failure(submitters, paths['grades_path'], paths['stats_path'])
+                index_submission(submission, test_path, paths['grades_path'], paths['stats_path'], submitters)
+            except Exception, e:
+                f_results.write('No grade: %s\n' % e)
+        finally:
+            if shared:
+                unlock_results(lease_folder, worker)
+                mark_done(lease_folder, submission, worker)
+
+        remove_extracted(submission)
+    f_results.close()
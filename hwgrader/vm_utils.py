@@ -0,0 +1,702 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+from utils import import_path, get_submitters, add_grade, add_stats, add_failure, \
+     ParTextTestRunner, TestStatus, end_kernel, TEST_JOURNAL_HEADER, TEST_JOURNAL_HEADER_SIZE, \
+     TEST_JOURNAL_SUFFIX
+from metrics_utils import record_phase, set_metrics_submission
+from build_utils import run_pool, cpu_count, artifact_folder, artifact_status, \
+     build_reference_tree, prebuild_submissions, ARTIFACT_SOURCE_FOLDER
+import traceback
+import binascii
+import termios
+import struct
+import socket
+import glob
+import signal
+import shutil
+import time
+import sys
+import os
+
+__all__ = [
+    'VMTestResult',
+    'init_vm_grader',
+    'end_vm_grader',
+    'prepare_vm_job',
+    'qemu_command',
+    'create_vm_snapshot',
+    'snapshot_command',
+    'uml_command',
+    'run_vm',
+    'read_vm_results',
+    'grade_in_vms',
+    'run_guest_job',
+    'wait_guest_job'
+    ]
+
+VM_RESULTS_BEGIN = 'HWGRADER-RESULTS-BEGIN'
+VM_RESULTS_END = 'HWGRADER-RESULTS-END'
+VM_TEST_TAG = 'HWGRADER-TEST'
+VM_STATUS_TAG = 'HWGRADER-STATUS'
+VM_SUITE_TAG = 'HWGRADER-SUITE'
+VM_CONSOLE_NAME = 'console.log'
+VM_RESULTS_NAME = 'results.log'
+VM_TIME_NAME = 'time'
+VM_READY_TAG = 'HWGRADER-READY'
+VM_WAIT_NAME = 'wait'
+VM_SNAPSHOT_NAME = 'hwgrader_ready'
+VM_MONITOR_NAME = 'monitor.sock'
+VM_STATUS_NAME = 'test_status'
+VM_SUITE_NAME = 'suite'
+VM_RESTARTS_NAME = 'restarts'
+
+#
+# The kernel images of the artifacts (bzImage for QEMU, linux for User-Mode Linux).
+#
+VM_KERNEL_NAMES = ('bzImage', 'linux')
+
+#
+# Files of a job that are removed when the virtual machine ends (the disk
+# images that hold the writes of the guest).
+#
+VM_DISPOSABLE_EXTS = ('.qcow2', '.cow')
+
+
+class VMTestResult(object):
+    """The test results reported by a grader running in a virtual machine.
+
+    Has the attributes used by add_grade/add_stats.
+    """
+
+    def __init__(self, tests_stats):
+        self.testsStats = tests_stats
+        self.testsRun = len(tests_stats)
+        self.successes = len([k for k in tests_stats.values() if k])
+
+
+class _SerialTestStatus(TestStatus):
+    """The test status of a guest, that also sends its journal to the host.
+
+    Each journal record is written to the results device as a line with
+    VM_STATUS_TAG and the hex of the record. When the guest crashes the
+    host keeps the records in the job folder and restarts the guest, which
+    resumes after the tests that were running (see _vm_worker).
+    """
+
+    def __init__(self, path, new, f_dev):
+        self._f_dev = f_dev
+        TestStatus.__init__(self, path, new)
+
+    def _write(self, op, payload=''):
+        TestStatus._write(self, op, payload)
+        record = struct.pack(TEST_JOURNAL_HEADER, op, len(payload)) + payload
+        self._f_dev.write('%s\t%s\n' % (VM_STATUS_TAG, binascii.hexlify(record)))
+
+    def sync(self):
+        """Also wait until the records were sent on the serial line (a test might crash the guest)"""
+
+        TestStatus.sync(self)
+        try:
+            termios.tcdrain(self._f_dev.fileno())
+        except termios.error:
+            pass
+
+
+def init_vm_grader():
+    """Prepare the reference kernel for building the submissions"""
+
+    if os.path.exists(TEMP_FILES_FOLDER):
+        raise Exception('Temporary grader files remain from previous run. This might indicate a bad exit.\nIt is suggested to run the script with -r flag.')
+
+    os.mkdir(TEMP_FILES_FOLDER)
+    shutil.os.rename(CUSTOM_KERNEL_PATH, CUSTOM_KERNEL_BAKCUP_PATH)
+    build_reference_tree()
+
+
+def end_vm_grader():
+    """Restore the custom kernel and remove the temporary files"""
+
+    end_kernel()
+
+    if os.path.exists(TEMP_FILES_FOLDER):
+        shutil.rmtree(TEMP_FILES_FOLDER, ignore_errors=True)
+
+
+def vm_job_folder(submission):
+    """The folder shared with the virtual machine that grades a submission"""
+
+    name = os.path.splitext(os.path.basename(submission))[0]
+
+    return os.path.join(VM_JOBS_FOLDER, name)
+
+
+def prepare_vm_job(submission, test_path):
+    """Prepare the folder that is shared with the virtual machine.
+
+    The job includes the sources of the submission, the test folder
+    and the kernel (and modules) of the submission.
+    """
+
+    job_folder = vm_job_folder(submission)
+    if os.path.exists(job_folder):
+        shutil.rmtree(job_folder)
+    os.makedirs(job_folder)
+
+    for name in (VM_CONSOLE_NAME, VM_RESULTS_NAME, VM_RESTARTS_NAME):
+        for path in glob.glob(job_folder + '.' + name) + glob.glob(job_folder + '.' + name + '.*'):
+            os.remove(path)
+
+    dest_folder = artifact_folder(submission)
+    shutil.copytree(os.path.join(dest_folder, ARTIFACT_SOURCE_FOLDER), os.path.join(job_folder, 'submission'))
+    shutil.copytree(os.path.dirname(test_path), os.path.join(job_folder, 'tests'))
+    shutil.copytree(os.path.join(dest_folder, 'lib'), os.path.join(job_folder, 'lib'))
+    for name in VM_KERNEL_NAMES:
+        if os.path.exists(os.path.join(dest_folder, name)):
+            shutil.copy2(os.path.join(dest_folder, name), job_folder)
+
+    f = open(os.path.join(job_folder, 'test_name'), 'wb')
+    f.write('%s\n' % os.path.basename(test_path))
+    f.close()
+
+    return job_folder
+
+
+def _qemu_devices(job_folder):
+    """The devices of a QEMU guest (these must be the same when restoring a snapshot).
+
+    The job folder is exposed as a read only FAT disk. The console and
+    the results are written to two serial ports (the files are kept
+    outside of the job folder).
+    """
+
+    return [
+        '-m', str(VM_MEMORY),
+        '-nographic',
+        '-no-reboot',
+        '-hdb', 'fat:%s' % job_folder,
+        '-serial', 'file:%s' % (job_folder + '.' + VM_CONSOLE_NAME),
+        '-serial', 'file:%s' % (job_folder + '.' + VM_RESULTS_NAME)
+        ]
+
+
+def qemu_command(job_folder, root_image):
+    """The command that boots the kernel of a job in a QEMU guest.
+
+    The root image is shared by all guests (-snapshot discards the writes
+    of each guest).
+    """
+
+    return [QEMU_PATH] + _qemu_devices(job_folder) + [
+        '-snapshot',
+        '-hda', root_image,
+        '-kernel', os.path.join(job_folder, 'bzImage'),
+        '-append', '%s %s=1' % (VM_KERNEL_ARGS, VM_JOB_ARG)
+        ]
+
+
+def _monitor_command(monitor_path, commands):
+    """Send commands to the monitor (unix socket) of a running QEMU"""
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(monitor_path)
+    for command in commands:
+        s.send(command + '\n')
+
+    #
+    # Read until QEMU closes the monitor (the last command is quit).
+    #
+    while s.recv(1024):
+        pass
+    s.close()
+
+
+def create_vm_snapshot(root_image, snapshot_image=VM_SNAPSHOT_PATH, timeout=VM_TIMEOUT):
+    """Boot the guest once and save a snapshot at the point where the grader starts.
+
+    The guest boots its own (normal) kernel. guest_grader.py finds the
+    wait marker on the job disk, reports that it is ready and waits for a
+    job. The snapshot is saved in a qcow2 overlay of the root image.
+    """
+
+    if os.path.exists(snapshot_image):
+        os.remove(snapshot_image)
+    if os.system('%s create -f qcow2 -b %s %s > /dev/null' % (QEMU_IMG_PATH, root_image, snapshot_image)):
+        raise Exception('Failed creating the snapshot image')
+
+    job_folder = os.path.join(VM_JOBS_FOLDER, VM_SNAPSHOT_NAME)
+    if os.path.exists(job_folder):
+        shutil.rmtree(job_folder)
+    os.makedirs(job_folder)
+    open(os.path.join(job_folder, VM_WAIT_NAME), 'wb').close()
+
+    results_path = job_folder + '.' + VM_RESULTS_NAME
+    monitor_path = job_folder + '.' + VM_MONITOR_NAME
+    for path in (results_path, monitor_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    cmd = [QEMU_PATH] + _qemu_devices(job_folder) + [
+        '-hda', snapshot_image,
+        '-monitor', 'unix:%s,server,nowait' % monitor_path
+        ]
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.execvp(cmd[0], cmd)
+        except:
+            traceback.print_exc()
+        os._exit(1)
+
+    start_time = time.time()
+    while time.time() - start_time < timeout:
+        if os.path.exists(results_path) and open(results_path, 'rb').read().find(VM_READY_TAG) >= 0:
+            break
+        time.sleep(1)
+    else:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise Exception('The guest did not reach the grader, see %s' % (job_folder + '.' + VM_CONSOLE_NAME))
+
+    _monitor_command(monitor_path, ['savevm %s' % VM_SNAPSHOT_NAME, 'quit'])
+    os.waitpid(pid, 0)
+
+
+def snapshot_command(job_folder, snapshot_image):
+    """The command that restores the snapshot of the guest for a job.
+
+    Each guest gets its own copy of the snapshot image (the copy is small,
+    it only holds the changes to the root image and the memory of the guest).
+    The guest then starts the kernel of the job with kexec.
+    """
+
+    image_copy = job_folder + '.qcow2'
+    shutil.copyfile(snapshot_image, image_copy)
+
+    return [QEMU_PATH] + _qemu_devices(job_folder) + [
+        '-hda', image_copy,
+        '-loadvm', VM_SNAPSHOT_NAME
+        ]
+
+
+def uml_command(job_folder, root_image):
+    """The command that runs the User-Mode Linux kernel of a job as a host process.
+
+    The writes of the guest go to a copy-on-write file of the job. The job
+    folder is mounted in the guest with hostfs and the results are written
+    to the second serial line of the guest, which is connected to a file
+    (fd 3 of the process).
+    """
+
+    cmd = [
+        os.path.join(job_folder, 'linux'),
+        'ubd0=%s.cow,%s' % (job_folder, root_image),
+        'root=/dev/ubd0',
+        'mem=%dM' % VM_MEMORY,
+        'con=null',
+        'con0=fd:0,fd:1',
+        'ssl=null',
+        'ssl1=fd:3',
+        '%s=1' % VM_JOB_ARG,
+        '%s=%s' % (UML_HOSTFS_ARG, job_folder)
+        ]
+
+    return ['sh', '-c', 'exec "$0" "$@" 3>>%s' % (job_folder + '.' + VM_RESULTS_NAME)] + cmd
+
+
+def run_vm(cmd, log_path, timeout=VM_TIMEOUT):
+    """Run a virtual machine and wait for it to end (or kill it after timeout).
+
+    The virtual machine runs in its own process group (User-Mode Linux
+    runs as several host processes), the whole group is killed.
+    Returns the exit status (None if killed) and the wall time.
+    """
+
+    start_time = time.time()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgrp()
+            fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+            os.dup2(os.open('/dev/null', os.O_RDONLY), sys.stdin.fileno())
+            os.dup2(fd, sys.stdout.fileno())
+            os.dup2(fd, sys.stderr.fileno())
+            os.execvp(cmd[0], cmd)
+        except:
+            traceback.print_exc()
+        os._exit(1)
+
+    status = None
+    while time.time() - start_time < timeout:
+        cpid, cstatus = os.waitpid(pid, os.WNOHANG)
+        if cpid == pid:
+            status = cstatus
+            break
+        time.sleep(1)
+    else:
+        os.kill(-pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    #
+    # Remove processes of the group that remain after the main one exits.
+    #
+    try:
+        os.kill(-pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+    return status, time.time() - start_time
+
+
+def read_vm_results(results_path):
+    """Read the results written by the guest grader.
+
+    Returns the text of the results and a VMTestResult, or None if
+    the results are not complete (the guest crashed or timed out).
+    """
+
+    if not os.path.exists(results_path):
+        return '', None
+
+    f = open(results_path, 'rb')
+    lines = f.readlines()
+    f.close()
+
+    text_lines = []
+    tests_stats = {}
+    started = False
+    for line in lines:
+        line = line.replace('\r', '')
+        if line.strip() == VM_RESULTS_BEGIN:
+            started = True
+            text_lines = []
+            tests_stats = {}
+        elif not started:
+            continue
+        elif line.strip() == VM_RESULTS_END:
+            return ''.join(text_lines), VMTestResult(tests_stats)
+        elif line.startswith(VM_TEST_TAG + '\t'):
+            temp = line.strip().split('\t')
+            tests_stats[temp[1]] = temp[2] == '1'
+        else:
+            text_lines.append(line)
+
+    return ''.join(text_lines), None
+
+
+def read_vm_status(results_path):
+    """Read the test status records and the ids of the suite sent by the guest grader.
+
+    Returns the journal records (see _SerialTestStatus) and the test ids.
+    A record cut by a crash is dropped.
+    """
+
+    if not os.path.exists(results_path):
+        return [], []
+
+    f = open(results_path, 'rb')
+    lines = f.readlines()
+    f.close()
+
+    records = []
+    suite_ids = []
+    for line in lines:
+        temp = line.replace('\r', '').rstrip('\n').split('\t')
+        if len(temp) != 2:
+            continue
+        if temp[0] == VM_SUITE_TAG:
+            suite_ids.append(temp[1])
+        elif temp[0] == VM_STATUS_TAG:
+            try:
+                record = binascii.unhexlify(temp[1])
+            except (TypeError, binascii.Error):
+                continue
+            if len(record) < TEST_JOURNAL_HEADER_SIZE:
+                continue
+            op, size = struct.unpack(TEST_JOURNAL_HEADER, record[:TEST_JOURNAL_HEADER_SIZE])
+            if len(record) == TEST_JOURNAL_HEADER_SIZE + size:
+                records.append(record)
+
+    return records, suite_ids
+
+
+def _save_guest_status(job_folder, records, suite_ids):
+    """Keep the status sent by a guest that crashed in its job folder.
+
+    The records are appended to the journal of the test status of the job
+    (the guest that is restarted loads it). Returns True if a test was
+    started since the last restart (so the restarted guest skips it).
+    """
+
+    status_path = os.path.join(job_folder, VM_STATUS_NAME)
+    if not os.path.exists(status_path):
+        TestStatus(status_path, new=True).close()
+
+    f = open(status_path + TEST_JOURNAL_SUFFIX, 'ab')
+    f.write(''.join(records))
+    f.close()
+
+    if suite_ids:
+        f = open(os.path.join(job_folder, VM_SUITE_NAME), 'wb')
+        f.write(''.join([test_id + '\n' for test_id in suite_ids]))
+        f.close()
+
+    return len([record for record in records if record[:1] == 'S']) > 0
+
+
+def _guest_status_result(job_folder):
+    """The results of a guest that crashed too many times, from the status kept in its job folder.
+
+    The tests that were running when the guest crashed and the tests that
+    were never run are failures. Returns None if no test was started.
+    """
+
+    status_path = os.path.join(job_folder, VM_STATUS_NAME)
+    if not os.path.exists(status_path):
+        return None
+
+    test_status = TestStatus(status_path)
+    test_status.close()
+    if not test_status.get_tests_ids():
+        return None
+
+    tests_stats = {}
+    suite_path = os.path.join(job_folder, VM_SUITE_NAME)
+    if os.path.exists(suite_path):
+        for line in open(suite_path, 'rb').readlines():
+            tests_stats[line.strip()] = False
+    for test_id in test_status.get_tests_ids():
+        tests_stats[test_id] = False
+    for test_id in test_status.get_successes():
+        tests_stats[test_id] = True
+
+    return VMTestResult(tests_stats)
+
+
+def _vm_worker(submission, slot, test_path, root_image, vm_command):
+    """Grade a single submission in a virtual machine.
+
+    A guest that crashes or times out after starting a test is restarted
+    (up to VM_MAX_RESTARTS times) and resumes after the tests that were
+    running. The console and results of each crashed run are kept with the
+    number of the restart as a suffix.
+    """
+
+    set_metrics_submission(submission)
+    start_time = time.time()
+
+    job_folder = prepare_vm_job(submission, test_path)
+    results_path = job_folder + '.' + VM_RESULTS_NAME
+
+    total_time = 0
+    restarts = 0
+    while 1:
+        status, wall_time = run_vm(vm_command(job_folder, root_image), job_folder + '.log')
+        total_time += wall_time
+
+        for ext in VM_DISPOSABLE_EXTS:
+            if os.path.exists(job_folder + ext):
+                os.remove(job_folder + ext)
+
+        if read_vm_results(results_path)[1] is not None:
+            break
+
+        records, suite_ids = read_vm_status(results_path)
+        if not _save_guest_status(job_folder, records, suite_ids) or restarts == VM_MAX_RESTARTS:
+            break
+
+        restarts += 1
+        for name in (VM_CONSOLE_NAME, VM_RESULTS_NAME):
+            if os.path.exists(job_folder + '.' + name):
+                os.rename(job_folder + '.' + name, '%s.%s.%d' % (job_folder, name, restarts))
+
+    f = open(job_folder + '.' + VM_TIME_NAME, 'wb')
+    f.write('%.3f\n' % total_time)
+    f.close()
+
+    f = open(job_folder + '.' + VM_RESTARTS_NAME, 'wb')
+    f.write('%d\n' % restarts)
+    f.close()
+
+    record_phase('vm_run', start_time)
+
+    return status != 0
+
+
+def grade_in_vms(submissions, test_path, root_image, paths, workers=None, vm_command=qemu_command, build_script=BUILD_KERNEL_SCRIPT):
+    """Grade submissions concurrently, each in its own virtual machine.
+
+    The kernels of the submissions are prebuilt, then up to workers virtual
+    machines run the test suite. The results of each guest are merged into
+    the results/grades/stats files when it ends. A guest that crashes or
+    times out is restarted after the running tests (see _vm_worker), the
+    crashed and unrun tests are failures. build_script builds the kernels
+    (use BUILD_UML_SCRIPT with uml_command).
+    """
+
+    if not workers:
+        workers = cpu_count()
+
+    f_results = open(paths['results_path'], 'ab', buffering=0)
+
+    prebuild_submissions(submissions, workers, build_script)
+
+    ready = []
+    for submission in submissions:
+        if artifact_status(submission) == 0:
+            ready.append(submission)
+            continue
+
+        f_results.write('\n' + 70*'#' + '\nProcessing submission %s\n' % submission)
+        f_results.write('Failed building the submission, see %s\n' % artifact_folder(submission))
+        try:
+            add_failure(get_submitters(os.path.join(artifact_folder(submission), ARTIFACT_SOURCE_FOLDER)), paths['grades_path'], paths['stats_path'])
+        except:
+            traceback.print_exc(file=f_results)
+
+    def func(submission, slot):
+        return _vm_worker(submission, slot, test_path, root_image, vm_command)
+
+    def done(submission, status):
+        job_folder = vm_job_folder(submission)
+        f_results.write('\n' + 70*'#' + '\nProcessing submission %s\n' % submission)
+
+        try:
+            submitters = get_submitters(os.path.join(job_folder, 'submission'))
+            f_results.write("\nSubmission by %s\n\n" % ' & '.join(submitters))
+
+            text, test_result = read_vm_results(job_folder + '.' + VM_RESULTS_NAME)
+            f_results.write(text)
+
+            if os.path.exists(job_folder + '.' + VM_TIME_NAME):
+                f_results.write('Virtual machine wall time: %s seconds\n' % open(job_folder + '.' + VM_TIME_NAME, 'rb').read().strip())
+
+            restarts_path = job_folder + '.' + VM_RESTARTS_NAME
+            if os.path.exists(restarts_path):
+                restarts = int(open(restarts_path, 'rb').read())
+                if restarts:
+                    f_results.write('The virtual machine crashed or timed out %d times and was restarted after the running tests, see %s.*\n' % \
+                                    (restarts, job_folder + '.' + VM_CONSOLE_NAME))
+
+            if test_result is None:
+                f_results.write('The virtual machine crashed or timed out, see %s\n' % (job_folder + '.' + VM_CONSOLE_NAME))
+                test_result = _guest_status_result(job_folder)
+
+            if test_result is None:
+                add_failure(submitters, paths['grades_path'], paths['stats_path'])
+            else:
+                add_grade(submitters, test_result, paths['grades_path'])
+                add_stats(submitters, test_result, paths['stats_path'])
+        except:
+            traceback.print_exc(file=f_results)
+
+    if not os.path.exists(VM_JOBS_FOLDER):
+        os.makedirs(VM_JOBS_FOLDER)
+
+    run_pool(ready, func, workers, done)
+
+    f_results.write('\n\nFinished checking all submissions\n')
+    f_results.close()
+
+
+def wait_guest_job(results_device=VM_RESULTS_DEVICE, poll_interval=0.5):
+    """Wait (inside the guest) for a job and start its kernel with kexec.
+
+    Called when the job disk has the wait marker. The host saves a snapshot
+    of the guest after the ready tag is written and restores it with the
+    job disk of a submission. The job disk is polled until it holds a job.
+    """
+
+    f_dev = open(results_device, 'wb')
+    f_dev.write('%s\n' % VM_READY_TAG)
+    f_dev.close()
+
+    while 1:
+        time.sleep(poll_interval)
+
+        #
+        # Drop the cached blocks of the job disk, it changes when the
+        # snapshot is restored.
+        #
+        os.system('umount %s > /dev/null 2>&1' % VM_JOB_MOUNT)
+        os.system('blockdev --flushbufs %s > /dev/null 2>&1' % VM_JOB_DEVICE)
+        if os.system('mount -t vfat -o ro %s %s' % (VM_JOB_DEVICE, VM_JOB_MOUNT)):
+            continue
+        if os.path.exists(os.path.join(VM_JOB_MOUNT, 'test_name')):
+            break
+
+    f = open('/proc/cmdline', 'rb')
+    cmdline = f.read().strip()
+    f.close()
+
+    kernel = os.path.join(VM_JOB_MOUNT, 'bzImage')
+    if os.system('%s -l %s --append="%s %s=1"' % (KEXEC_PATH, kernel, cmdline, VM_JOB_ARG)):
+        raise Exception('Failed loading the kernel of the job')
+
+    os.system('umount %s' % VM_JOB_MOUNT)
+    os.system('sync')
+    os.system('%s -e' % KEXEC_PATH)
+
+
+def run_guest_job(job_folder, results_device=VM_RESULTS_DEVICE):
+    """Run the test suite of a job inside the virtual machine.
+
+    The ids of the tests of the suite and the records of the test status
+    are sent while the tests run. When the job has the status of a guest
+    that crashed, the tests that it ran are skipped. The results are
+    written to the results device framed by begin/end markers, followed by
+    a line per test with its success status.
+    """
+
+    from fingerprint_utils import _suite_tests
+
+    #
+    # Copy the job locally (the job disk is read only).
+    #
+    if os.path.exists(VM_GUEST_FOLDER):
+        shutil.rmtree(VM_GUEST_FOLDER)
+    shutil.copytree(job_folder, VM_GUEST_FOLDER)
+
+    submission_folder = os.path.join(VM_GUEST_FOLDER, 'submission')
+    test_name = open(os.path.join(VM_GUEST_FOLDER, 'test_name'), 'rb').read().strip()
+    test_path = os.path.join(VM_GUEST_FOLDER, 'tests', test_name)
+
+    #
+    # Install the modules of the submission kernel.
+    #
+    modules_path = os.path.join(VM_GUEST_FOLDER, 'lib', 'modules', CUSTOM_KERNEL_VERSION)
+    if os.path.exists(modules_path):
+        os.system('rm -rf /lib/modules/%s' % CUSTOM_KERNEL_VERSION)
+        os.system('cp -rf %s /lib/modules/ && depmod -a' % modules_path)
+
+    results_path = os.path.join(VM_GUEST_FOLDER, VM_RESULTS_NAME)
+    f_results = open(results_path, 'wb', buffering=0)
+    f_dev = open(results_device, 'wb', buffering=0)
+
+    status_path = os.path.join(VM_GUEST_FOLDER, VM_STATUS_NAME)
+
+    tests_stats = {}
+    try:
+        test_module = import_path(test_path)
+        suite = test_module.suite(submission_path=submission_folder, test_path=test_path)
+        for test in _suite_tests(suite):
+            f_dev.write('%s\t%s\n' % (VM_SUITE_TAG, test.id()))
+
+        test_status = _SerialTestStatus(status_path, not os.path.exists(status_path), f_dev)
+        test_result = ParTextTestRunner(f_results, verbosity=2, test_status=test_status).run(suite)
+        tests_stats = test_result.testsStats
+    except:
+        f_results.flush()
+        traceback.print_exc(file=f_results)
+
+    f_results.close()
+
+    f_dev.write('%s\n' % VM_RESULTS_BEGIN)
+    f_dev.write(open(results_path, 'rb').read())
+    for test_id, success in tests_stats.items():
+        f_dev.write('%s\t%s\t%d\n' % (VM_TEST_TAG, test_id, success))
+    f_dev.write('%s\n' % VM_RESULTS_END)
+    f_dev.close()
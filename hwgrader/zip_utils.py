@@ -0,0 +1,230 @@
+#!/usr/bin/python
+
+from __future__ import division
+from grader_globals import *
+import zipfile
+import fnmatch
+import struct
+import zlib
+import urllib
+import os
+import shutil
+
+__all__ = [
+    'extract_zip',
+    'extracted_folder',
+    'save_extract_info',
+    'load_extract_info',
+    'remove_extracted'
+    ]
+
+#
+# Files and folders (matched against each part of the path) that the build
+# doesn't need: build products, version control and editor leftovers.
+#
+EXTRACT_IGNORE_PATTERNS = [
+    '*.o',
+    '*.ko',
+    '*.a',
+    '*.so',
+    '*.cmd',
+    '*.ver',
+    '*.pyc',
+    '*~',
+    '*.orig',
+    '*.rej',
+    '*.swp',
+    'vmlinux*',
+    'bzImage',
+    'System.map',
+    '.depend',
+    '.hdepend',
+    '.svn',
+    '.git',
+    'CVS',
+    '__MACOSX',
+    '.DS_Store'
+    ]
+
+#
+# Files above EXTRACT_MAX_FILE_SIZE are skipped, a submission above
+# EXTRACT_MAX_TOTAL_SIZE fails (e.g. a zip of a whole kernel tree).
+#
+EXTRACT_MAX_FILE_SIZE = 4*1024*1024
+EXTRACT_MAX_TOTAL_SIZE = 32*1024*1024
+
+EXTRACT_CHUNK_SIZE = 64*1024
+
+#
+# The statistics of a submission extracted at init are kept next to its
+# folder: files size duration, then a line per skipped entry.
+#
+EXTRACT_INFO_SUFFIX = '.extract'
+
+#
+# The fixed part of the local file header of a zip entry.
+#
+LOCAL_HEADER_FORMAT = '<4s5H3L2H'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+
+
+def extracted_folder(submission):
+    """The folder of a submission that was extracted at init (see validate_utils)"""
+
+    name = os.path.splitext(os.path.basename(submission))[0]
+
+    return os.path.join(EXTRACTED_FOLDER, name)
+
+
+def _extract_info_path(submission):
+    return extracted_folder(submission) + EXTRACT_INFO_SUFFIX
+
+
+def save_extract_info(submission, files, size, duration, skipped):
+    """Keep the statistics of the extraction at init, for the log of the boot loop"""
+
+    f = open(_extract_info_path(submission), 'wb')
+    f.write('%d %d %.3f\n' % (files, size, duration))
+    f.write(''.join([urllib.quote(name) + '\n' for name in skipped]))
+    f.close()
+
+
+def load_extract_info(submission):
+    """Return the (files, size, duration, skipped) saved by save_extract_info or None"""
+
+    info_path = _extract_info_path(submission)
+    if not os.path.exists(info_path):
+        return None
+
+    f = open(info_path, 'rb')
+    lines = f.readlines()
+    f.close()
+
+    files, size, duration = lines[0].split()
+    skipped = [urllib.unquote(line.rstrip('\n')) for line in lines[1:]]
+
+    return int(files), int(size), float(duration), skipped
+
+
+def remove_extracted(submission):
+    """Remove the folder of a submission extracted at init and its statistics"""
+
+    shutil.rmtree(extracted_folder(submission), ignore_errors=True)
+    if os.path.exists(_extract_info_path(submission)):
+        os.remove(_extract_info_path(submission))
+
+
+def _ignored(name, patterns):
+    for part in name.split('/'):
+        for pattern in patterns:
+            if fnmatch.fnmatch(part, pattern):
+                return True
+
+    return False
+
+
+def _extract_entry(f_zip, zinfo, dest_path, max_size):
+    """Stream a zip entry to dest_path. Returns the number of bytes written"""
+
+    f_zip.seek(zinfo.header_offset)
+    header = struct.unpack(LOCAL_HEADER_FORMAT, f_zip.read(LOCAL_HEADER_SIZE))
+    f_zip.seek(header[-2] + header[-1], 1)
+
+    if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    elif zinfo.compress_type == zipfile.ZIP_STORED:
+        decompressor = None
+    else:
+        raise Exception('Unsupported compression of %s in the zip' % zinfo.filename)
+
+    size = 0
+    crc = zlib.crc32('')
+    left = zinfo.compress_size
+    f = open(dest_path, 'wb')
+    try:
+        while left:
+            data = f_zip.read(min(left, EXTRACT_CHUNK_SIZE))
+            if not data:
+                raise Exception('Truncated entry %s in the zip' % zinfo.filename)
+            left -= len(data)
+
+            if decompressor:
+                data = decompressor.decompress(data)
+                if not left:
+                    data += decompressor.flush()
+
+            #
+            # The sizes in the zip directory can't be trusted.
+            #
+            size += len(data)
+            if size > max_size:
+                raise Exception('Entry %s of the zip is larger than %d bytes' % (zinfo.filename, max_size))
+
+            crc = zlib.crc32(data, crc)
+            f.write(data)
+    finally:
+        f.close()
+
+    if (crc & 0xffffffffL) != (zinfo.CRC & 0xffffffffL):
+        raise Exception('Bad CRC of entry %s in the zip' % zinfo.filename)
+
+    return size
+
+
+def extract_zip(zip_path, dest_folder, ignore=EXTRACT_IGNORE_PATTERNS, max_file_size=EXTRACT_MAX_FILE_SIZE, max_total_size=EXTRACT_MAX_TOTAL_SIZE):
+    """Extract a zip to dest_folder without loading whole entries to memory.
+
+    Entries that match the ignore patterns or are larger than max_file_size
+    are skipped, the extraction fails when more than max_total_size bytes
+    would be extracted. Returns (number of files, bytes, skipped entries).
+    """
+
+    z = zipfile.ZipFile(zip_path)
+    f_zip = open(zip_path, 'rb')
+
+    files = 0
+    total_size = 0
+    skipped = []
+    try:
+        for zinfo in z.infolist():
+            name = zinfo.filename.replace('\\', '/')
+            parts = [part for part in name.split('/') if part not in ('', '.')]
+            if name.startswith('/') or '..' in parts:
+                raise Exception('Entry %s of the zip is outside the submission folder' % zinfo.filename)
+
+            if not parts or _ignored(name, ignore):
+                if parts:
+                    skipped.append(zinfo.filename)
+                continue
+
+            dest_path = os.path.join(dest_folder, *parts)
+            if name.endswith('/'):
+                if not os.path.exists(dest_path):
+                    os.makedirs(dest_path)
+                continue
+
+            if zinfo.file_size > max_file_size:
+                skipped.append(zinfo.filename)
+                continue
+
+            if total_size + zinfo.file_size > max_total_size:
+                raise Exception('The zip is larger than %d bytes' % max_total_size)
+
+            if not os.path.exists(os.path.dirname(dest_path)):
+                os.makedirs(os.path.dirname(dest_path))
+
+            total_size += _extract_entry(f_zip, zinfo, dest_path, min(max_file_size, max_total_size - total_size))
+            files += 1
+
+            #
+            # Keep the execute permission (e.g. of scripts) of entries
+            # zipped on unix.
+            #
+            mode = (zinfo.external_attr >> 16) & 0777
+            if mode & 0111:
+                os.chmod(dest_path, mode)
+    finally:
+        f_zip.close()
+        z.close()
+
+    return files, total_size, skipped
@@ -15,8 +15,19 @@ import os
 import time
 from hwgrader import *
 from hwgrader.utils import *
+from hwgrader.build_utils import artifact_status, artifact_sources, artifact_from_cache, cache_built_kernel, install_artifact, \
+     prepare_kernel_tree, start_background_build, wait_background_build, headers_changed, choose_build_recipe, \
+     set_installed_modules, log_recipe_time, BUILD_RECIPE_FULL, MODULES_UNKNOWN, \
+     MODULES_MODIFIED, MODULES_REFERENCE
+from hwgrader.cc_cache import write_cache_stats
+from hwgrader.metrics_utils import set_metrics_path, set_metrics_submission, record_phase, record_reboot
+from hwgrader.state_utils import record_state, STATE_PHASE
+from hwgrader.index_utils import index_submission, remove_previous_results
+from hwgrader.lease_utils import set_shared_run, lock_shared_results, unlock_shared_results, finish_shared_submission
+from hwgrader.fingerprint_utils import suite_fingerprints, index_tests, previous_outcomes, seed_test_status
 import ConfigParser
 import traceback
+import signal
 
 
 def usage(test_path):
@@ -33,10 +44,99 @@ Options:
   -t, --test        set the path to the test file (default """ + test_path + """)
   -b, --break       break after compiling and loading the submission so that the test
                     can be run manually.
+  -p, --prebuild    build the kernels of all submissions in parallel before starting
+                    the boot loop (the boot loop only installs the built kernels).
+  -n, --nice        build the next submission in the background while the current one
+                    is tested, using the given nice level (e.g. -n 19).
+  -k, --kexec       switch kernels using kexec instead of a full reboot (falls back to
+                    a normal reboot when kexec is not available).
+  -f, --fast        unattended fast cycle: no keypress prompt (stop the grader by creating
+                    """ + ABORT_SENTINEL_PATH + """ or sending SIGUSR1 to the pid in
+                    """ + GRADER_PID_PATH + """), the grader is started directly by init
+                    and a kernel panic reboots after """ + str(FAST_PANIC_TIMEOUT) + """ seconds.
+  -I, --incremental grade only the submissions whose zip was not graded with this test
+                    file before and merge the results into the last grades/stats files.
+  -R, --reuse       copy the results of a submission with the same sources as one already
+                    graded with this test (and its helper files) instead of testing it.
+  -S, --shared      grade as one worker of the named shared run: the machines that are
+                    started with the same name on the same submissions folder take the
+                    submissions from a common queue (e.g. -S hw3).
+
+To grade in QEMU or User-Mode Linux guests instead of rebooting this machine use vm_grader.py.
 """
     print usage_doc
     
 
+def unzip_sources(submissions_folder, temp_folder, submission, f_results):
+    """Unzip the submission into a temporary path"""
+
+    unzip_submission(submissions_folder, temp_folder, submission, f_results)
+
+    if os.path.exists(os.path.join(temp_folder, 'Makefile')):
+        #
+        # Sometimes the students leave a Makefile in the main
+        # submission folder.
+        #
+        os.remove(os.path.join(temp_folder, 'Makefile'))
+        
+
+def build_submission(temp_folder, f_results):
+    """Compile and install the kernel of an unzipped submission"""
+
+    #
+    # Handle the compiling and loading of the new kernel
+    #
+    prepare_kernel_tree(CUSTOM_KERNEL_PATH, temp_folder)
+
+    #
+    # Choose the cheapest build recipe: the modules and initrd are built
+    # only when the submission changes a header file.
+    #
+    changed_headers = headers_changed(temp_folder)
+    recipe, reason = choose_build_recipe(changed_headers)
+    if recipe == BUILD_RECIPE_FULL:
+        build_script = BUILD_SCRIPT
+        set_installed_modules(MODULES_UNKNOWN)
+    else:
+        build_script = BUILD_NM_SCRIPT
+        
+    f_results.write("Start of compilation, recipe %s (%s)\n" % (recipe, reason))
+    start_time = time.time()
+    status = os.system(build_script + " " + temp_folder)
+    log_recipe_time('build', recipe, time.time() - start_time, f_results)
+    record_phase('build', start_time)
+    if status:
+        f_results.flush()
+        raise Exception('Failed building the submission, exit with status: %d' % (status/256))
+
+    #
+    # Identical sources (e.g. when regrading after a test fix) install
+    # this kernel instead of building it again.
+    #
+    cache_built_kernel(temp_folder, changed_headers)
+
+    if recipe == BUILD_RECIPE_FULL:
+        if changed_headers:
+            set_installed_modules(MODULES_MODIFIED)
+        else:
+            set_installed_modules(MODULES_REFERENCE)
+
+
+def install_kernel(temp_folder, submission, prebuilt, f_results):
+    """Install the kernel of an unzipped (or prebuilt) submission"""
+
+    if prebuilt:
+        #
+        # The kernel was already built, only install it.
+        #
+        install_artifact(submission, temp_folder, f_results)
+    elif artifact_from_cache(submission, temp_folder):
+        f_results.write("Reusing the kernel built from identical sources\n")
+        install_artifact(submission, temp_folder, f_results, write_header=False)
+    else:
+        build_submission(temp_folder, f_results)
+
+
 def main():
     """main"""
     
@@ -47,9 +147,16 @@ def main():
     test_folder = DEFAULT_TESTS_FOLDER
     test_path = os.path.join(test_folder, DEFAULT_TEST_NAME)
     break_flag = False
+    prebuild = False
+    pipeline_nice = None
+    kexec = False
+    fast = False
+    incremental = False
+    reuse = False
+    shared = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hirbt:", ["help", "init", "reset", "break", "test="])
+        opts, args = getopt.getopt(sys.argv[1:], "hirbpkfIRn:t:S:", ["help", "init", "reset", "break", "prebuild", "kexec", "fast", "incremental", "reuse", "nice=", "test=", "shared="])
     except getopt.GetoptError:
         # print help information and exit:
         usage(test_path)
@@ -70,6 +177,20 @@ def main():
             test_folder, test_name = os.path.split(test_path)
         if o in ("-b", "--break"):
             break_flag = True
+        if o in ("-p", "--prebuild"):
+            prebuild = True
+        if o in ("-n", "--nice"):
+            pipeline_nice = int(a)
+        if o in ("-k", "--kexec"):
+            kexec = True
+        if o in ("-f", "--fast"):
+            fast = True
+        if o in ("-I", "--incremental"):
+            incremental = True
+        if o in ("-R", "--reuse"):
+            reuse = True
+        if o in ("-S", "--shared"):
+            shared = a
 
     if args:
         submissions_folder = os.path.abspath(args[0])
@@ -78,17 +199,8 @@ def main():
         #
         # Init the grader and reboot for starting the test process
         #
-        init_grader(submissions_folder, test_path, break_flag, kernel_test=True)
-        os.system('reboot')
-        return
-    
-    #
-    # Prompt the user in case he wants to end the tests.
-    #
-    ch = prompt_with_timeout(timeout=5)
-    if ch != None:
-        print 'Terminating grader'
-        end_grader()
+        init_grader(submissions_folder, test_path, break_flag, kernel_test=True, prebuild=prebuild, pipeline_nice=pipeline_nice, kexec=kexec, fast=fast, incremental=incremental, shared=shared, reuse=reuse)
+        reboot(kexec)
         return
     
     #
@@ -102,7 +214,47 @@ def main():
     grades_path = config.get('paths', 'grades_path')
     stats_path = config.get('paths', 'stats_path')
     temp_folder = config.get('paths', 'temp_folder')
+    cache_stats_path = None
+    if config.has_option('paths', 'cache_stats_path'):
+        cache_stats_path = config.get('paths', 'cache_stats_path')
     break_flag = int(config.get('flags', 'break_flag'))
+    if config.has_option('flags', 'kexec'):
+        kexec = int(config.get('flags', 'kexec'))
+    pipeline_nice = None
+    if config.has_option('flags', 'pipeline_nice'):
+        pipeline_nice = int(config.get('flags', 'pipeline_nice'))
+    fast = False
+    if config.has_option('flags', 'fast'):
+        fast = int(config.get('flags', 'fast'))
+    incremental = False
+    if config.has_option('flags', 'incremental'):
+        incremental = int(config.get('flags', 'incremental'))
+    reuse = False
+    if config.has_option('flags', 'reuse'):
+        reuse = int(config.get('flags', 'reuse'))
+    if config.has_option('paths', 'metrics_path'):
+        set_metrics_path(config.get('paths', 'metrics_path'))
+    if config.has_option('paths', 'lease_folder'):
+        set_shared_run(config.get('paths', 'lease_folder'), config.get('flags', 'worker_id'))
+
+    record_reboot()
+    record_phase('boot_to_grader', time.time() - boot_latency())
+
+    #
+    # In fast mode the grader is stopped by the abort sentinel (or SIGUSR1),
+    # otherwise prompt the user in case he wants to end the tests.
+    #
+    install_abort_handler()
+    prompt_start_time = time.time()
+    if fast:
+        abort = abort_requested()
+    else:
+        abort = prompt_with_timeout(timeout=5) != None or abort_requested()
+    record_phase('prompt', prompt_start_time)
+    if abort:
+        print 'Terminating grader'
+        end_grader()
+        return
     
     #
     # Open the result file.
@@ -119,31 +271,81 @@ def main():
             return
         
         f_results.write("Start of automatic testing\n")
+        set_metrics_submission(current_submission())
 
         #
         # In the custom kernel. Run the test.
         #
+        suite_start_time = time.time()
         test_module = import_path(test_path)
         
+        #
+        # Build the next submission while this one is tested. Tests that
+        # are sensitive to timing can disable this by setting __pipeline__
+        # to False in the test module.
+        #
+        builder_pid = None
+        if pipeline_nice is not None and getattr(test_module, '__pipeline__', True):
+            pending_submission = peek_submission()
+            if pending_submission and artifact_status(pending_submission) is None:
+                f_results.write("Building submission %s in the background\n" % pending_submission)
+                builder_pid = start_background_build(pending_submission, nice=pipeline_nice)
+            
         #
         # Load the test status
         #
         test_status = TestStatus()
         
         try:
-            test_result = ParTextTestRunner(f_results, verbosity=2, test_status=test_status).run(
-                            test_module.suite(submission_path=temp_folder, test_path=test_path)
-                            )
-            add_grade(get_submitters(temp_folder), test_result, grades_path)
-            add_stats(get_submitters(temp_folder), test_result, stats_path)
+            suite = test_module.suite(submission_path=temp_folder, test_path=test_path)
+            fingerprints = suite_fingerprints(suite)
+            if incremental and not test_status.get_tests_ids():
+                #
+                # Run only the tests that changed since this zip was graded.
+                #
+                outcomes = previous_outcomes(current_submission(), fingerprints, os.path.dirname(grades_path))
+                seed_test_status(test_status, suite, outcomes)
+                f_results.write('Reusing the results of %d unchanged tests\n' % len(outcomes))
+            record_phase('suite', suite_start_time)
+
+            test_result = ParTextTestRunner(f_results, verbosity=2, test_status=test_status).run(suite)
+
+            results_start_time = time.time()
+            lock_shared_results()
+            try:
+                submitters = get_submitters(temp_folder)
+                if incremental:
+                    remove_previous_results(submitters, grades_path, stats_path)
+                add_grade(submitters, test_result, grades_path)
+                add_stats(submitters, test_result, stats_path)
+                index_submission(current_submission(), test_path, grades_path, stats_path, submitters)
+                index_tests(current_submission(), fingerprints, test_status, os.path.dirname(grades_path))
+            finally:
+                unlock_shared_results()
+            record_phase('results', results_start_time)
+            record_state(current_submission(), STATE_PHASE, 'test', 'done')
+            test_status.compact()
         except KeyboardInterrupt:
             f_results.write('Test terminated by user\n')
             f_results.close()
+            if builder_pid:
+                os.kill(-builder_pid, signal.SIGKILL)
+                wait_background_build(builder_pid)
             end_grader()
             return
         except:
             f_results.flush()
             traceback.print_exc(file=f_results)
+            record_state(current_submission(), STATE_PHASE, 'test', 'error')
+
+        finish_shared_submission(current_submission())
+
+        #
+        # Let the background build finish before rebooting.
+        #
+        if builder_pid:
+            status = wait_background_build(builder_pid)
+            f_results.write("Background build ended with status: %d\n" % (status/256))
 
         #
         # Change the grub to custom.
@@ -152,65 +354,116 @@ def main():
             
     else:
         #
-        # Compile and install the new Kernel.
+        # Compile and install the new Kernel. Submissions that fail to
+        # build get a zero grade and the next submission is processed
+        # without rebooting (there is no new kernel to test). So does a
+        # submission that is identical to one already graded with this
+        # test file: its results are copied.
         #
-        submission = next_submission(submissions_folder)
+        while 1:
+            if abort_requested():
+                f_results.write('\n\nGrader aborted by user\n')
+                f_results.close()
+                end_grader()
+                return
 
-        if not submission:
-            f_results.write('\n\nFinished checking all submissions\n')
-            f_results.close()
-            end_grader()
-            return
+            submission = next_submission(submissions_folder)
+    
+            if not submission:
+                f_results.write('\n\nFinished checking all submissions\n')
+                f_results.close()
+                end_grader()
+                return
+    
+            f_results.write('\n' + 70*'#' + '\nProcessing submission %s\n' % submission)
+            set_metrics_submission(submission)
+            
+            installed = False
+            reused = False
+            source_folder = None
+            try:
+                prebuilt = artifact_status(submission) is not None
+                if prebuilt:
+                    source_folder = artifact_sources(submission)
+                else:
+                    #
+                    # The unzip empties the temp folder first, so it never
+                    # holds the sources of the previous submission.
+                    #
+                    source_folder = temp_folder
+                    unzip_sources(submissions_folder, temp_folder, submission, f_results)
 
-        f_results.write('\n' + 70*'#' + '\nProcessing submission %s\n' % submission)
-        
-        try:
+                reused = reuse_results(submission, source_folder, test_path, grades_path, stats_path, incremental, f_results, reuse)
+                if not reused:
+                    install_kernel(temp_folder, submission, prebuilt, f_results)
+    
+                    #
+                    # Create a test status object.
+                    # Note:
+                    # it automatically saves itself on creation.
+                    #
+                    TestStatus(new=True)
+                    
+                    set_grub(custom=True)
+                    installed = True
+                    record_state(submission, STATE_PHASE, 'build', 'ok')
+    
+            except:
+                traceback.print_exc(file=f_results)
+            
             #
-            # Unzip the submission into a temporary path.
+            # Update the statistics of the compiler cache.
             #
-            unzip_submission(submissions_folder, temp_folder, submission, f_results)
+            if cache_stats_path:
+                write_cache_stats(cache_stats_path)
 
-            #
-            # Handle the compiling and loading of the new kernel
-            #
-            if os.path.exists(CUSTOM_KERNEL_PATH):
-                shutil.rmtree(CUSTOM_KERNEL_PATH)
-            shutil.copytree(CUSTOM_KERNEL_BAKCUP_PATH, CUSTOM_KERNEL_PATH)
+            if installed:
+                break
 
-            #
-            # Copy custom modificaions of the grader (memory tracking)
-            #
-            os.system('cp -rf %s %s' % (os.path.join(BASE_INSTALL_PATH, KERNEL_MODIFICATIONS_FOLDER, '*'), CUSTOM_KERNEL_PATH))
-            if os.path.exists(os.path.join(temp_folder, 'Makefile')):
-                #
-                # Sometimes the students leave a Makefile in the main
-                # submission folder.
-                #
-                os.remove(os.path.join(temp_folder, 'Makefile'))
-                
-            f_results.write("Start of compilation\n")
-            status = os.system(BUILD_SCRIPT + " " + temp_folder)
-            if status:
-                f_results.flush()
-                raise Exception('Failed building the submission, exit with status: %d' % (status/256))
+            if reused:
+                finish_shared_submission(submission)
+                f_results.write('Skipping to the next submission without reboot\n')
+                continue
+
+            record_state(submission, STATE_PHASE, 'build', 'failed')
 
             #
-            # Create a test status object.
-            # Note:
-            # it automatically saves itself on creation.
+            # The zero grade goes to the submitters of this submission (the
+            # temp folder might still hold the previous one when a prebuilt
+            # submission failed before its sources were copied).
             #
-            TestStatus(new=True)
-                
-            set_grub(custom=True)
+            submitters = None
+            if source_folder:
+                try:
+                    submitters = get_submitters(source_folder)
+                except:
+                    traceback.print_exc(file=f_results)
+            if not submitters:
+                f_results.write('No grade: the submitters of the submission are unknown\n')
+                finish_shared_submission(submission)
+                f_results.write('Skipping to the next submission without reboot\n')
+                continue
+
+            lock_shared_results()
+            try:
+                try:
+                    if incremental:
+                        remove_previous_results(submitters, grades_path, stats_path)
+                    add_failure(submitters, grades_path, stats_path)
+                    index_submission(submission, test_path, grades_path, stats_path, submitters)
+                except:
+                    traceback.print_exc(file=f_results)
+            finally:
+                unlock_shared_results()
+            finish_shared_submission(submission)
+
+            f_results.write('Skipping to the next submission without reboot\n')
 
-        except:
-            traceback.print_exc(file=f_results)
-        
     #
     # Handle reboot
     #
     f_results.close()
-    os.system('reboot')
+    reboot(kexec)
 
 
 if __name__ == '__main__':
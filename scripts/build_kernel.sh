@@ -0,0 +1,17 @@
+SRC=$2
+ARTIFACT=$3
+
+. grader_phase.sh
+
+phase copy_sources cp -rf --remove-destination $1/* $SRC/ || exit 1
+cd $SRC
+
+# Compile through the object cache (set HWGRADER_CC=gcc to disable)
+CC=${HWGRADER_CC:-"cache_cc.py gcc"}
+export HWGRADER_CC_BASEDIR=`pwd`
+
+phase make_bzImage make CC="$CC" bzImage || exit 2
+phase make_modules make CC="$CC" modules  || exit 3
+phase modules_install make modules_install INSTALL_MOD_PATH=$ARTIFACT || exit 4
+
+cp arch/i386/boot/bzImage System.map $ARTIFACT/ || exit 5
@@ -1,12 +1,18 @@
 SRC=/usr/src/linux-2.4.18-14custom/
 
-cp -rf $1/* $SRC/ || exit 1
+. grader_phase.sh
+
+phase copy_sources cp -rf --remove-destination $1/* $SRC/ || exit 1
 cd $SRC
 
-make bzImage || exit 2
-make modules  || exit 3
-make modules_install  || exit 4
+# Compile through the object cache (set HWGRADER_CC=gcc to disable)
+CC=${HWGRADER_CC:-"cache_cc.py gcc"}
+export HWGRADER_CC_BASEDIR=`pwd`
+
+phase make_bzImage make CC="$CC" bzImage || exit 2
+phase make_modules make CC="$CC" modules  || exit 3
+phase modules_install make modules_install  || exit 4
 
-make install  || exit 5
+phase make_install make install  || exit 5
 cd /boot
-mkinitrd -f 2.4.18-14custom.img 2.4.18-14custom || exit 6
+phase mkinitrd mkinitrd -f 2.4.18-14custom.img 2.4.18-14custom || exit 6
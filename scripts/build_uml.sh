@@ -0,0 +1,31 @@
+#!/bin/sh
+#
+# Build the User-Mode Linux kernel of a submission.
+# Usage: build_uml.sh SUBMISSION TREE ARTIFACT
+#
+SRC=$2
+ARTIFACT=$3
+
+. grader_phase.sh
+
+phase copy_sources cp -rf --remove-destination $1/* $SRC/ || exit 1
+cd $SRC
+
+# Compile through the object cache (set HWGRADER_CC=gcc to disable)
+CC=${HWGRADER_CC:-"cache_cc.py gcc"}
+export HWGRADER_CC_BASEDIR=`pwd`
+
+# The tree starts as a copy of the (i386) reference tree, clean it once for ARCH=um
+if [ ! -f .hwgrader_uml ]; then
+    make ARCH=um mrproper || exit 2
+    cp ${HWGRADER_UML_CONFIG:-arch/um/defconfig} .config || exit 2
+    make ARCH=um oldconfig < /dev/null || exit 2
+    make ARCH=um dep || exit 2
+    touch .hwgrader_uml
+fi
+
+phase make_linux make ARCH=um CC="$CC" linux || exit 2
+phase make_modules make ARCH=um CC="$CC" modules  || exit 3
+phase modules_install make ARCH=um modules_install INSTALL_MOD_PATH=$ARTIFACT || exit 4
+
+cp linux System.map $ARTIFACT/ || exit 5
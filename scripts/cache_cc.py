@@ -0,0 +1,30 @@
+#!/usr/bin/python
+#
+# cache_cc
+# --------
+#
+# A compiler wrapper that caches object files. The cache is keyed on the
+# preprocessed source, the compiler flags and the compiler version so
+# identical translation units (e.g. untouched kernel files in different
+# submissions) are compiled only once.
+#
+# Usage: cache_cc.py <compiler> [compiler arguments]
+#
+
+from __future__ import division
+import sys
+from hwgrader.cc_cache import compile_cached
+
+
+def main():
+    """main"""
+
+    if len(sys.argv) < 2:
+        print 'Usage: %s <compiler> [compiler arguments]' % sys.argv[0]
+        sys.exit(2)
+
+    sys.exit(compile_cached(sys.argv[1:]))
+
+
+if __name__ == '__main__':
+    main()
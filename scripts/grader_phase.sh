@@ -0,0 +1,15 @@
+# Sourced by the build scripts. Runs a build step and records its duration
+# in the metrics file of the grader (when HWGRADER_METRICS is set).
+# Usage: phase NAME COMMAND [ARGS...]
+phase() {
+    PHASE_NAME=$1
+    shift
+    PHASE_START=`date +%s.%N`
+    "$@"
+    PHASE_STATUS=$?
+    if [ -n "$HWGRADER_METRICS" ]; then
+        PHASE_END=`date +%s.%N`
+        awk "BEGIN { printf \"%.3f\t%s\t%s\t%.3f\n\", $PHASE_START, \"${HWGRADER_SUBMISSION:--}\", \"$PHASE_NAME\", $PHASE_END - $PHASE_START }" >> $HWGRADER_METRICS
+    fi
+    return $PHASE_STATUS
+}
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+#
+# grader_state
+# ------------
+#
+# Show the state of a grader run: the status of each submission
+# in the queue and the outcomes of its tests.
+#
+
+from __future__ import division
+import getopt
+import sys
+import os
+from hwgrader import *
+from hwgrader.state_utils import read_state, submission_phases, STATE_TEST, STATE_CHANNEL
+
+
+def usage():
+    """Print usage details"""
+
+    usage_doc = """
+Usage: """ + os.path.basename(sys.argv[0]) + """ [options] [submission]
+
+Shows the state of the running grader (stored under """ + STATE_STORE_FOLDER + """).
+Without a submission, prints a line per submission with the status of its phases
+and the number of tests that passed. With a submission, prints its tests and the
+events traffic of each test.
+Options:
+  -h, --help        show this help message and exit
+  -s, --state       set the path to the state folder
+"""
+    print usage_doc
+
+
+def main():
+    """main"""
+
+    state_folder = STATE_STORE_FOLDER
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hs:", ["help", "state="])
+    except getopt.GetoptError:
+        # print help information and exit:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o in ("-s", "--state"):
+            state_folder = os.path.abspath(a)
+
+    if args:
+        #
+        # Print the tests of a single submission.
+        #
+        for record in read_state(args[0], STATE_TEST, state_folder):
+            outcome, duration = record[4].split()
+            print '%-8s %8ss  %s' % (outcome, duration, record[3])
+
+        #
+        # The traffic of the events of each test (stalls are the times
+        # that a test process found the pipe full).
+        #
+        for record in read_state(args[0], STATE_CHANNEL, state_folder):
+            print '%-8s %s  %s' % ('channel', record[4], record[3])
+        return
+
+    submissions = []
+    for record in read_state(state_folder=state_folder):
+        if record[1] != '-' and record[1] not in submissions:
+            submissions.append(record[1])
+
+    for submission in submissions:
+        phases = submission_phases(submission, state_folder)
+        phases_str = ' '.join(['%s=%s' % item for item in phases.items()])
+
+        tests = {}
+        for record in read_state(submission, STATE_TEST, state_folder):
+            tests[record[3]] = record[4].split()[0]
+        passed = len([outcome for outcome in tests.values() if outcome == 'success'])
+
+        print '%-30s %-40s tests %d/%d' % (submission, phases_str, passed, len(tests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# guest_grader
+# ------------
+#
+# Runs inside a virtual machine started by vm_grader.py. Add this script
+# to the .bash_profile of the guest image. It grades the job when the
+# kernel was started with the hwgrader_job argument. When the job disk
+# has the wait marker (vm_grader.py -s) it waits for a job instead, the
+# host saves a snapshot of the guest at this point. A User-Mode Linux
+# guest gets the job folder of the host with hostfs instead of a disk.
+# A guest that crashed is started again with the test status that it
+# sent in the job folder and skips the tests that already ran.
+#
+
+from __future__ import division
+import sys
+import os
+from hwgrader import *
+from hwgrader.vm_utils import run_guest_job, wait_guest_job, VM_WAIT_NAME
+
+
+def main():
+    """main"""
+
+    f = open('/proc/cmdline', 'rb')
+    cmdline = f.read().split()
+    f.close()
+
+    if not os.path.exists(VM_JOB_MOUNT):
+        os.makedirs(VM_JOB_MOUNT)
+
+    if '%s=1' % VM_JOB_ARG not in cmdline:
+        if os.system('mount -t vfat -o ro %s %s > /dev/null 2>&1' % (VM_JOB_DEVICE, VM_JOB_MOUNT)):
+            return
+        if not os.path.exists(os.path.join(VM_JOB_MOUNT, VM_WAIT_NAME)):
+            os.system('umount %s' % VM_JOB_MOUNT)
+            return
+        wait_guest_job()
+        return
+
+    hostfs = [arg for arg in cmdline if arg.startswith(UML_HOSTFS_ARG + '=')]
+    if hostfs:
+        mount_cmd = 'mount -t hostfs -o ro,%s none %s' % (hostfs[0].split('=', 1)[1], VM_JOB_MOUNT)
+    else:
+        mount_cmd = 'mount -t vfat -o ro %s %s' % (VM_JOB_DEVICE, VM_JOB_MOUNT)
+
+    if os.system(mount_cmd):
+        raise Exception('Failed mounting the job disk')
+
+    try:
+        run_guest_job(VM_JOB_MOUNT)
+    finally:
+        if hostfs:
+            #
+            # A User-Mode Linux process restarts on reboot, halt ends it.
+            #
+            os.system('halt')
+        else:
+            #
+            # The guest is started with -no-reboot so this ends the virtual machine.
+            #
+            os.system('reboot')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,17 @@
+ARTIFACT=$1
+RECIPE=${2:-full}
+VERSION=2.4.18-14custom
+
+. grader_phase.sh
+
+if [ "$RECIPE" != "no_modules" ]; then
+    rm -rf /lib/modules/$VERSION/kernel
+    phase copy_modules cp -rf $ARTIFACT/lib/modules/$VERSION /lib/modules/ || exit 4
+fi
+
+phase installkernel /sbin/installkernel $VERSION $ARTIFACT/bzImage $ARTIFACT/System.map || exit 5
+
+if [ "$RECIPE" != "no_modules" ]; then
+    cd /boot
+    phase mkinitrd mkinitrd -f $VERSION.img $VERSION || exit 6
+fi
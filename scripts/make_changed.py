@@ -6,6 +6,7 @@ import getopt
 import sys
 import os
 from hwgrader import *
+from hwgrader.build_utils import snapshot_tree
 
 
 SRC_PATH = r'/mnt/hgfs/Shared/kernel_modifications'
@@ -83,16 +84,14 @@ def main():
             shutil.os.rename(CUSTOM_KERNEL_PATH, CUSTOM_KERNEL_BAKCUP_PATH)
     
         print 'Making a clean copy of the custom kernel'
-        if os.path.exists(CUSTOM_KERNEL_PATH):
-            shutil.rmtree(CUSTOM_KERNEL_PATH)
-        shutil.copytree(CUSTOM_KERNEL_BAKCUP_PATH, CUSTOM_KERNEL_PATH)
+        snapshot_tree(CUSTOM_KERNEL_BAKCUP_PATH, CUSTOM_KERNEL_PATH)
 
     #
     # Handle the compiling and loading of the new kernel
     #
     # Copy custom modificaions of the grader (memory tracking)
     #
-    os.system('cp -rf %s %s' % (os.path.join(BASE_INSTALL_PATH, KERNEL_MODIFICATIONS_FOLDER, '*'), CUSTOM_KERNEL_PATH))
+    os.system('cp -rf --remove-destination %s %s' % (os.path.join(BASE_INSTALL_PATH, KERNEL_MODIFICATIONS_FOLDER, '*'), CUSTOM_KERNEL_PATH))
 
     print 'Start of compilation'
     if no_modules:
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+#
+# metrics_summary
+# ---------------
+#
+# Summarize the metrics file of a grader run: where the time went
+# and the throughput in submissions per hour.
+#
+
+from __future__ import division
+import getopt
+import sys
+import os
+from hwgrader import *
+from hwgrader.metrics_utils import read_metrics
+
+
+def usage():
+    """Print usage details"""
+
+    usage_doc = """
+Usage: """ + os.path.basename(sys.argv[0]) + """ [options] <path to metrics file>
+
+Summarizes the metrics file of a grader run (written to the results folder
+of the submissions). Prints the total time of each phase, its share of the
+run and the number of submissions graded per hour.
+Options:
+  -h, --help        show this help message and exit
+  -t, --tests       show each test separately (by default all tests are summed
+                    as a single phase)
+"""
+    print usage_doc
+
+
+def format_duration(seconds):
+    return '%d:%02d:%02d' % (seconds // 3600, (seconds % 3600) // 60, seconds % 60)
+
+
+def main():
+    """main"""
+
+    split_tests = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "ht", ["help", "tests"])
+    except getopt.GetoptError:
+        # print help information and exit:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o in ("-t", "--tests"):
+            split_tests = True
+
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+
+    records = read_metrics(args[0])
+    if not records:
+        print 'No metrics in %s' % args[0]
+        return
+
+    #
+    # Sum the phases. The steps of the build scripts are recorded within
+    # the build/install phases, so the shares can add up to more than 100%.
+    #
+    totals = {}
+    counts = {}
+    submissions = {}
+    run_start = records[0][0]
+    run_end = records[0][0] + records[0][3]
+    for start_time, submission, phase, duration in records:
+        if phase.startswith('test ') and not split_tests:
+            phase = 'tests'
+        totals[phase] = totals.get(phase, 0) + duration
+        counts[phase] = counts.get(phase, 0) + 1
+        if submission != '-':
+            submissions[submission] = 1
+        run_start = min(run_start, start_time)
+        run_end = max(run_end, start_time + duration)
+
+    run_time = run_end - run_start
+
+    phases = [(total, phase) for phase, total in totals.items()]
+    phases.sort()
+    phases.reverse()
+
+    print '%-40s %10s %6s %8s %7s' % ('phase', 'total', 'count', 'mean(s)', 'share')
+    for total, phase in phases:
+        share = 0
+        if run_time:
+            share = 100 * total / run_time
+        print '%-40s %10s %6d %8.1f %6.1f%%' % (phase, format_duration(total), counts[phase], total / counts[phase], share)
+
+    print
+    print 'Run time: %s' % format_duration(run_time)
+    print 'Submissions: %d' % len(submissions)
+    if run_time:
+        print 'Throughput: %.1f submissions per hour' % (len(submissions) * 3600 / run_time)
+
+
+if __name__ == '__main__':
+    main()
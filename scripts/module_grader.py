@@ -15,6 +15,12 @@ import os
 import time
 from hwgrader import *
 from hwgrader.utils import *
+from hwgrader.health_utils import kernel_state, check_kernel_health
+from hwgrader.metrics_utils import set_metrics_path, set_metrics_submission, record_phase, record_reboot
+from hwgrader.state_utils import record_state, STATE_PHASE
+from hwgrader.index_utils import index_submission, remove_previous_results
+from hwgrader.lease_utils import set_shared_run, lock_shared_results, unlock_shared_results, finish_shared_submission
+from hwgrader.fingerprint_utils import suite_fingerprints, index_tests, previous_outcomes, seed_test_status
 import ConfigParser
 import traceback
 
@@ -33,6 +39,20 @@ Options:
   -t, --test        set the path to the test file (default """ + test_path + """)
   -b, --break       break after compiling and loading the submission so that the test
                     can be run manually.
+  -a, --always-reboot
+                    reboot after every submission (by default the next submission is
+                    tested in the same boot unless the kernel health check fails)
+  -f, --fast        unattended fast cycle: no keypress prompt (stop the grader by creating
+                    """ + ABORT_SENTINEL_PATH + """ or sending SIGUSR1 to the pid in
+                    """ + GRADER_PID_PATH + """), the grader is started directly by init
+                    and a kernel panic reboots after """ + str(FAST_PANIC_TIMEOUT) + """ seconds.
+  -I, --incremental grade only the submissions whose zip was not graded with this test
+                    file before and merge the results into the last grades/stats files.
+  -R, --reuse       copy the results of a submission with the same sources as one already
+                    graded with this test (and its helper files) instead of testing it.
+  -S, --shared      grade as one worker of the named shared run: the machines that are
+                    started with the same name on the same submissions folder take the
+                    submissions from a common queue (e.g. -S hw3).
 """
     print usage_doc
     
@@ -46,9 +66,14 @@ def main():
     submissions_folder = DEFAULT_SUBMISSIONS_FOLDER
     test_path = os.path.join(DEFAULT_TESTS_FOLDER, DEFAULT_TEST_NAME)
     break_flag = False
+    always_reboot = False
+    fast = False
+    incremental = False
+    reuse = False
+    shared = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hirbt:", ["help", "init", "reset", "break", "test="])
+        opts, args = getopt.getopt(sys.argv[1:], "hirbafIRt:S:", ["help", "init", "reset", "break", "always-reboot", "fast", "incremental", "reuse", "test=", "shared="])
     except getopt.GetoptError:
         # print help information and exit:
         usage(test_path)
@@ -68,6 +93,16 @@ def main():
             test_path = os.path.abspath(a)
         if o in ("-b", "--break"):
             break_flag = True
+        if o in ("-a", "--always-reboot"):
+            always_reboot = True
+        if o in ("-f", "--fast"):
+            fast = True
+        if o in ("-I", "--incremental"):
+            incremental = True
+        if o in ("-R", "--reuse"):
+            reuse = True
+        if o in ("-S", "--shared"):
+            shared = a
 
     if args:
         submissions_folder = os.path.abspath(args[0])
@@ -76,8 +111,8 @@ def main():
         #
         # Init the grader and reboot for starting the test process
         #
-        init_grader(submissions_folder, test_path, break_flag, kernel_test=False)
-        os.system('reboot')
+        init_grader(submissions_folder, test_path, break_flag, kernel_test=False, always_reboot=always_reboot, fast=fast, incremental=incremental, shared=shared, reuse=reuse)
+        reboot()
         return
     
     if break_flag:
@@ -85,15 +120,6 @@ def main():
         f_results.close()
         return
     
-    #
-    # Prompt the user in case he wants to end the tests.
-    #
-    ch = prompt_with_timeout(timeout=5)
-    if ch != None:
-        print 'Terminating grader'
-        end_grader()
-        return
-    
     #
     # Read the configuration file
     #
@@ -106,81 +132,182 @@ def main():
     stats_path = config.get('paths', 'stats_path')
     temp_folder = config.get('paths', 'temp_folder')
     break_flag = int(config.get('flags', 'break_flag'))
+    always_reboot = False
+    if config.has_option('flags', 'always_reboot'):
+        always_reboot = int(config.get('flags', 'always_reboot'))
+    fast = False
+    if config.has_option('flags', 'fast'):
+        fast = int(config.get('flags', 'fast'))
+    incremental = False
+    if config.has_option('flags', 'incremental'):
+        incremental = int(config.get('flags', 'incremental'))
+    reuse = False
+    if config.has_option('flags', 'reuse'):
+        reuse = int(config.get('flags', 'reuse'))
+    if config.has_option('paths', 'metrics_path'):
+        set_metrics_path(config.get('paths', 'metrics_path'))
+    if config.has_option('paths', 'lease_folder'):
+        set_shared_run(config.get('paths', 'lease_folder'), config.get('flags', 'worker_id'))
+
+    record_reboot()
+    record_phase('boot_to_grader', time.time() - boot_latency())
+
+    #
+    # In fast mode the grader is stopped by the abort sentinel (or SIGUSR1),
+    # otherwise prompt the user in case he wants to end the tests.
+    #
+    install_abort_handler()
+    prompt_start_time = time.time()
+    if fast:
+        abort = abort_requested()
+    else:
+        abort = prompt_with_timeout(timeout=5) != None or abort_requested()
+    record_phase('prompt', prompt_start_time)
+    if abort:
+        print 'Terminating grader'
+        end_grader()
+        return
     
     #
     # Open the result file.
     #
     f_results = open(results_path, 'ab', buffering=0)
     
-    try:
+    while 1:
+        if abort_requested():
+            f_results.write('\n\nGrader aborted by user\n')
+            f_results.close()
+            end_grader()
+            return
+
         #
-        # Load a previous test_status (in cash the test rebooted)
-        # or create a new one.
+        # Record the state of the kernel for the health check.
         #
-        if os.path.exists(TEST_STATUS_PATH):
-            #
-            # Continue with the last submission (it probably crashed/rebooted in the middle)
-            #
-            test_status = TestStatus(path=TEST_STATUS_PATH)
-        else:
+        state = kernel_state()
+
+        reused = False
+        try:
             #
-            # Test a new submission
+            # Load a previous test_status (in cash the test rebooted)
+            # or create a new one.
             #
-            test_status = TestStatus(path=TEST_STATUS_PATH, new=True)
+            if os.path.exists(TEST_STATUS_PATH):
+                #
+                # Continue with the last submission (it probably crashed/rebooted in the middle)
+                #
+                test_status = TestStatus(path=TEST_STATUS_PATH)
+                set_metrics_submission(current_submission())
+            else:
+                #
+                # Test a new submission
+                #
+                test_status = TestStatus(path=TEST_STATUS_PATH, new=True)
             
-            #
-            # Get next submission.
-            #
-            submission = next_submission(submissions_folder)
+                #
+                # Get next submission.
+                #
+                submission = next_submission(submissions_folder)
     
-            if not submission:
-                f_results.write('\n'+70*'#'+'\nFinished checking all submissions\n')
-                f_results.close()
-                end_grader()
-                return
+                if not submission:
+                    f_results.write('\n'+70*'#'+'\nFinished checking all submissions\n')
+                    f_results.close()
+                    end_grader()
+                    return
     
-            f_results.write('\n'+70*'#'+'\nProcessing submission %s\n' % submission)
+                f_results.write('\n'+70*'#'+'\nProcessing submission %s\n' % submission)
+                set_metrics_submission(submission)
             
-            unzip_submission(submissions_folder, temp_folder, submission, f_results)
+                unzip_submission(submissions_folder, temp_folder, submission, f_results)
+
+                #
+                # With -R a submission identical to one already graded
+                # with this test is not tested again.
+                #
+                reused = reuse_results(submission, temp_folder, test_path, grades_path, stats_path, incremental, f_results, reuse)
             
-            os.chdir(temp_folder)
-            if not os.path.exists(os.path.join(temp_folder, MAKE_FILE)):
-                test_folder, test_name = os.path.split(test_path)
-                shutil.copy(os.path.join(test_folder, MAKE_FILE), temp_folder)
+                if not reused:
+                    os.chdir(temp_folder)
+                    if not os.path.exists(os.path.join(temp_folder, MAKE_FILE)):
+                        test_folder, test_name = os.path.split(test_path)
+                        shutil.copy(os.path.join(test_folder, MAKE_FILE), temp_folder)
     
-            if os.system('make'):
-                raise Exception('Failed make of the submission.') 
+                    make_start_time = time.time()
+                    if os.system('make'):
+                        record_state(submission, STATE_PHASE, 'build', 'failed')
+                        raise Exception('Failed make of the submission.') 
+                    record_phase('make', make_start_time)
+                    record_state(submission, STATE_PHASE, 'build', 'ok')
+    
+            if not reused:
+                #
+                # Run the test.
+                #
+                suite_start_time = time.time()
+                test_module = import_path(test_path)
+                suite = test_module.suite(submission_path=temp_folder, test_path=test_path)
+                fingerprints = suite_fingerprints(suite)
+                if incremental and not test_status.get_tests_ids():
+                    #
+                    # Run only the tests that changed since this zip was graded.
+                    #
+                    outcomes = previous_outcomes(current_submission(), fingerprints, os.path.dirname(grades_path))
+                    seed_test_status(test_status, suite, outcomes)
+                    f_results.write('Reusing the results of %d unchanged tests\n' % len(outcomes))
+                record_phase('suite', suite_start_time)
+
+                test_result = ParTextTestRunner(f_results, verbosity=2, test_status=test_status).run(suite)
+
+                results_start_time = time.time()
+                lock_shared_results()
+                try:
+                    submitters = get_submitters(temp_folder)
+                    if incremental:
+                        remove_previous_results(submitters, grades_path, stats_path)
+                    add_grade(submitters, test_result, grades_path)
+                    add_stats(submitters, test_result, stats_path)
+                    index_submission(current_submission(), test_path, grades_path, stats_path, submitters)
+                    index_tests(current_submission(), fingerprints, test_status, os.path.dirname(grades_path))
+                finally:
+                    unlock_shared_results()
+                record_phase('results', results_start_time)
+                record_state(current_submission(), STATE_PHASE, 'test', 'done')
+        except KeyboardInterrupt:
+            f_results.write('Test terminated by user\n')
+            f_results.close()
+            end_grader()
+            return
+        except:
+            f_results.flush()
+            traceback.print_exc(file=f_results)
     
         #
-        # Run the test.
+        # Delete the test_status to signal that we
+        # finished processing this submission
         #
-        test_module = import_path(test_path)
-
-        test_result = ParTextTestRunner(f_results, verbosity=2, test_status=test_status).run(
-            test_module.suite(submission_path=temp_folder, test_path=test_path)
-            )
-        add_grade(get_submitters(temp_folder), test_result, grades_path)
-        add_stats(get_submitters(temp_folder), test_result, stats_path)
-    except KeyboardInterrupt:
-        f_results.write('Test terminated by user\n')
-        f_results.close()
-        end_grader()
-        return
-    except:
-        f_results.flush()
-        traceback.print_exc(file=f_results)
-    
-    #
-    # Delete the test_status to signal that we
-    # finished processing this submission
-    #
-    os.remove(TEST_STATUS_PATH)
-    
+        finish_shared_submission(current_submission())
+        remove_test_status()
+
+        if always_reboot:
+            break
+
+        #
+        # Continue with the next submission in the same boot unless
+        # the submission damaged the kernel.
+        #
+        health_start_time = time.time()
+        problems = check_kernel_health(state)
+        record_phase('health_check', health_start_time)
+        if problems:
+            f_results.write('The kernel health check failed, rebooting:\n')
+            for problem in problems:
+                f_results.write('    %s\n' % problem)
+            break
+
     #
     # Handle reboot
     #
     f_results.close()
-    os.system('reboot')
+    reboot()
 
 if __name__ == '__main__':
     main()
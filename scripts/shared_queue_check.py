@@ -0,0 +1,167 @@
+#!/usr/bin/python
+#
+# shared_queue_check
+# ------------------
+#
+# Check the protocol of shared runs on one machine: several worker
+# processes, each with its own state folder (a stand-in for a grader
+# machine), grade fake submissions from a common leases folder. Some
+# workers crash in the middle of a submission, the others must take over
+# their submissions once the leases expire.
+#
+
+from __future__ import division
+import traceback
+import tempfile
+import getopt
+import random
+import shutil
+import time
+import sys
+import os
+from hwgrader import *
+from hwgrader.state_utils import init_state
+from hwgrader.lease_utils import claim_shared, renew_leases, lock_results, unlock_results, \
+     mark_done, is_done
+
+
+def usage():
+    """Print usage details"""
+
+    usage_doc = """
+Usage: """ + os.path.basename(sys.argv[0]) + """ [options] [path to shared folder]
+
+Runs worker processes that grade fake submissions using the leases of a
+shared run, then checks that every submission was graded exactly once.
+The shared folder (e.g. a folder on the shared submissions mount) defaults
+to a temporary folder.
+Options:
+  -h, --help        show this help message and exit
+  -w, --workers     number of workers (default 4)
+  -n, --number      number of submissions (default 40)
+  -c, --crash       probability that a worker crashes in a step of a submission (default 0.01)
+  -l, --lease       lease timeout in seconds (default 3)
+"""
+    print usage_doc
+
+
+def worker_main(index, shared_folder, lease_timeout, crash):
+    """Grade fake submissions until the queue is done"""
+
+    lease_folder = os.path.join(shared_folder, 'leases')
+    state_folder = os.path.join(shared_folder, 'state_%d' % index)
+    worker = 'worker-%d-%d' % (index, os.getpid())
+    random.seed(os.getpid())
+
+    while 1:
+        submission = claim_shared(lease_folder, worker, state_folder, poll=lease_timeout/10, timeout=lease_timeout)
+        if not submission:
+            return
+
+        #
+        # Grade, renewing the lease like the heartbeat of the grader.
+        #
+        for step in range(random.randint(1, 5)):
+            if random.random() < crash:
+                os._exit(1)
+            time.sleep(lease_timeout/10)
+            renew_leases(lease_folder, worker)
+
+        lock_results(lease_folder, worker, timeout=lease_timeout, poll=lease_timeout/10)
+        try:
+            f = open(os.path.join(shared_folder, 'grades.txt'), 'ab')
+            f.write('%s\t%s\n' % (submission, worker))
+            f.close()
+        finally:
+            unlock_results(lease_folder, worker)
+
+        mark_done(lease_folder, submission, worker)
+
+
+def main():
+    """main"""
+
+    workers = 4
+    number = 40
+    crash = 0.01
+    lease_timeout = 3
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hw:n:c:l:", ["help", "workers=", "number=", "crash=", "lease="])
+    except getopt.GetoptError:
+        # print help information and exit:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o in ("-w", "--workers"):
+            workers = int(a)
+        if o in ("-n", "--number"):
+            number = int(a)
+        if o in ("-c", "--crash"):
+            crash = float(a)
+        if o in ("-l", "--lease"):
+            lease_timeout = int(a)
+
+    if args:
+        shared_folder = os.path.join(os.path.abspath(args[0]), 'shared_queue_check_%d' % os.getpid())
+    else:
+        shared_folder = tempfile.mktemp()
+    os.makedirs(os.path.join(shared_folder, 'leases'))
+
+    submissions = ['submission_%03d.zip' % i for i in range(number)]
+
+    pids = []
+    for index in range(workers):
+        init_state(submissions, os.path.join(shared_folder, 'state_%d' % index))
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                try:
+                    worker_main(index, shared_folder, lease_timeout, crash)
+                    status = 0
+                except:
+                    traceback.print_exc()
+            finally:
+                os._exit(status)
+        pids.append(pid)
+
+    crashed = 0
+    for pid in pids:
+        pid, status = os.waitpid(pid, 0)
+        if status:
+            crashed += 1
+
+    #
+    # Check the results.
+    #
+    graded = {}
+    grades_path = os.path.join(shared_folder, 'grades.txt')
+    if os.path.exists(grades_path):
+        f = open(grades_path, 'rb')
+        for line in f.readlines():
+            submission = line.split('\t')[0]
+            graded[submission] = graded.get(submission, 0) + 1
+        f.close()
+
+    missing = [submission for submission in submissions if not graded.has_key(submission) or not is_done(os.path.join(shared_folder, 'leases'), submission)]
+    twice = [submission for submission in submissions if graded.get(submission, 0) > 1]
+
+    print '%d workers (%d crashed), %d submissions: %d graded, %d missing, %d graded twice' % \
+          (workers, crashed, number, len(graded), len(missing), len(twice))
+
+    if crashed == workers and missing:
+        print 'All the workers crashed, the missing submissions are expected'
+    elif missing or twice:
+        print 'Failed, see %s' % shared_folder
+        sys.exit(1)
+
+    shutil.rmtree(shared_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+#!/usr/bin/python
+#
+# vm_grader
+# ---------
+#
+# Grade several submissions concurrently, each one in its own
+# virtual machine.
+#
+
+from __future__ import division
+import getopt
+import glob
+import sys
+import os
+from hwgrader import *
+from hwgrader.utils import submission_paths
+from hwgrader.build_utils import cpu_count
+from hwgrader.metrics_utils import set_metrics_path
+from hwgrader.vm_utils import init_vm_grader, end_vm_grader, grade_in_vms, \
+     create_vm_snapshot, snapshot_command, qemu_command, uml_command
+
+
+def usage(test_path):
+    """Print usage details"""
+    
+    usage_doc = """
+Usage: """ + os.path.basename(sys.argv[0]) + """ [options] [path to submission folder]
+
+Grades the submissions in virtual machines, several submissions at once. The submissions
+folder, if not set, defaults to """ + DEFAULT_SUBMISSIONS_FOLDER + """
+The kernel of each submission is built and booted in a QEMU guest that runs the root image
+copy-on-write. The guest image should have hwgrader installed and run """ + GUEST_GRADER_SCRIPT + """
+on (auto)login.
+Options:
+  -h, --help        show this help message and exit
+  -r, --reset       reset the custom kernel files (after a bad exit)
+  -t, --test        set the path to the test file (default """ + test_path + """)
+  -i, --image       set the path to the root image of the guests
+  -j, --jobs        number of concurrent guests (default """ + str(cpu_count()) + """)
+  -s, --snapshot    boot the guest once and restore a snapshot of it for each submission
+                    (the guest kernel must support kexec)
+  -u, --uml         build User-Mode Linux kernels and run them as host processes
+                    (the image is the root filesystem of the guests)
+
+A guest that crashes or times out is restarted from the test status that it sent (kept in
+its job folder) and skips the tests that already ran.
+"""
+    print usage_doc
+    
+
+def main():
+    """main"""
+    
+    #
+    # Parse the command line
+    #
+    submissions_folder = DEFAULT_SUBMISSIONS_FOLDER
+    test_path = os.path.join(DEFAULT_TESTS_FOLDER, DEFAULT_TEST_NAME)
+    root_image = None
+    workers = cpu_count()
+    snapshot = False
+    uml = False
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hrsut:i:j:", ["help", "reset", "snapshot", "uml", "test=", "image=", "jobs="])
+    except getopt.GetoptError:
+        # print help information and exit:
+        usage(test_path)
+        sys.exit(2)
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage(test_path)
+            sys.exit()
+        if o in ("-r", "--reset"):
+            end_vm_grader()
+            return
+        if o in ("-t", "--test"):
+            test_path = os.path.abspath(a)
+        if o in ("-i", "--image"):
+            root_image = os.path.abspath(a)
+        if o in ("-j", "--jobs"):
+            workers = int(a)
+        if o in ("-s", "--snapshot"):
+            snapshot = True
+        if o in ("-u", "--uml"):
+            uml = True
+
+    if args:
+        submissions_folder = os.path.abspath(args[0])
+        
+    if not root_image:
+        usage(test_path)
+        sys.exit(2)
+
+    paths = submission_paths(submissions_folder)
+    set_metrics_path(paths['metrics_path'])
+    submissions = glob.glob(os.path.join(submissions_folder, '*.[zZ][iI][pP]'))
+
+    init_vm_grader()
+    try:
+        if uml:
+            grade_in_vms(submissions, test_path, root_image, paths, workers, uml_command, BUILD_UML_SCRIPT)
+        elif snapshot:
+            create_vm_snapshot(root_image, VM_SNAPSHOT_PATH)
+            grade_in_vms(submissions, test_path, VM_SNAPSHOT_PATH, paths, workers, snapshot_command)
+        else:
+            grade_in_vms(submissions, test_path, root_image, paths, workers, qemu_command)
+    finally:
+        end_vm_grader()
+
+    print 'Results written to %s' % paths['results_path']
+
+
+if __name__ == '__main__':
+    main()
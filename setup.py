@@ -5,6 +5,7 @@ from distutils.extension import Extension
 import os
 from hwgrader import BASE_INSTALL_PATH, AUTOLOGIN_FILES_FOLDER, \
      MMLOG_FILES_FOLDER, KERNEL_MODIFICATIONS_FOLDER, BUILD_SCRIPT, BUILD_NM_SCRIPT, \
+     BUILD_KERNEL_SCRIPT, INSTALL_KERNEL_SCRIPT, CACHE_CC_SCRIPT, GUEST_GRADER_SCRIPT, BUILD_UML_SCRIPT, PHASE_SCRIPT, \
      WD_FILES_FOLDER
 
 
@@ -69,8 +70,18 @@ def main():
             'scripts/boot_grader.py',
             'scripts/make_changed.py',
             'scripts/module_grader.py',
+            'scripts/vm_grader.py',
+            'scripts/metrics_summary.py',
+            'scripts/grader_state.py',
+            'scripts/shared_queue_check.py',
+            'scripts/%s' % GUEST_GRADER_SCRIPT,
             'scripts/%s' % BUILD_SCRIPT,
             'scripts/%s' % BUILD_NM_SCRIPT,
+            'scripts/%s' % BUILD_KERNEL_SCRIPT,
+            'scripts/%s' % INSTALL_KERNEL_SCRIPT,
+            'scripts/%s' % CACHE_CC_SCRIPT,
+            'scripts/%s' % BUILD_UML_SCRIPT,
+            'scripts/%s' % PHASE_SCRIPT,
             'scripts/mmlog_module_load',
             'scripts/mmlog_module_unload',
             'scripts/wd_module_load',